@@ -0,0 +1,140 @@
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+
+def percentiles(samples, points=(50, 90, 95, 99)):
+    """
+    Nearest-rank percentiles of a list of numbers.
+
+    Returns:
+        dict: {"p50": ..., ..., "max": ..., "mean": ..., "count": ...}; values are None when empty
+    """
+    ordered = sorted(samples)
+    result = {"count": len(ordered)}
+    if not ordered:
+        result.update({f"p{p}": None for p in points}, max=None, mean=None)
+        return result
+    for p in points:
+        rank = max(1, -(-p * len(ordered) // 100))  # ceil(p/100 * n)
+        result[f"p{p}"] = ordered[rank - 1]
+    result["max"] = ordered[-1]
+    result["mean"] = sum(ordered) / len(ordered)
+    return result
+
+
+def peak_rss_kb():
+    """Peak resident set size of this process in KiB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is bytes on macOS, KiB elsewhere
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+class Phase:
+    """
+    Wall-clock and process CPU time of one benchmark phase.
+
+    Use as a context manager, count handled events in .events, then read
+    .result() for throughput and CPU per event.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.events = 0
+        self.extra = {}
+        self.wall = self.cpu = 0.0
+
+    def __enter__(self):
+        self._wall0, self._cpu0 = time.perf_counter(), time.process_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wall = time.perf_counter() - self._wall0
+        self.cpu = time.process_time() - self._cpu0
+
+    def result(self):
+        return {
+            "events": self.events,
+            "wall_s": round(self.wall, 6),
+            "cpu_s": round(self.cpu, 6),
+            "events_per_s": round(self.events / self.wall, 2) if self.wall else None,
+            "cpu_us_per_event": round(self.cpu / self.events * 1e6, 2) if self.events else None,
+            **self.extra,
+        }
+
+
+def git_revision():
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, timeout=5, check=True,
+        )
+        return out.stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def write_results(path, benchmark, params, phases):
+    """Write a machine-readable results file and return its content"""
+    results = {
+        "benchmark": benchmark,
+        "revision": git_revision(),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": params,
+        "peak_rss_kb": peak_rss_kb(),
+        "phases": phases,
+    }
+    if path:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return results
+
+
+def compare(baseline_path, results, keys=("p50", "p95", "p99", "events_per_s", "cpu_us_per_event")):
+    """
+    Print per-phase changes against an earlier results file.
+
+    Returns:
+        list: (phase, metric, old, new, change in %) rows
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    rows = []
+    for phase, metrics in results["phases"].items():
+        old_metrics = baseline.get("phases", {}).get(phase, {})
+        for key, new in _flatten(metrics):
+            if key.rsplit(".", 1)[-1] not in keys:
+                continue
+            old = dict(_flatten(old_metrics)).get(key)
+            if not isinstance(old, (int, float)) or not isinstance(new, (int, float)) or not old:
+                continue
+            rows.append((phase, key, old, new, (new - old) / old * 100))
+    print(f"\nAgainst {baseline_path} (revision {baseline.get('revision')}):")
+    for phase, key, old, new, change in rows:
+        print(f"  {phase:<10} {key:<32} {old:>12.3f} -> {new:>12.3f}  {change:+7.1f}%")
+    return rows
+
+
+def _flatten(metrics, prefix=""):
+    for key, value in metrics.items():
+        if isinstance(value, dict):
+            yield from _flatten(value, f"{prefix}{key}.")
+        else:
+            yield f"{prefix}{key}", value
+
+
+def print_results(results):
+    print(f"\n{results['benchmark']} @ {results['revision']}  params={results['params']}")
+    for phase, metrics in results["phases"].items():
+        print(f"  [{phase}]")
+        for key, value in _flatten(metrics):
+            print(f"    {key:<32} {value}")
+    print(f"  peak RSS: {results['peak_rss_kb'] / 1024:.1f} MiB")
@@ -0,0 +1,179 @@
+"""
+REST hot-path benchmark for CreateOrGetRoom.post and RoomMessages.get.
+
+Runs the Django request stack in-process on SQLite against the stub auth
+service, for rooms holding --sizes messages each:
+
+    python -m benchmarks.rest_bench --requests 500 --sizes 0,1000,10000 --out bench-results/rest.json
+    python -m benchmarks.rest_bench --requests 500 --baseline bench-results/rest.json
+
+Every phase reports requests/sec, latency percentiles, CPU per request,
+SQL statements per request and auth service calls per request. The
+budgets those last two must stay within are enforced by HotPathBudgetTest
+in chat/tests.py.
+"""
+import argparse
+import contextlib
+import os
+import time
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "benchmarks.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+import jwt  # noqa: E402
+from django.conf import settings  # noqa: E402
+from django.core.management import call_command  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test import Client  # noqa: E402
+from django.test.utils import CaptureQueriesContext  # noqa: E402
+
+from benchmarks.harness import Phase, compare, percentiles, print_results, write_results  # noqa: E402
+from benchmarks.stub_auth import StubAuthService  # noqa: E402
+
+USER_ID = "1"
+
+
+def prepare_database(sizes):
+    """Migrate a fresh SQLite file and create one room per history size; returns {size: room_id}"""
+    from chat.models import ChatRoom, Message
+
+    path = settings.DATABASES["default"]["NAME"]
+    if os.path.exists(path):
+        os.remove(path)
+    call_command("migrate", verbosity=0)
+    rooms = {}
+    for index, size in enumerate(sizes):
+        room = ChatRoom.objects.create(participant_a=USER_ID, participant_b=str(1_000_000 + index))
+        Message.objects.bulk_create(
+            [
+                Message(room=room, sender_id=(USER_ID, room.participant_b)[n % 2], content=f"message {n}", seq=n + 1)
+                for n in range(size)
+            ],
+            batch_size=1000,
+        )
+        ChatRoom.objects.filter(id=room.id).update(last_seq=size)
+        rooms[size] = room.id
+    return rooms
+
+
+def measure(name, auth, requests):
+    """
+    Issue every request from the iterable, which yields (callable, expected statuses).
+
+    Returns:
+        dict: Phase results with latency, SQL statements and auth calls per request
+    """
+    latencies, errors = [], 0
+    auth_before = auth.calls
+    with CaptureQueriesContext(connection) as queries, Phase(name) as phase:
+        for issue, expected in requests:
+            started = time.perf_counter()
+            response = issue()
+            latencies.append(time.perf_counter() - started)
+            if response.status_code not in expected:
+                errors += 1
+        phase.events = len(latencies)
+    statements = [q for q in queries.captured_queries if not _is_transaction_control(q["sql"])]
+    phase.extra.update({
+        "errors": errors,
+        "latency_ms": percentiles([round(s * 1000, 3) for s in latencies]),
+        "queries_per_request": round(len(statements) / max(1, phase.events), 3),
+        "auth_calls_per_request": round((auth.calls - auth_before) / max(1, phase.events), 3),
+    })
+    return phase.result()
+
+
+def _is_transaction_control(sql):
+    return sql.split(" ", 1)[0].upper() in ("BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE")
+
+
+def run(args, auth):
+    from chat import auth_client, membership
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    rooms = prepare_database(sizes)
+    membership.clear_room_cache()
+    auth_client.clear_profile_cache()
+    auth_client.clear_known_users()
+
+    token = jwt.encode({"user_id": USER_ID, "exp": int(time.time()) + 3600}, settings.JWT_SECRET, algorithm="HS256")
+    client = Client(HTTP_AUTHORIZATION=f"Bearer {token}")
+    phases = {}
+
+    def create(partner):
+        return lambda: client.post("/api/chat/rooms/", {"participant_a": USER_ID, "participant_b": str(partner)})
+
+    def cold(issue):
+        def run_cold():
+            auth_client.clear_profile_cache()
+            auth_client.clear_known_users()
+            return issue()
+        return run_cold
+
+    partners = range(2, 2 + args.requests)
+    phases["create_room_cold_auth"] = measure(
+        "create_room_cold_auth", auth, ((cold(create(p)), (201,)) for p in partners)
+    )
+    partners = range(2 + args.requests, 2 + 2 * args.requests)
+    phases["create_room_new"] = measure("create_room_new", auth, ((create(p), (201,)) for p in partners))
+    phases["create_room_existing"] = measure("create_room_existing", auth, ((create(p), (200,)) for p in partners))
+
+    for size, room_id in rooms.items():
+        url = f"/api/chat/rooms/{room_id}/messages/"
+        latest = (lambda: client.get(url, {"limit": args.page_size}), (200,))
+        phases[f"messages_latest_{size}"] = measure(
+            f"messages_latest_{size}", auth, (latest for _ in range(args.requests))
+        )
+        phases[f"messages_walk_{size}"] = measure(
+            f"messages_walk_{size}", auth, _walk_history(client, url, args.page_size, args.requests)
+        )
+    return phases
+
+
+def _walk_history(client, url, page_size, requests):
+    """Page backwards through a room's history with "prev" cursors, wrapping around at the start"""
+    cursor = None
+    for _ in range(requests):
+        params = {"limit": page_size}
+        if cursor:
+            params["before"] = cursor
+        holder = {}
+
+        def issue(params=params, holder=holder):
+            holder["response"] = client.get(url, params)
+            return holder["response"]
+
+        yield issue, (200,)
+        cursor = holder["response"].data.get("prev")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200, help="Requests per phase")
+    parser.add_argument("--sizes", default="0,100,1000,10000", help="Comma-separated messages per room")
+    parser.add_argument("--page-size", type=int, default=50, help="?limit= for RoomMessages.get")
+    parser.add_argument("--out", help="Write JSON results here")
+    parser.add_argument("--baseline", help="Compare against an earlier JSON results file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    params = {k: v for k, v in vars(args).items() if k not in ("out", "baseline")}
+    with StubAuthService() as auth:
+        settings.AUTH_API_URL = auth.url
+        # The views' debug prints would drown the report; they still cost what they cost
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            phases = run(args, auth)
+    results = write_results(args.out, "rest", params, phases)
+    print_results(results)
+    if args.baseline:
+        compare(args.baseline, results)
+    return results
+
+
+if __name__ == "__main__":
+    main()
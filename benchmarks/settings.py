@@ -0,0 +1,41 @@
+import os
+import tempfile
+from chat_api.settings import *  # noqa: F401,F403
+
+# Self-contained benchmark setup: SQLite, the in-memory channel layer and
+# the stub auth service from benchmarks/stub_auth.py (its URL is filled in
+# at startup). Everything else, e.g. CHAT_WRITE_BEHIND, still comes from
+# the environment like in production.
+
+BENCH_DB_PATH = os.getenv("BENCH_DB_PATH", os.path.join(tempfile.gettempdir(), "chat_bench.sqlite3"))
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BENCH_DB_PATH,
+    }
+}
+
+CHANNEL_LAYERS = {
+    "default": {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        'CONFIG': {'capacity': int(os.getenv('BENCH_CHANNEL_CAPACITY', 10000))},
+    },
+}
+
+PRESENCE_REDIS_URL = None
+AUTH_PROFILE_CACHE_REDIS_URL = None
+
+SECRET_KEY = SECRET_KEY or "bench-secret-key"
+JWT_SECRET = "bench-secret"
+JWT_ALGORITHM = "HS256"
+JWT_PUBLIC_KEY = None
+
+LOGGING['root']['level'] = 'WARNING'
+LOGGING['loggers']['chat']['level'] = 'WARNING'
+
+# The load phases send faster than a client is allowed to; measure the
+# pipeline, not the limiter
+CHAT_RATE_LIMITS = {}
+CHAT_USER_RATE_LIMITS = {}
+CHAT_RATE_LIMIT_REDIS_URL = None
@@ -0,0 +1,70 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import jwt
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """
+    Minimal stand-in for the auth service.
+
+    GET api/users/profile/  -> profile of the Bearer token's user_id (signature not checked)
+    GET api/users/<id>/     -> 200 for any numeric id
+    """
+
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real service behind a proxy
+    disable_nagle_algorithm = True  # headers and body go out as separate writes
+
+    def do_GET(self):
+        self.server.calls += 1
+        path = self.path.split("?", 1)[0].strip("/")
+        parts = path.split("/")
+        if path == "api/users/profile":
+            auth = self.headers.get("Authorization", "")
+            try:
+                payload = jwt.decode(auth.replace("Bearer ", ""), options={"verify_signature": False})
+            except jwt.PyJWTError:
+                return self._reply(401, {"detail": "invalid token"})
+            user_id = payload.get("user_id") or payload.get("sub")
+            return self._reply(200, {"id": user_id, "username": f"user{user_id}", "email": f"user{user_id}@bench"})
+        if len(parts) == 3 and parts[:2] == ["api", "users"] and parts[2].isdigit():
+            return self._reply(200, {"id": int(parts[2])})
+        self._reply(404, {"detail": "not found"})
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubAuthService:
+    """Run the stub auth service on a background thread; use as a context manager"""
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.server = ThreadingHTTPServer((host, port), _Handler)
+        self.server.daemon_threads = True
+        self.server.calls = 0
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def calls(self):
+        return self.server.calls
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,259 @@
+"""
+WebSocket load and fan-out benchmark.
+
+Drives chat_api.asgi.application in-process with N clients spread over M
+rooms, on SQLite, the in-memory channel layer and a stub auth service:
+
+    python -m benchmarks.ws_bench --clients 200 --rooms 50 --out bench-results/ws.json
+    python -m benchmarks.ws_bench --clients 200 --rooms 50 --baseline bench-results/ws.json
+
+Phases: connect (JWT in the query string), fetch_profile (one auth
+round trip per client), messages (every client sends --messages chat
+messages), typing (bursts of --typing-burst typing events per client)
+and presence (--churn of the clients disconnect and reconnect, --churn-rounds
+times). CPU time is for the whole process, so it includes the database
+thread and the stub auth service.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import time
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "benchmarks.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+import jwt  # noqa: E402
+from channels.testing import WebsocketCommunicator  # noqa: E402
+from django.conf import settings  # noqa: E402
+from django.core.management import call_command  # noqa: E402
+
+from benchmarks.harness import Phase, compare, percentiles, print_results, write_results  # noqa: E402
+from benchmarks.stub_auth import StubAuthService  # noqa: E402
+
+BENCH_PREFIX = "bench:"
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 3)
+
+
+class Client:
+    """One simulated WebSocket client; a reader task records every frame it gets"""
+
+    def __init__(self, stats, index, room_id, user_id):
+        self.stats = stats
+        self.index = index
+        self.room_id = room_id
+        self.user_id = user_id
+        self.token = jwt.encode(
+            {"user_id": user_id, "exp": int(time.time()) + 3600},
+            settings.JWT_SECRET,
+            algorithm=settings.JWT_ALGORITHM,
+        )
+        self.comm = None
+        self._reader = None
+
+    async def connect(self, application):
+        self.comm = WebsocketCommunicator(application, f"/ws/chat/{self.room_id}/?token={self.token}")
+        started = time.perf_counter()
+        connected, _ = await self.comm.connect(timeout=30)
+        elapsed = time.perf_counter() - started
+        if not connected:
+            raise RuntimeError(f"client {self.index} was refused by room {self.room_id}")
+        self._reader = asyncio.ensure_future(self._read())
+        return elapsed
+
+    async def disconnect(self):
+        self._reader.cancel()
+        await asyncio.gather(self._reader, return_exceptions=True)
+        await self.comm.disconnect(timeout=30)
+
+    async def send(self, frame):
+        await self.comm.send_to(text_data=json.dumps(frame))
+
+    async def _read(self):
+        while True:
+            message = await self.comm.output_queue.get()
+            if message.get("type") != "websocket.send" or message.get("text") is None:
+                continue
+            self.stats.on_frame(json.loads(message["text"]))
+
+
+class Stats:
+    """Frame counters shared by every client, with a way to wait for an expected count"""
+
+    def __init__(self):
+        self.counts = {}
+        self.message_latencies = []
+        self._waiters = []
+
+    def on_frame(self, frame):
+        kind = frame.get("type") or ("message" if "sender_id" in frame else "unknown")
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+        content = frame.get("content")
+        if kind == "message" and isinstance(content, str) and content.startswith(BENCH_PREFIX):
+            sent_at = float(content[len(BENCH_PREFIX):].split(":", 1)[0])
+            self.message_latencies.append(time.perf_counter() - sent_at)
+        for waiter in list(self._waiters):
+            kind_wanted, target, event = waiter
+            if self.counts.get(kind_wanted, 0) >= target:
+                event.set()
+                self._waiters.remove(waiter)
+
+    async def wait_for(self, kind, target, timeout):
+        """Wait until `target` frames of `kind` have arrived in total; returns False on timeout"""
+        if self.counts.get(kind, 0) >= target:
+            return True
+        event = asyncio.Event()
+        self._waiters.append((kind, target, event))
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+def prepare_database(rooms):
+    """Migrate a fresh SQLite file and create the rooms; returns [(room_id, user_a, user_b)]"""
+    from chat.models import ChatRoom
+
+    path = settings.DATABASES["default"]["NAME"]
+    if os.path.exists(path):
+        os.remove(path)
+    call_command("migrate", verbosity=0)
+    created = ChatRoom.objects.bulk_create([
+        ChatRoom(participant_a=str(2 * i + 1), participant_b=str(2 * i + 2)) for i in range(rooms)
+    ])
+    return [(room.id, room.participant_a, room.participant_b) for room in ChatRoom.objects.order_by("id")][:len(created)]
+
+
+async def _gather_limited(coros, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(coro):
+        async with semaphore:
+            return await coro
+
+    return await asyncio.gather(*(run(coro) for coro in coros))
+
+
+async def run(args):
+    from chat import membership, presence
+    from chat.persistence import flush_pending_messages
+    from chat.receipts import flush_pending_receipts
+    from chat_api.asgi import application
+
+    membership.clear_room_cache()
+    presence.reset_store()
+    rooms = await asyncio.to_thread(prepare_database, args.rooms)
+    stats = Stats()
+    clients = []
+    for index in range(args.clients):
+        room_id, user_a, user_b = rooms[index % len(rooms)]
+        user_id = user_a if (index // len(rooms)) % 2 == 0 else user_b
+        clients.append(Client(stats, index, room_id, user_id))
+    fanout = {}
+    for client in clients:
+        fanout[client.room_id] = fanout.get(client.room_id, 0) + 1
+
+    phases = {}
+
+    with Phase("connect") as phase:
+        latencies = await _gather_limited([c.connect(application) for c in clients], args.concurrency)
+        phase.events = len(clients)
+    phase.extra["latency_ms"] = percentiles([_ms(s) for s in latencies])
+    phases["connect"] = phase.result()
+    await stats.wait_for("presence_snapshot", len(clients), args.timeout)
+
+    with Phase("fetch_profile") as phase:
+        for client in clients:
+            await client.send({"type": "fetch_profile"})
+        phase.extra["complete"] = await stats.wait_for("profile", len(clients), args.timeout)
+        phase.events = len(clients)
+    phases["fetch_profile"] = phase.result()
+
+    expected = sum(fanout[c.room_id] for c in clients) * args.messages
+    with Phase("messages") as phase:
+        for n in range(args.messages):
+            for client in clients:
+                await client.send({"type": "message", "content": f"{BENCH_PREFIX}{time.perf_counter()!r}:{client.index}:{n}"})
+        phase.extra["complete"] = await stats.wait_for("message", expected, args.timeout)
+        phase.events = stats.counts.get("message", 0)
+        await flush_pending_messages()
+    phase.extra["sent"] = args.messages * len(clients)
+    phase.extra["delivered"] = stats.counts.get("message", 0)
+    phase.extra["latency_ms"] = percentiles([_ms(s) for s in stats.message_latencies])
+    phases["messages"] = phase.result()
+
+    typing_before = stats.counts.get("typing", 0)
+    with Phase("typing") as phase:
+        for n in range(args.typing_burst):
+            for client in clients:
+                await client.send({"type": "typing", "is_typing": n % 2 == 0})
+        phase.events = args.typing_burst * len(clients)
+        # Throttled: at least one frame per room member must get through
+        phase.extra["complete"] = await stats.wait_for("typing", typing_before + len(clients), args.timeout)
+        await asyncio.sleep(args.settle)
+    phase.extra["frames_delivered"] = stats.counts.get("typing", 0) - typing_before
+    phases["typing"] = phase.result()
+
+    churners = clients[:max(1, int(len(clients) * args.churn))] if args.churn > 0 else []
+    reconnects = []
+    presence_before = stats.counts.get("presence", 0)
+    with Phase("presence") as phase:
+        for _ in range(args.churn_rounds):
+            await _gather_limited([c.disconnect() for c in churners], args.concurrency)
+            reconnects += await _gather_limited([c.connect(application) for c in churners], args.concurrency)
+        phase.events = 2 * len(churners) * args.churn_rounds
+        await asyncio.sleep(args.settle)
+    phase.extra["reconnect_latency_ms"] = percentiles([_ms(s) for s in reconnects])
+    phase.extra["presence_frames"] = stats.counts.get("presence", 0) - presence_before
+    phases["presence"] = phase.result()
+
+    await _gather_limited([c.disconnect() for c in clients], args.concurrency)
+    await flush_pending_messages()
+    await flush_pending_receipts()
+    presence.reset_store()
+    return phases
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, default=100, help="Simulated WebSocket clients")
+    parser.add_argument("--rooms", type=int, default=25, help="Rooms the clients are spread over")
+    parser.add_argument("--messages", type=int, default=5, help="Chat messages sent per client")
+    parser.add_argument("--typing-burst", type=int, default=20, help="Typing events sent per client")
+    parser.add_argument("--churn", type=float, default=0.25, help="Fraction of clients that reconnect")
+    parser.add_argument("--churn-rounds", type=int, default=3, help="Disconnect/reconnect rounds")
+    parser.add_argument("--concurrency", type=int, default=100, help="Connects in flight at once")
+    parser.add_argument("--settle", type=float, default=0.2, help="Seconds to let trailing frames arrive")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Seconds to wait for deliveries")
+    parser.add_argument("--out", help="Write JSON results here")
+    parser.add_argument("--baseline", help="Compare against an earlier JSON results file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    params = {k: v for k, v in vars(args).items() if k not in ("out", "baseline")}
+    params["write_behind"] = getattr(settings, "CHAT_WRITE_BEHIND", False)
+    with StubAuthService() as auth:
+        settings.AUTH_API_URL = auth.url
+        # The app's debug prints would drown the report; they still cost what they cost
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            phases = asyncio.run(run(args))
+        params["auth_calls"] = auth.calls
+    results = write_results(args.out, "ws", params, phases)
+    print_results(results)
+    if args.baseline:
+        compare(args.baseline, results)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -11,16 +11,177 @@
 
 # messaging_services/chat/auth_client.py
 
+import asyncio
+import atexit
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import weakref
 import httpx
+import jwt
 from django.conf import settings
 import os
 import logging
 
+from .cache import MISSING, AsyncSingleFlight, RedisTier, SingleFlight, TTLCache
+from .metrics import AUTH_REQUEST_SECONDS
+
 logger = logging.getLogger(__name__)
 
 # Enable debug for now - remove these after testing
 DEBUG_MODE = True
 
+# Process-wide clients so auth lookups reuse keep-alive connections instead
+# of paying a TCP/TLS handshake per call. The async client is bound to the
+# event loop it was created on, so keep one per loop.
+_sync_client = None
+_sync_client_lock = threading.Lock()
+_async_clients = weakref.WeakKeyDictionary()
+# Loading the CA bundle takes tens of milliseconds, so every client shares one context
+_ssl_context = None
+
+
+def _operation(request):
+    """Name an auth service call for the metrics: profile, bulk_users or verify_user"""
+    path = request.url.path.strip("/")
+    if path.endswith(getattr(settings, "AUTH_PROFILE_ENDPOINT", "api/users/profile/").strip("/")):
+        return "profile"
+    bulk = getattr(settings, "AUTH_BULK_USERS_ENDPOINT", None)
+    if bulk and path.endswith(bulk.strip("/")):
+        return "bulk_users"
+    return "verify_user"
+
+
+class _InstrumentedTransport(httpx.BaseTransport):
+    """Records every auth service call in AUTH_REQUEST_SECONDS"""
+
+    def __init__(self, inner):
+        self._inner = inner
+
+    def handle_request(self, request):
+        started, status = time.perf_counter(), "error"
+        try:
+            response = self._inner.handle_request(request)
+            status = response.status_code
+            return response
+        finally:
+            AUTH_REQUEST_SECONDS.labels(operation=_operation(request), status=status).observe(
+                time.perf_counter() - started
+            )
+
+    def close(self):
+        self._inner.close()
+
+
+class _InstrumentedAsyncTransport(httpx.AsyncBaseTransport):
+    """Async counterpart of _InstrumentedTransport"""
+
+    def __init__(self, inner):
+        self._inner = inner
+
+    async def handle_async_request(self, request):
+        started, status = time.perf_counter(), "error"
+        try:
+            response = await self._inner.handle_async_request(request)
+            status = response.status_code
+            return response
+        finally:
+            AUTH_REQUEST_SECONDS.labels(operation=_operation(request), status=status).observe(
+                time.perf_counter() - started
+            )
+
+    async def aclose(self):
+        await self._inner.aclose()
+
+
+def _get_ssl_context():
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = httpx.create_ssl_context()
+    return _ssl_context
+
+
+def _client_kwargs(asynchronous=False):
+    """Build httpx client options from settings"""
+    timeout = httpx.Timeout(
+        getattr(settings, "AUTH_HTTP_TIMEOUT", 10.0),
+        connect=getattr(settings, "AUTH_HTTP_CONNECT_TIMEOUT", 3.0),
+    )
+    limits = httpx.Limits(
+        max_connections=getattr(settings, "AUTH_HTTP_MAX_CONNECTIONS", 100),
+        max_keepalive_connections=getattr(settings, "AUTH_HTTP_MAX_KEEPALIVE", 20),
+        keepalive_expiry=getattr(settings, "AUTH_HTTP_KEEPALIVE_EXPIRY", 30.0),
+    )
+    http2 = getattr(settings, "AUTH_HTTP2", False)
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logger.warning("AUTH_HTTP2 is enabled but the 'h2' package is not installed; using HTTP/1.1")
+            http2 = False
+    if asynchronous:
+        transport = _InstrumentedAsyncTransport(
+            httpx.AsyncHTTPTransport(verify=_get_ssl_context(), limits=limits, http2=http2)
+        )
+    else:
+        transport = _InstrumentedTransport(httpx.HTTPTransport(verify=_get_ssl_context(), limits=limits, http2=http2))
+    return {"timeout": timeout, "transport": transport}
+
+
+def get_sync_client():
+    """Return the shared, pooled httpx.Client for the auth service"""
+    global _sync_client
+    if _sync_client is None or _sync_client.is_closed:
+        with _sync_client_lock:
+            if _sync_client is None or _sync_client.is_closed:
+                _sync_client = httpx.Client(**_client_kwargs())
+    return _sync_client
+
+
+def get_async_client():
+    """Return the shared, pooled httpx.AsyncClient for the running event loop"""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(**_client_kwargs(asynchronous=True))
+        _async_clients[loop] = client
+    return client
+
+
+def close_sync_client():
+    """Close the shared sync client and drop its pooled connections"""
+    global _sync_client
+    with _sync_client_lock:
+        client, _sync_client = _sync_client, None
+    if client is not None:
+        client.close()
+
+
+async def aclose_clients():
+    """Close the shared clients; called on ASGI lifespan shutdown"""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.pop(loop, None)
+    if client is not None:
+        await client.aclose()
+    close_sync_client()
+
+
+@atexit.register
+def _close_clients():
+    # Daphne never sends lifespan events, so this is what closes the pools
+    # when it stops. An async client can only be closed on its own loop,
+    # once that loop has stopped; otherwise exit drops its sockets anyway.
+    close_sync_client()
+    for loop, client in list(_async_clients.items()):
+        if client.is_closed or loop.is_closed() or loop.is_running():
+            continue
+        try:
+            loop.run_until_complete(client.aclose())
+        except Exception as e:
+            logger.warning(f"Failed to close auth client at exit: {type(e).__name__}: {str(e)}")
+    _async_clients.clear()
+
 def get_auth_url():
     """Get the auth service URL from settings"""
     url = getattr(settings, "AUTH_API_URL", "http://authservice:8080")
@@ -36,9 +197,9 @@ def get_profile_endpoint():
     return endpoint
 
 
-def fetch_profile_sync(token):
+def _request_profile_sync(token):
     """
-    Fetch user profile from auth service synchronously.
+    Fetch user profile from auth service synchronously, bypassing the cache.
     
     Args:
         token: JWT access token
@@ -66,7 +227,7 @@ def fetch_profile_sync(token):
         print("=" * 70)
     
     try:
-        response = httpx.get(url, headers=headers, timeout=10.0)
+        response = get_sync_client().get(url, headers=headers)
         
         if DEBUG_MODE:
             print(f"Response Status: {response.status_code}")
@@ -154,7 +315,9 @@ def verify_user_exists(user_id, token):
         print(f"🔍 Verifying user {user_id} at: {url}")
     
     try:
-        response = httpx.get(url, headers=headers, timeout=5.0)
+        response = get_sync_client().get(
+            url, headers=headers, timeout=getattr(settings, "AUTH_VERIFY_TIMEOUT", 5.0)
+        )
         
         if DEBUG_MODE:
             print(f"   Status: {response.status_code}")
@@ -193,8 +356,8 @@ def verify_user_exists(user_id, token):
         return False
 
 
-async def fetch_profile_async(token):
-   
+async def _request_profile_async(token):
+    """Async counterpart of _request_profile_sync, bypassing the cache"""
     if not token:
         logger.error("No token provided to fetch_profile_async")
         return None
@@ -207,23 +370,315 @@ async def fetch_profile_async(token):
     if DEBUG_MODE:
         print(f"🔍 [ASYNC] Fetching profile from: {url}")
     
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        try:
-            response = await client.get(url, headers=headers)
-            
-            if DEBUG_MODE:
-                print(f"📥 [ASYNC] Status: {response.status_code}")
+    try:
+        response = await get_async_client().get(url, headers=headers)
+        
+        if DEBUG_MODE:
+            print(f"📥 [ASYNC] Status: {response.status_code}")
+        
+        if response.status_code == 200:
+            profile = response.json()
+            logger.info(f"✓ [ASYNC] Fetched profile for user ID: {profile.get('id')}")
+            return profile
+        else:
+            logger.warning(f"[ASYNC] Auth failed with status {response.status_code}")
+            return None
             
-            if response.status_code == 200:
-                profile = response.json()
-                logger.info(f"✓ [ASYNC] Fetched profile for user ID: {profile.get('id')}")
-                return profile
-            else:
-                logger.warning(f"[ASYNC] Auth failed with status {response.status_code}")
-                return None
-                
+    except Exception as e:
+        logger.error(f"[ASYNC] Error fetching profile: {str(e)}")
+        if DEBUG_MODE:
+            print(f" [ASYNC] Error: {str(e)}")
+        return None
+
+
+# Profile cache: token hash -> profile (or None for a failed lookup).
+_profile_cache = TTLCache(maxsize=getattr(settings, "AUTH_PROFILE_CACHE_SIZE", 10000))
+_profile_flight = SingleFlight()
+_profile_flight_async = AsyncSingleFlight()
+_profile_redis = None
+
+
+def _token_key(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def _get_profile_redis():
+    """Return the shared Redis tier if AUTH_PROFILE_CACHE_REDIS_URL is set"""
+    global _profile_redis
+    url = getattr(settings, "AUTH_PROFILE_CACHE_REDIS_URL", None)
+    if not url:
+        return None
+    if _profile_redis is None or _profile_redis.url != url:
+        _profile_redis = RedisTier(url, prefix="chat:profile")
+    return _profile_redis
+
+
+def _profile_ttl(token, profile):
+    """
+    How long a lookup result may be cached.
+
+    Successful profiles live for AUTH_PROFILE_CACHE_TTL but never past the
+    token's own exp claim; failures are cached for AUTH_PROFILE_NEGATIVE_TTL.
+    """
+    if profile is None:
+        return getattr(settings, "AUTH_PROFILE_NEGATIVE_TTL", 5.0)
+    ttl = getattr(settings, "AUTH_PROFILE_CACHE_TTL", 60.0)
+    try:
+        exp = jwt.decode(token, options={"verify_signature": False}).get("exp")
+    except jwt.PyJWTError:
+        exp = None
+    if exp:
+        ttl = min(ttl, float(exp) - time.time())
+    return ttl
+
+
+def clear_profile_cache():
+    """Drop every cached profile in this process"""
+    _profile_cache.clear()
+
+
+def fetch_profile_sync(token):
+    """
+    Fetch user profile from auth service synchronously, via the profile cache.
+
+    Args:
+        token: JWT access token
+
+    Returns:
+        dict: User profile data with keys: id, username, email
+        None: If authentication fails or user not found
+    """
+    if not token:
+        logger.error("No token provided to fetch_profile_sync")
+        return None
+
+    key = _token_key(token)
+    profile = _profile_cache.get(key)
+    if profile is not MISSING:
+        return profile
+
+    def load():
+        redis_tier = _get_profile_redis()
+        if redis_tier is not None:
+            cached = redis_tier.get(key)
+            if cached is not MISSING:
+                _profile_cache.set(key, cached, _profile_ttl(token, cached))
+                return cached
+        result = _request_profile_sync(token)
+        _remember_existing_user(result)
+        ttl = _profile_ttl(token, result)
+        _profile_cache.set(key, result, ttl)
+        if redis_tier is not None:
+            redis_tier.set(key, result, ttl)
+        return result
+
+    return _profile_flight.do(key, load)
+
+
+async def fetch_profile_async(token):
+    """Async counterpart of fetch_profile_sync, sharing the same cache"""
+    if not token:
+        logger.error("No token provided to fetch_profile_async")
+        return None
+
+    key = _token_key(token)
+    profile = _profile_cache.get(key)
+    if profile is not MISSING:
+        return profile
+
+    async def load():
+        redis_tier = _get_profile_redis()
+        if redis_tier is not None:
+            cached = await redis_tier.aget(key)
+            if cached is not MISSING:
+                _profile_cache.set(key, cached, _profile_ttl(token, cached))
+                return cached
+        result = await _request_profile_async(token)
+        _remember_existing_user(result)
+        ttl = _profile_ttl(token, result)
+        _profile_cache.set(key, result, ttl)
+        if redis_tier is not None:
+            await redis_tier.aset(key, result, ttl)
+        return result
+
+    return await _profile_flight_async.do(key, load)
+
+
+# Positive cache of user IDs the auth service has confirmed exist. Users are
+# never cached as missing, so a freshly registered user is never blocked.
+_known_users = TTLCache(maxsize=getattr(settings, "AUTH_USER_EXISTS_CACHE_SIZE", 50000))
+_verify_executor = None
+_verify_executor_lock = threading.Lock()
+
+
+def _remember_existing_user(profile):
+    user_id = profile and (profile.get("id") or profile.get("user_id"))
+    if user_id:
+        _known_users.set(str(user_id), True, getattr(settings, "AUTH_USER_EXISTS_CACHE_TTL", 300.0))
+
+
+def _get_verify_executor():
+    global _verify_executor
+    if _verify_executor is None:
+        with _verify_executor_lock:
+            if _verify_executor is None:
+                _verify_executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, "AUTH_VERIFY_CONCURRENCY", 8),
+                    thread_name_prefix="auth-verify",
+                )
+    return _verify_executor
+
+
+def _user_url(user_id):
+    return f"{get_auth_url().rstrip('/')}/api/users/{user_id}/"
+
+
+def _bulk_request(user_ids, token):
+    """Return (url, params, headers) for the bulk lookup endpoint, or None if not configured"""
+    endpoint = getattr(settings, "AUTH_BULK_USERS_ENDPOINT", None)
+    if not endpoint:
+        return None
+    url = f"{get_auth_url().rstrip('/')}/{endpoint.lstrip('/')}"
+    return url, {"ids": ",".join(user_ids)}, {"Authorization": f"Bearer {token}"}
+
+
+def _user_status(user_id, response):
+    """
+    Classify a single-user lookup.
+
+    Returns True if the user exists, False if the auth service says it
+    doesn't (404), None if the answer is unknown (other status codes).
+    """
+    if response.status_code == 200:
+        return True
+    if response.status_code == 404:
+        logger.error(f"User {user_id} not found in auth service")
+        return False
+    logger.warning(f"Auth service returned status {response.status_code} for user {user_id}")
+    return None
+
+
+def _bulk_statuses(user_ids, response):
+    """Classify a bulk lookup; any ID missing from a 200 response does not exist"""
+    if response.status_code != 200:
+        logger.warning(f"Bulk user lookup returned status {response.status_code}")
+        return {user_id: None for user_id in user_ids}
+    try:
+        body = response.json()
+    except ValueError as e:
+        logger.error(f"Failed to parse bulk user lookup response: {e}")
+        return {user_id: None for user_id in user_ids}
+    users = body.get("results", []) if isinstance(body, dict) else body
+    found = {str(u.get("id") or u.get("user_id")) for u in users if isinstance(u, dict)}
+    return {user_id: user_id in found for user_id in user_ids}
+
+
+def _check_user_sync(user_id, token):
+    try:
+        response = get_sync_client().get(
+            _user_url(user_id),
+            headers={"Authorization": f"Bearer {token}"},
+            timeout=getattr(settings, "AUTH_VERIFY_TIMEOUT", 5.0),
+        )
+        return _user_status(user_id, response)
+    except Exception as e:
+        logger.error(f"Error verifying user {user_id}: {str(e)}")
+        return None
+
+
+async def _check_user_async(user_id, token):
+    try:
+        response = await get_async_client().get(
+            _user_url(user_id),
+            headers={"Authorization": f"Bearer {token}"},
+            timeout=getattr(settings, "AUTH_VERIFY_TIMEOUT", 5.0),
+        )
+        return _user_status(user_id, response)
+    except Exception as e:
+        logger.error(f"Error verifying user {user_id}: {str(e)}")
+        return None
+
+
+def _pending_user_ids(user_ids):
+    pending = []
+    for user_id in map(str, user_ids):
+        if user_id not in pending and user_id not in _known_users:
+            pending.append(user_id)
+    return pending
+
+
+def _record_statuses(statuses):
+    """Cache confirmed users and return False only if some user is definitely missing"""
+    ttl = getattr(settings, "AUTH_USER_EXISTS_CACHE_TTL", 300.0)
+    for user_id, exists in statuses.items():
+        if exists:
+            _known_users.set(user_id, True, ttl)
+    # Unknown answers (timeouts, 5xx) don't block room creation
+    return not any(exists is False for exists in statuses.values())
+
+
+def verify_users_exist(user_ids, token):
+    """
+    Verify a batch of users exist in auth service.
+
+    Already-confirmed users are answered from the positive cache; the rest
+    are looked up concurrently, or in one call to AUTH_BULK_USERS_ENDPOINT
+    when it is configured.
+
+    Args:
+        user_ids: User IDs to verify
+        token: JWT access token
+
+    Returns:
+        bool: False if any user is definitely missing, True otherwise
+    """
+    pending = _pending_user_ids(user_ids)
+    if not pending:
+        return True
+    bulk = _bulk_request(pending, token)
+    if bulk:
+        url, params, headers = bulk
+        try:
+            response = get_sync_client().get(
+                url, params=params, headers=headers,
+                timeout=getattr(settings, "AUTH_VERIFY_TIMEOUT", 5.0),
+            )
+            statuses = _bulk_statuses(pending, response)
         except Exception as e:
-            logger.error(f"[ASYNC] Error fetching profile: {str(e)}")
-            if DEBUG_MODE:
-                print(f" [ASYNC] Error: {str(e)}")
-            return None
\ No newline at end of file
+            logger.error(f"Error in bulk user lookup: {str(e)}")
+            statuses = {user_id: None for user_id in pending}
+    elif len(pending) == 1:
+        statuses = {pending[0]: _check_user_sync(pending[0], token)}
+    else:
+        executor = _get_verify_executor()
+        results = executor.map(lambda user_id: _check_user_sync(user_id, token), pending)
+        statuses = dict(zip(pending, results))
+    return _record_statuses(statuses)
+
+
+async def averify_users_exist(user_ids, token):
+    """Async counterpart of verify_users_exist, sharing the same cache"""
+    pending = _pending_user_ids(user_ids)
+    if not pending:
+        return True
+    bulk = _bulk_request(pending, token)
+    if bulk:
+        url, params, headers = bulk
+        try:
+            response = await get_async_client().get(
+                url, params=params, headers=headers,
+                timeout=getattr(settings, "AUTH_VERIFY_TIMEOUT", 5.0),
+            )
+            statuses = _bulk_statuses(pending, response)
+        except Exception as e:
+            logger.error(f"Error in bulk user lookup: {str(e)}")
+            statuses = {user_id: None for user_id in pending}
+    else:
+        results = await asyncio.gather(*[_check_user_async(user_id, token) for user_id in pending])
+        statuses = dict(zip(pending, results))
+    return _record_statuses(statuses)
+
+
+def clear_known_users():
+    """Drop every cached user-exists answer in this process"""
+    _known_users.clear()
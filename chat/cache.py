@@ -0,0 +1,190 @@
+import asyncio
+import functools
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Returned by TTLCache.get on a miss, so None can be cached as a value
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Thread-safe in-process LRU cache with a per-entry time to live.
+
+    Safe to share between the event loop and sync worker threads; every
+    operation is O(1) under a single lock.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires_at = item
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key) is not MISSING
+
+    def __len__(self):
+        return len(self._data)
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Collapse concurrent sync calls for the same key into one execution"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.event.wait()
+        else:
+            try:
+                call.result = func()
+            except Exception as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    self._calls.pop(key, None)
+                call.event.set()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+
+class AsyncSingleFlight:
+    """Collapse concurrent coroutine calls for the same key into one execution"""
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, func):
+        # Tasks belong to one loop, so in-flight calls are shared per loop
+        loop = asyncio.get_running_loop()
+        slot = (id(loop), key)
+        task = self._calls.get(slot)
+        if task is None:
+            # Run func as its own task rather than in the first caller, so
+            # cancelling that caller (e.g. wait_for timing out) doesn't cancel
+            # it for everyone else waiting on the same key
+            task = self._calls[slot] = loop.create_task(func())
+            task.add_done_callback(functools.partial(self._finished, slot))
+        return await asyncio.shield(task)
+
+    def _finished(self, slot, task):
+        if self._calls.get(slot) is task:
+            del self._calls[slot]
+        if not task.cancelled():
+            # Mark retrieved, in case every caller was cancelled before it finished
+            task.exception()
+
+
+class RedisTier:
+    """
+    Optional shared cache tier in Redis so several workers share entries.
+
+    Values are stored as JSON. Any Redis error is logged and treated as a
+    miss so the cache can never take the service down.
+    """
+
+    def __init__(self, url, prefix):
+        self.url = url
+        self.prefix = prefix
+        self._sync = None
+        self._async = {}
+
+    def _key(self, key):
+        return f"{self.prefix}:{key}"
+
+    def _sync_client(self):
+        if self._sync is None:
+            import redis
+            self._sync = redis.Redis.from_url(self.url)
+        return self._sync
+
+    def _async_client(self):
+        loop = asyncio.get_running_loop()
+        client = self._async.get(id(loop))
+        if client is None:
+            import redis.asyncio
+            client = self._async[id(loop)] = redis.asyncio.Redis.from_url(self.url)
+        return client
+
+    def get(self, key):
+        try:
+            raw = self._sync_client().get(self._key(key))
+        except Exception as e:
+            logger.warning(f"Redis cache get failed: {type(e).__name__}: {str(e)}")
+            return MISSING
+        return MISSING if raw is None else json.loads(raw)
+
+    def set(self, key, value, ttl):
+        if ttl <= 0:
+            return
+        try:
+            self._sync_client().set(self._key(key), json.dumps(value), px=int(ttl * 1000))
+        except Exception as e:
+            logger.warning(f"Redis cache set failed: {type(e).__name__}: {str(e)}")
+
+    async def aget(self, key):
+        try:
+            raw = await self._async_client().get(self._key(key))
+        except Exception as e:
+            logger.warning(f"Redis cache get failed: {type(e).__name__}: {str(e)}")
+            return MISSING
+        return MISSING if raw is None else json.loads(raw)
+
+    async def aset(self, key, value, ttl):
+        if ttl <= 0:
+            return
+        try:
+            await self._async_client().set(self._key(key), json.dumps(value), px=int(ttl * 1000))
+        except Exception as e:
+            logger.warning(f"Redis cache set failed: {type(e).__name__}: {str(e)}")
@@ -0,0 +1,94 @@
+import json
+import msgpack
+
+try:
+    import orjson
+except ImportError:  # optional; the stdlib encoder is used when it's missing
+    orjson = None
+
+MSGPACK_SUBPROTOCOL = "msgpack"
+
+
+def dumps_json(content):
+    """Encode to a JSON str, with orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(content).decode()
+    return json.dumps(content)
+
+
+def encode_event(event_type, frame, collapse_key=None):
+    """
+    Build a channel-layer group event carrying a pre-encoded client frame.
+
+    The frame is encoded once, as JSON text and as MessagePack, by the
+    sender; every recipient's handler forwards the bytes as-is through
+    SubprotocolMixin.send_encoded instead of re-encoding per socket.
+
+    Events with a collapse_key are state updates (typing, presence, read
+    position): a slow socket only needs the latest one per key, see
+    chat.outbound.
+    """
+    event = {
+        "type": event_type,
+        "text": dumps_json(frame),
+        "bytes": msgpack.packb(frame, use_bin_type=True),
+    }
+    if collapse_key is not None:
+        event["collapse_key"] = collapse_key
+    return event
+
+
+class SubprotocolMixin:
+    """
+    Lets a client negotiate the "msgpack" WebSocket subprotocol.
+
+    Mix in before AsyncJsonWebsocketConsumer. With msgpack negotiated every
+    outbound frame is a MessagePack binary frame; otherwise frames stay JSON
+    text. Inbound frames are decoded by their type, so either encoding is
+    accepted whatever was negotiated.
+    """
+
+    binary = False
+
+    async def accept(self, subprotocol=None, headers=None):
+        if subprotocol is None and MSGPACK_SUBPROTOCOL in self.scope.get("subprotocols", []):
+            subprotocol = MSGPACK_SUBPROTOCOL
+        self.binary = subprotocol == MSGPACK_SUBPROTOCOL
+        await super().accept(subprotocol=subprotocol, headers=headers)
+
+    def decode_frame(self, text_data=None, bytes_data=None):
+        """
+        Decode an inbound frame to a dict.
+
+        Returns:
+            dict: Decoded event, or None for an empty or undecodable frame
+        """
+        try:
+            if bytes_data is not None:
+                data = msgpack.unpackb(bytes_data, raw=False)
+            elif text_data is not None:
+                data = json.loads(text_data)
+            else:
+                return None
+        except (ValueError, msgpack.exceptions.UnpackException):
+            return None
+        return data if isinstance(data, dict) else None
+
+    async def send_json(self, content, close=False):
+        if self.binary:
+            await self.send(bytes_data=msgpack.packb(content, use_bin_type=True), close=close)
+        else:
+            # Not super().send_json(): channels' version calls its own base send
+            # directly, skipping overrides of send() such as the outbound queue
+            await self.send(text_data=await self.encode_json(content), close=close)
+
+    async def send_encoded(self, event):
+        """Forward a frame built by encode_event in this socket's encoding"""
+        if self.binary:
+            await self.send(bytes_data=event["bytes"])
+        else:
+            await self.send(text_data=event["text"])
+
+    @classmethod
+    async def encode_json(cls, content):
+        return dumps_json(content)
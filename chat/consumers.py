@@ -1,22 +1,71 @@
-import json
+import asyncio
+import uuid
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
-from channels.db import database_sync_to_async
 from django.conf import settings
-from .models import ChatRoom, Message
+from django.utils import timezone
+from .models import Message
+from . import metrics, presence, repository
 from .auth_client import fetch_profile_async
+from .codecs import SubprotocolMixin, encode_event
+from .membership import aget_participants
+from .outbound import OutboundQueueMixin
+from .persistence import get_writer, write_behind_enabled
+from .profiling import ProfiledConsumerMixin
+from .ratelimit import ConnectionRateLimiter
+from .receipts import get_coalescer
+from .routers import anote_write
+from .typing_indicator import TypingThrottle
+
+# Inbound frame types, as the "event" label of the receive metrics
+_EVENT_TYPES = {"message", "typing", "read", "fetch_profile"}
+
+async def _allow_frame(consumer, limiter, event):
+    """
+    Apply the connection's rate limits to one inbound frame.
+
+    The first refused frame of a run gets a "rate_limited" error frame
+    with the seconds to wait; the rest of the run is dropped silently.
+
+    Returns:
+        bool: True if the frame may be handled
+    """
+    limited = await limiter.check(event) if limiter is not None else None
+    if limited is None:
+        return True
+    if limited.notify:
+        await consumer.send_json({
+            "type": "error",
+            "detail": "rate_limited",
+            "event": event,
+            "retry_after": round(min(limited.retry_after, 3600.0), 3),
+        })
+    return False
+
+
+class ChatConsumer(ProfiledConsumerMixin, OutboundQueueMixin, SubprotocolMixin, AsyncJsonWebsocketConsumer):
+    profile_name = "chat"
 
-class ChatConsumer(AsyncJsonWebsocketConsumer):
     async def connect(self):
+        with metrics.WS_HANDLER_SECONDS.labels(consumer="chat", handler="connect", event="").time():
+            await self._connect()
+
+    async def _connect(self):
         self.room_id = self.scope["url_route"]["kwargs"]["room_id"]
         self.room_group = f"chat_{self.room_id}"
         
         self.user_id= None
+        self._ack_tasks = set()
+        self._typing = None
+        self._joined = False
+        self._limiter = None
         
         auth_user = self.scope.get("auth_user")
         if not auth_user:
             await self.close()
             return
         self.user_id = str(auth_user["user_id"])
+        self._limiter = ConnectionRateLimiter(self.user_id)
         # verify membership
         allowed = await self._user_in_room(self.room_id, self.user_id)
         if not allowed:
@@ -25,52 +74,92 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         # Join room group
         await self.channel_layer.group_add(self.room_group, self.channel_name)
         await self.accept()
+        metrics.WS_CONNECTIONS.labels(consumer="chat").inc()
+        self._typing = TypingThrottle(
+            self._broadcast_typing,
+            interval=getattr(settings, "CHAT_TYPING_INTERVAL", 1.0),
+            idle_timeout=getattr(settings, "CHAT_TYPING_IDLE_TIMEOUT", 5.0),
+        )
+        self._joined = True
 
-        # announce presence in room (others can show online)
-        await self.channel_layer.group_send(self.room_group, {
-            "type":"presence.update",
-            "user_id": self.user_id,
-            "status": "online",
+        # announce presence in room (others can show online); only the user's
+        # first connection is broadcast, and the joiner gets everyone's state at once
+        await presence.connect(self.room_group, self.user_id)
+        participants = await aget_participants(self.room_id) or ()
+        await self.send_json({
+            "type": "presence_snapshot",
+            "users": await presence.snapshot(self.room_group, list(participants)),
         })
 
+        # resume: replay what the client missed before live traffic. Group
+        # events received meanwhile are queued until connect returns, so the
+        # client may see a message twice (dedupe by seq) but doesn't miss one.
+        # With write-behind, this worker's pending messages are committed
+        # first; ones still queued in another worker's writer can be missed,
+        # so the guarantee only holds across workers with write-behind off.
+        last_seq = self._requested_last_seq()
+        if last_seq is not None:
+            if write_behind_enabled():
+                await get_writer().flush()
+            missed, truncated = await self._messages_after(last_seq)
+            await self.send_json({
+                "type": "resume",
+                "messages": [self._message_payload(msg) for msg in missed],
+                "truncated": truncated,
+            })
+
     async def disconnect(self, code):
         # leave
+        if self._ack_tasks:
+            # Persist this socket's queued messages now rather than relying on
+            # lifespan shutdown, and let their acks reach the room
+            await get_writer().flush()
+            await asyncio.gather(*self._ack_tasks, return_exceptions=True)
+        if self._typing is not None:
+            await self._typing.close()
         await self.channel_layer.group_discard(self.room_group, self.channel_name)
-        if self.user_id:
-            await self.channel_layer.group_send(self.room_group,{
-                'type':"presence.update",
-                'user_id':self.user_id,
-                'status':'offline',
-            })
+        if self._joined:
+            metrics.WS_CONNECTIONS.labels(consumer="chat").dec()
+            await presence.disconnect(self.room_group, self.user_id)
 
     async def receive(self, text_data=None, bytes_data=None):
-        if text_data is None:
+        if text_data is None and bytes_data is None:
+            return
+        data = self.decode_frame(text_data, bytes_data)
+        typ = data.get("type") if data is not None else None
+        event = typ if typ in _EVENT_TYPES else "unknown"
+        if not await _allow_frame(self, self._limiter, event):
+            return
+        if data is None:
+            await self.send_json({"type":"error","detail":"invalid frame"})
             return
-        data = json.loads(text_data)
-        typ = data.get("type")
+        with metrics.WS_HANDLER_SECONDS.labels(consumer="chat", handler="receive", event=event).time():
+            await self._receive(typ, data)
+
+    async def _receive(self, typ, data):
         if typ == "message":
             content = data.get("content", "").strip()
             if not content:
                 return
-            msg = await self._create_message(self.room_id, self.user_id, content)
-            payload = {
-                "type":"chat.message",
-                "message": {
-                    "id": msg.id,
-                    "room": msg.room_id,
-                    "sender_id": msg.sender_id,
-                    "content": msg.content,
-                    "timestamp": msg.timestamp.isoformat(),
-                }
-            }
-            await self.channel_layer.group_send(self.room_group, payload)
+            # The sender's next history reads go to the primary until replicas catch up
+            await anote_write(self.user_id)
+            if write_behind_enabled():
+                await self._enqueue_message(content)
+                return
+            msg = await repository.acreate_message(self.room_id, self.user_id, content)
+            payload = encode_event("chat.message", self._message_payload(msg))
+            await metrics.timed_group_send(self.channel_layer, self.room_group, payload)
         elif typ == "typing":
-            is_typing = bool(data.get("is_typing"))
-            await self.channel_layer.group_send(self.room_group, {
-                "type": "typing.event",
-                "user_id": self.user_id,
-                "is_typing": is_typing,
-            })
+            if self._typing is not None:
+                await self._typing.update(bool(data.get("is_typing")))
+        elif typ == "read":
+            try:
+                up_to_id = int(data.get("message_id"))
+            except (TypeError, ValueError):
+                await self.send_json({"type":"error","detail":"message_id must be an integer"})
+                return
+            await anote_write(self.user_id)
+            get_coalescer().submit(self.room_group, self.room_id, self.user_id, up_to_id)
         elif typ == "fetch_profile":
             # optional: return profile for this user from Auth service
             token = self.scope.get("auth_user", {}).get("token")
@@ -82,67 +171,143 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
             # unknown type -> ignore or send error
             await self.send_json({"type":"error","detail":"unknown type"})
 
-    # group handlers
+    # group handlers; events are pre-encoded by encode_event, so just forward them.
+    # send_encoded only queues the frame (OutboundQueueMixin), so a slow socket can't stall these
     async def chat_message(self, event):
-        await self.send_json(event["message"])
+        await self.send_encoded(event)
+
+    async def chat_ack(self, event):
+        await self.send_encoded(event)
 
     async def typing_event(self, event):
-        await self.send_json({
-            "type": "typing",
-            "user_id": event["user_id"],
-            "is_typing": event["is_typing"],
-        })
+        await self.send_encoded(event)
 
     async def presence_update(self, event):
-        await self.send_json({
-            "type": "presence",
-            "user_id": event.get("user_id"),
-            "status": event.get("status"),
-        })
+        await self.send_encoded(event)
+
+    async def read_receipt(self, event):
+        await self.send_encoded(event)
 
     # helpers
-    @database_sync_to_async
-    def _user_in_room(self, room_id, user_id):
+    def _message_payload(self, msg, uid=None):
+        payload = {
+            "id": msg.id,
+            "room": msg.room_id,
+            "sender_id": msg.sender_id,
+            "content": msg.content,
+            "timestamp": msg.timestamp.isoformat(),
+            "seq": msg.seq,
+        }
+        if uid:
+            payload["uid"] = uid
+        return payload
+
+    async def _broadcast_typing(self, is_typing):
+        await metrics.timed_group_send(self.channel_layer, self.room_group, encode_event("typing.event", {
+            "type": "typing",
+            "user_id": self.user_id,
+            "is_typing": is_typing,
+        }, collapse_key=f"typing:{self.user_id}"))
+
+    async def _enqueue_message(self, content):
+        """
+        Write-behind path: broadcast now, persist with the next batch.
+
+        The database id and seq don't exist until the batch is flushed, so
+        the broadcast carries a server-assigned uid (and seq None), with no
+        DB hop before it. Once the batch is committed the whole room gets an
+        "ack" mapping that uid to the saved id and seq, which is what
+        clients track last_seq and mark messages read with.
+        """
+        msg = Message(room_id=int(self.room_id), sender_id=self.user_id,
+                      content=content, timestamp=timezone.now())
+        uid = uuid.uuid4().hex
+        saved = get_writer().submit(msg)
+        await metrics.timed_group_send(
+            self.channel_layer, self.room_group, encode_event("chat.message", self._message_payload(msg, uid=uid))
+        )
+        task = asyncio.ensure_future(self._ack_when_saved(uid, saved))
+        self._ack_tasks.add(task)
+        task.add_done_callback(self._ack_tasks.discard)
+
+    async def _ack_when_saved(self, uid, saved):
+        try:
+            msg = await saved
+        except Exception:
+            await self.send_json({"type": "error", "detail": "message not saved", "uid": uid})
+            return
+        await metrics.timed_group_send(self.channel_layer, self.room_group, encode_event("chat.ack", {
+            "type": "ack",
+            "uid": uid,
+            "id": msg.id,
+            "seq": msg.seq,
+            "timestamp": msg.timestamp.isoformat(),
+        }))
+
+    async def _user_in_room(self, room_id, user_id):
+        participants = await aget_participants(room_id)
+        return participants is not None and user_id in participants
+
+    def _requested_last_seq(self):
+        qs = parse_qs(self.scope.get("query_string", b"").decode())
         try:
-            room = ChatRoom.objects.get(id=room_id)
-            return user_id in (room.participant_a, room.participant_b)
-        except ChatRoom.DoesNotExist:
-            return False
+            return int(qs["last_seq"][0])
+        except (KeyError, ValueError):
+            return None
 
-    @database_sync_to_async
-    def _create_message(self, room_id, sender_id, content):
-        room = ChatRoom.objects.get(id=room_id)
-        return Message.objects.create(room=room, sender_id=sender_id, content=content)
+    async def _messages_after(self, last_seq):
+        """Range scan on the (room, seq) index, capped at CHAT_RESUME_MAX_MESSAGES"""
+        limit = getattr(settings, "CHAT_RESUME_MAX_MESSAGES", 500)
+        rows = [msg async for msg in repository.aiter_messages_after(self.room_id, last_seq, limit=limit + 1)]
+        # truncated: the client should fall back to RoomMessages for the rest
+        return rows[:limit], len(rows) > limit
 
-class PresenceConsumer(AsyncJsonWebsocketConsumer):
+class PresenceConsumer(ProfiledConsumerMixin, OutboundQueueMixin, SubprotocolMixin, AsyncJsonWebsocketConsumer):
     """
     Optional consumer clients can subscribe to global presence channel.
     Send/receive presence updates here.
     """
+    profile_name = "presence"
+
     async def connect(self):
-        await self.channel_layer.group_add("presence_global", self.channel_name)
-        await self.accept()
+        auth_user = self.scope.get("auth_user") or {}
+        self.user_id = str(auth_user["user_id"]) if auth_user.get("user_id") else None
+        self._announced = False
+        self._limiter = ConnectionRateLimiter(self.user_id)
+        with metrics.WS_HANDLER_SECONDS.labels(consumer="presence", handler="connect", event="").time():
+            await self.channel_layer.group_add("presence_global", self.channel_name)
+            await self.accept()
+        self._counted = True
+        metrics.WS_CONNECTIONS.labels(consumer="presence").inc()
 
     async def disconnect(self, code):
+        if getattr(self, "_counted", False):
+            metrics.WS_CONNECTIONS.labels(consumer="presence").dec()
+        if getattr(self, "_announced", False):
+            await presence.clear_announcement(self.user_id)
         await self.channel_layer.group_discard("presence_global", self.channel_name)
 
     async def receive(self, text_data=None, bytes_data=None):
         # this is optional: allow client to announce presence changes
-        data = json.loads(text_data or "{}")
+        data = self.decode_frame(text_data, bytes_data) or {}
         action = data.get("action")
+        event = "status" if action == "status" else "unknown"
+        if not await _allow_frame(self, self._limiter, event):
+            return
+        with metrics.WS_HANDLER_SECONDS.labels(consumer="presence", handler="receive", event=event).time():
+            await self._receive(action, data)
+
+    async def _receive(self, action, data):
         if action == "status":
-            user_id = data.get("user_id")
+            user_id = str(data.get("user_id") or self.user_id or "")
             status = data.get("status")
             if user_id and status:
-                await self.channel_layer.group_send("presence_global", {
-                    "type": "presence.broadcast",
-                    "user_id": user_id,
-                    "status": status,
-                })
+                if user_id != self.user_id:
+                    await self.send_json({"type":"error","detail":"can only announce your own status"})
+                    return
+                # only real state changes reach the global group
+                await presence.announce(user_id, status)
+                self._announced = True
 
     async def presence_broadcast(self, event):
-        await self.send_json({
-            "type": "presence_global",
-            "user_id": event.get("user_id"),
-            "status": event.get("status"),
-        })
+        await self.send_encoded(event)
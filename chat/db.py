@@ -0,0 +1,69 @@
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import connections
+from . import metrics
+
+# Database work from async code runs on this pool instead of asgiref's
+# single thread-sensitive thread, which every database_sync_to_async call
+# (and every Django async ORM call: aget, acreate, async for) shares, so
+# one slow query would hold up every other. Each hop takes a connection
+# from the psycopg pool with DB_POOL, or opens its own without it.
+
+_executor = None
+_lock = threading.Lock()
+
+
+def pool_size():
+    """Threads in the DB pool; SQLite allows one writer at a time, so it gets one"""
+    if connections["default"].vendor == "sqlite":
+        return 1
+    return max(1, getattr(settings, "CHAT_DB_THREADS", 10))
+
+
+def get_executor():
+    """Return this process's DB thread pool, creating it on first use"""
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=pool_size(), thread_name_prefix="chat-db")
+    return _executor
+
+
+async def shutdown_executor():
+    """Stop the pool, letting queued work finish; registered as a lifespan shutdown hook"""
+    global _executor
+    with _lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=False)
+
+
+def db_sync_to_async(operation):
+    """
+    database_sync_to_async on the pool above, recording DB and
+    thread-pool wait time in chat.metrics.
+
+    The wait is the time between the call on the event loop and the start
+    of the work on a pool thread, i.e. how backed up the pool is.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            submitted = time.perf_counter()
+
+            def run():
+                started = time.perf_counter()
+                metrics.THREADPOOL_WAIT_SECONDS.labels(operation=operation).observe(started - submitted)
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    metrics.DB_SECONDS.labels(operation=operation).observe(time.perf_counter() - started)
+
+            return await database_sync_to_async(run, thread_sensitive=False, executor=get_executor())()
+        return wrapper
+    return decorator
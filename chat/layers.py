@@ -0,0 +1,214 @@
+import asyncio
+import logging
+import time
+import uuid
+from collections import defaultdict
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+_GROUP_KEY = "__hybrid_group__"
+_ORIGIN_KEY = "__hybrid_origin__"
+
+# Prefix of the per-process channels on the remote layer; matched by the
+# channel_capacity pattern that process_channel_capacity adds
+PROCESS_CHANNEL_PREFIX = "hybrid-process"
+
+
+class HybridChannelLayer(BaseChannelLayer):
+    """
+    Channel layer that fans out to local consumers in memory.
+
+    Every consumer channel lives in this process. group_send delivers to
+    the group's local members straight from memory, then publishes the
+    event once to the remote layer (Redis in production) addressed to the
+    group. Each process subscribes a single "process channel" to the
+    remote groups it has local members in, so a remote event costs one
+    Redis message per process rather than one per member. A process drops
+    its own events when they come back through the remote layer.
+
+    With no remote configured the layer is purely in-memory, which suits
+    single-node deployments.
+
+    Limitation: consumer channels are process-local, so a direct send() to
+    one only works from the same process. This app only talks to consumers
+    through groups.
+
+    Limit: every event from other processes, for every room, queues on the
+    one process channel. Once process_channel_capacity events are waiting
+    in Redis (the pump fell behind), the remote layer drops further group
+    events for this process, whatever room they are for; size it for the
+    peak cross-process event rate times the pump's worst-case stall.
+
+    CONFIG:
+        remote: {"BACKEND": ..., "CONFIG": {...}} for the shared layer, an
+            already built layer instance, or None for in-memory only
+        process_channel_capacity: capacity of the process channel on the
+            remote layer (only applied when remote is given as a config)
+        expiry, capacity, channel_capacity: as for other channel layers
+    """
+
+    extensions = ["groups", "flush"]
+
+    def __init__(self, remote=None, expiry=60, capacity=100, channel_capacity=None,
+                 process_channel_capacity=10000, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.channel_capacity = self.compile_capacities(self.channel_capacity)
+        self.remote = self._build_remote(remote, process_channel_capacity)
+        self.origin = uuid.uuid4().hex
+        self._queues = {}
+        self._groups = defaultdict(set)
+        self._process_channel = None
+        self._pump = None
+        self._pump_lock = None
+        self._loop = None
+        self.stats = {"local_deliveries": 0, "remote_publishes": 0, "remote_deliveries": 0, "echoes_dropped": 0}
+
+    @staticmethod
+    def _build_remote(remote, process_channel_capacity):
+        if remote is None or isinstance(remote, BaseChannelLayer):
+            return remote
+        config = dict(remote.get("CONFIG", {}))
+        config["channel_capacity"] = {
+            **(config.get("channel_capacity") or {}),
+            f"{PROCESS_CHANNEL_PREFIX}*": process_channel_capacity,
+        }
+        return import_string(remote["BACKEND"])(**config)
+
+    # Channel layer API
+
+    async def new_channel(self, prefix="specific."):
+        channel = f"{prefix}hybrid!{uuid.uuid4().hex}"
+        self._queue(channel)
+        return channel
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+        queue = self._queues.get(channel)
+        if queue is None and self.remote is not None:
+            await self.remote.send(channel, message)
+            return
+        self._put(channel, queue or self._queue(channel), message)
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        queue = self._queue(channel)
+        try:
+            while True:
+                expires_at, message = await queue.get()
+                if expires_at >= time.time():
+                    return message
+        except asyncio.CancelledError:
+            # The consumer is shutting down; forget the channel and its groups
+            self._forget(channel)
+            raise
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        self._groups[group].add(channel)
+        if self.remote is not None:
+            await self._ensure_pump()
+            # Also refreshes the membership's group_expiry on every join
+            await self.remote.group_add(group, self._process_channel)
+
+    async def group_discard(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        members = self._groups.get(group)
+        if members is None:
+            return
+        members.discard(channel)
+        if not members:
+            del self._groups[group]
+            if self.remote is not None and self._process_channel is not None:
+                await self.remote.group_discard(group, self._process_channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_group_name(group)
+        self._deliver_local(group, message)
+        if self.remote is not None:
+            self.stats["remote_publishes"] += 1
+            await self.remote.group_send(group, {**message, _GROUP_KEY: group, _ORIGIN_KEY: self.origin})
+
+    async def flush(self):
+        self._queues.clear()
+        self._groups.clear()
+        if self.remote is not None and hasattr(self.remote, "flush"):
+            await self.remote.flush()
+
+    async def close(self):
+        if self._pump is not None:
+            self._pump.cancel()
+            self._pump = None
+        if self.remote is not None and hasattr(self.remote, "close"):
+            await self.remote.close()
+
+    # Internals
+
+    def _queue(self, channel):
+        queue = self._queues.get(channel)
+        if queue is None:
+            queue = self._queues[channel] = asyncio.Queue(maxsize=self.get_capacity(channel))
+        return queue
+
+    def _put(self, channel, queue, message):
+        try:
+            queue.put_nowait((time.time() + self.expiry, message))
+        except asyncio.QueueFull:
+            raise ChannelFull(channel)
+
+    def _forget(self, channel):
+        self._queues.pop(channel, None)
+        for group, members in list(self._groups.items()):
+            members.discard(channel)
+            if not members:
+                del self._groups[group]
+
+    def _deliver_local(self, group, message):
+        """Hand the same message object to every local member; consumers must not mutate it"""
+        for channel in list(self._groups.get(group, ())):
+            queue = self._queues.get(channel)
+            if queue is None:
+                continue
+            try:
+                self._put(channel, queue, message)
+                self.stats["local_deliveries"] += 1
+            except ChannelFull:
+                logger.warning(f"Channel {channel} is full; dropping message for group {group}")
+
+    async def _ensure_pump(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # First use, or a new event loop (tests): the old pump is gone with its loop
+            self._loop, self._pump, self._pump_lock = loop, None, asyncio.Lock()
+        async with self._pump_lock:
+            if self._process_channel is None:
+                self._process_channel = await self.remote.new_channel(PROCESS_CHANNEL_PREFIX)
+            if self._pump is None or self._pump.done():
+                self._pump = asyncio.ensure_future(self._run_pump())
+
+    async def _run_pump(self):
+        """Receive group events published by other processes and fan them out locally"""
+        while True:
+            try:
+                message = await self.remote.receive(self._process_channel)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Hybrid layer remote receive failed: {type(e).__name__}: {str(e)}")
+                await asyncio.sleep(1)
+                continue
+            group = message.pop(_GROUP_KEY, None)
+            if message.pop(_ORIGIN_KEY, None) == self.origin:
+                self.stats["echoes_dropped"] += 1
+                continue
+            if group is None:
+                logger.warning("Hybrid layer got a remote message without a group; dropping it")
+                continue
+            self.stats["remote_deliveries"] += 1
+            self._deliver_local(group, message)
@@ -0,0 +1,44 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+_startup_hooks = []
+_shutdown_hooks = []
+
+
+def on_startup(func):
+    """Register an async callable to run on ASGI lifespan startup"""
+    _startup_hooks.append(func)
+    return func
+
+
+def on_shutdown(func):
+    """Register an async callable to run on ASGI lifespan shutdown"""
+    _shutdown_hooks.append(func)
+    return func
+
+
+async def _run(hooks, phase):
+    for hook in hooks:
+        try:
+            await hook()
+        except Exception as e:
+            logger.error(f"Lifespan {phase} hook {hook.__name__} failed: {type(e).__name__}: {str(e)}")
+
+
+async def lifespan_app(scope, receive, send):
+    """
+    ASGI lifespan handler.
+
+    Servers that don't speak the lifespan protocol (Daphne) never call this,
+    so every hook must also be safe to skip.
+    """
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await _run(_startup_hooks, "startup")
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await _run(_shutdown_hooks, "shutdown")
+            await send({"type": "lifespan.shutdown.complete"})
+            return
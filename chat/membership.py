@@ -0,0 +1,48 @@
+from django.conf import settings
+from .cache import MISSING, TTLCache
+from .db import db_sync_to_async
+from .models import ChatRoom
+
+# room_id -> (participant_a, participant_b), or None for a room that doesn't exist.
+# Participants never change after creation, so positive entries can live long.
+_room_cache = TTLCache(maxsize=getattr(settings, "ROOM_CACHE_SIZE", 50000))
+
+
+def remember_room(room_id, participant_a, participant_b):
+    """Cache a room's participants, e.g. right after CreateOrGetRoom creates it"""
+    _room_cache.set(int(room_id), (participant_a, participant_b), getattr(settings, "ROOM_CACHE_TTL", 3600.0))
+
+
+def forget_room(room_id):
+    _room_cache.delete(int(room_id))
+
+
+def clear_room_cache():
+    _room_cache.clear()
+
+
+def get_participants(room_id):
+    """
+    Return (participant_a, participant_b) for a room, or None if it doesn't exist.
+
+    Served from the in-process cache when possible; otherwise a single
+    values_list query fills it. Missing rooms are cached for ROOM_NEGATIVE_CACHE_TTL.
+    """
+    room_id = int(room_id)
+    participants = _room_cache.get(room_id)
+    if participants is not MISSING:
+        return participants
+    participants = ChatRoom.objects.filter(id=room_id).values_list("participant_a", "participant_b").first()
+    if participants is None:
+        _room_cache.set(room_id, None, getattr(settings, "ROOM_NEGATIVE_CACHE_TTL", 5.0))
+    else:
+        remember_room(room_id, *participants)
+    return participants
+
+
+async def aget_participants(room_id):
+    """Async get_participants that only leaves the event loop on a cache miss"""
+    participants = _room_cache.get(int(room_id))
+    if participants is not MISSING:
+        return participants
+    return await db_sync_to_async("get_participants")(get_participants)(room_id)
@@ -0,0 +1,327 @@
+import math
+import threading
+import time
+
+# A small Prometheus-compatible metrics registry, so the hot paths can be
+# instrumented without a new dependency. Values are per process: scrape
+# every worker, or aggregate with a label per instance.
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def labels(self, **labels):
+        """Return the child for one combination of label values"""
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _default(self):
+        if self.labelnames:
+            raise ValueError(f"{self.name} has labels; use .labels(...)")
+        return self.labels()
+
+    def collect(self):
+        """Yield exposition lines for every child"""
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for key, child in sorted(self._children.items()):
+            yield from child.samples(self.name, self.labelnames, key)
+
+    def clear(self):
+        """Drop recorded values; gauges computed at scrape time are kept"""
+        with self._lock:
+            self._children = {
+                key: child for key, child in self._children.items() if getattr(child, "_function", None)
+            }
+
+
+class _Value:
+    def __init__(self):
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def get(self):
+        return self._value
+
+    def samples(self, name, labelnames, key):
+        yield f"{name}{_format_labels(labelnames, key)} {_format_value(self.get())}"
+
+
+class _GaugeValue(_Value):
+    _function = None
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+
+    def set_function(self, function):
+        """Compute the value at scrape time instead of tracking it"""
+        self._function = function
+
+    def get(self):
+        if self._function is not None:
+            try:
+                return self._function()
+            except Exception:
+                return math.nan
+        return self._value
+
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._counts = [0] * len(buckets)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self._sum += value
+            self._count += 1
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self._counts[i] += 1
+                    break
+
+    def time(self):
+        """Context manager observing the wall time of its block, awaits included"""
+        return _Timer(self.observe)
+
+    @property
+    def count(self):
+        return self._count
+
+    def samples(self, name, labelnames, key):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self._counts):
+            cumulative += count
+            le = (("le", repr(float(bound))),)
+            yield f"{name}_bucket{_format_labels(labelnames, key, le)} {cumulative}"
+        yield f"{name}_bucket{_format_labels(labelnames, key, (('le', '+Inf'),))} {self._count}"
+        yield f"{name}_sum{_format_labels(labelnames, key)} {_format_value(self._sum)}"
+        yield f"{name}_count{_format_labels(labelnames, key)} {self._count}"
+
+
+class _Timer:
+    def __init__(self, observe):
+        self._observe = observe
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._observe(time.perf_counter() - self._started)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeValue()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+    def dec(self, amount=1):
+        self._default().dec(amount)
+
+    def set(self, value):
+        self._default().set(value)
+
+    def set_function(self, function):
+        self._default().set_function(function)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Duplicate metric {metric.name}")
+        self._metrics[metric.name] = metric
+
+    def render(self):
+        """Prometheus text exposition format, version 0.0.4"""
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        """Reset every metric's values (tests)"""
+        for metric in self._metrics.values():
+            metric.clear()
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+WS_HANDLER_SECONDS = Histogram(
+    "chat_ws_handler_seconds",
+    "Time spent in WebSocket consumer handlers",
+    ["consumer", "handler", "event"],
+)
+WS_CONNECTIONS = Gauge(
+    "chat_ws_connections",
+    "Open WebSocket connections",
+    ["consumer"],
+)
+GROUP_SEND_SECONDS = Histogram(
+    "chat_group_send_seconds",
+    "Channel layer group_send latency",
+    ["event"],
+)
+AUTH_REQUEST_SECONDS = Histogram(
+    "chat_auth_request_seconds",
+    "Auth service call latency by outcome; status is the HTTP status or 'error'",
+    ["operation", "status"],
+)
+DB_SECONDS = Histogram(
+    "chat_db_seconds",
+    "Database helper latency, excluding the wait for a worker thread",
+    ["operation"],
+)
+THREADPOOL_WAIT_SECONDS = Histogram(
+    "chat_threadpool_wait_seconds",
+    "Time database work waited for a DB pool thread",
+    ["operation"],
+)
+CHANNEL_LAYER_QUEUED = Gauge(
+    "chat_channel_layer_queued_messages",
+    "Messages waiting in this process's channel layer queues (in-process layers only)",
+)
+CHANNEL_LAYER_MAX_QUEUE = Gauge(
+    "chat_channel_layer_max_queue_depth",
+    "Deepest single channel queue in this process's channel layer (in-process layers only)",
+)
+WS_OUTBOUND_QUEUED = Gauge(
+    "chat_ws_outbound_queued_frames",
+    "Frames waiting in WebSocket outbound queues, over all connections",
+)
+WS_OUTBOUND_MAX_DEPTH = Gauge(
+    "chat_ws_outbound_max_queue_depth",
+    "Deepest single WebSocket outbound queue",
+)
+WS_OUTBOUND_DROPPED = Counter(
+    "chat_ws_outbound_dropped_total",
+    "State frames not sent to slow sockets; reason is 'collapsed' (superseded) or 'full'",
+    ["event", "reason"],
+)
+WS_SLOW_CLOSES = Counter(
+    "chat_ws_slow_consumer_closes_total",
+    "WebSockets closed for falling too far behind",
+    ["reason"],
+)
+WS_RATE_LIMITED = Counter(
+    "chat_ws_rate_limited_total",
+    "Inbound WebSocket frames refused by rate limits; scope is 'connection' or 'user'",
+    ["event", "scope"],
+)
+DB_READ_ROUTES = Counter(
+    "chat_db_read_routes_total",
+    "Replica-eligible reads by where they went: replica, or the primary because the user wrote recently (sticky) or replicas lag (lagging)",
+    ["route"],
+)
+DB_REPLICA_LAG_SECONDS = Gauge(
+    "chat_db_replica_lag_seconds",
+    "Last measured replication lag per replica alias; NaN when the replica can't be reached",
+    ["alias"],
+)
+
+
+async def timed_group_send(channel_layer, group, event):
+    """group_send, observed in GROUP_SEND_SECONDS under the event's type"""
+    with GROUP_SEND_SECONDS.labels(event=event.get("type", "")).time():
+        await channel_layer.group_send(group, event)
+
+
+def _queue_depths():
+    """Queue sizes of the default channel layer, if it keeps its queues in this process"""
+    from channels.layers import channel_layers
+    layer = channel_layers.backends.get("default")
+    if layer is None:
+        return []
+    queues = getattr(layer, "_queues", None)  # HybridChannelLayer
+    if queues is not None:
+        return [queue.qsize() for queue in list(queues.values())]
+    channels = getattr(layer, "channels", None)  # InMemoryChannelLayer
+    if isinstance(channels, dict):
+        return [queue.qsize() for queue in list(channels.values())]
+    return []
+
+
+CHANNEL_LAYER_QUEUED.set_function(lambda: sum(_queue_depths()))
+CHANNEL_LAYER_MAX_QUEUE.set_function(lambda: max(_queue_depths(), default=0))
@@ -1,21 +1,66 @@
+import hashlib
+import logging
+import time
 import jwt
+from jwt.algorithms import get_default_algorithms
 from urllib.parse import parse_qs
 from channels.middleware import BaseMiddleware
-from channels.db import database_sync_to_async
 from django.conf import settings
+from .cache import MISSING, TTLCache
 
-@database_sync_to_async
-def _decode_token(token):
+logger = logging.getLogger(__name__)
+
+# Verified payloads keyed by token hash, so reconnect storms skip signature checks
+_payload_cache = TTLCache(maxsize=getattr(settings, "JWT_PAYLOAD_CACHE_SIZE", 10000))
+
+
+def _prepare_key():
+    """
+    Resolve the algorithm and parse the key material once.
+
+    Returns:
+        tuple: (algorithm, key) ready to pass to jwt.decode
+    """
+    if settings.JWT_ALGORITHM.upper() == "RS256" and settings.JWT_PUBLIC_KEY:
+        algorithm, raw_key = "RS256", settings.JWT_PUBLIC_KEY
+    else:
+        algorithm, raw_key = settings.JWT_ALGORITHM, settings.JWT_SECRET
     try:
-        if settings.JWT_ALGORITHM.upper() == "RS256" and settings.JWT_PUBLIC_KEY:
-            payload = jwt.decode(token, settings.JWT_PUBLIC_KEY, algorithms=["RS256"])
-        else:
-            payload = jwt.decode(token, settings.JWT_SECRET, algorithms=[settings.JWT_ALGORITHM])
+        return algorithm, get_default_algorithms()[algorithm].prepare_key(raw_key)
+    except Exception as e:
+        # Fall back to the raw key; jwt.decode will reject tokens the same way it used to
+        logger.error(f"Could not prepare JWT key for {algorithm}: {type(e).__name__}: {str(e)}")
+        return algorithm, raw_key
+
+
+def _decode_token(token, algorithm, key):
+    """
+    Verify a token and return its payload, or None if it is invalid.
+
+    Pure CPU work with no I/O, so it runs inline on the event loop. Verified
+    payloads are cached until the token's exp (or JWT_PAYLOAD_CACHE_TTL).
+    """
+    cache_key = hashlib.sha256(token.encode()).hexdigest()
+    payload = _payload_cache.get(cache_key)
+    if payload is not MISSING:
         return payload
+    try:
+        payload = jwt.decode(token, key, algorithms=[algorithm])
     except Exception:
         return None
+    ttl = getattr(settings, "JWT_PAYLOAD_CACHE_TTL", 300.0)
+    exp = payload.get("exp")
+    if exp:
+        ttl = min(ttl, float(exp) - time.time())
+    _payload_cache.set(cache_key, payload, ttl)
+    return payload
+
 
 class JwtAuthMiddleware(BaseMiddleware):
+    def __init__(self, inner):
+        super().__init__(inner)
+        self.algorithm, self.key = _prepare_key()
+
     async def __call__(self, scope, receive, send):
         qs = parse_qs(scope.get("query_string", b"").decode())
         token = qs.get("token", [None])[0]
@@ -31,7 +76,7 @@ class JwtAuthMiddleware(BaseMiddleware):
 
         scope["auth_user"] = None
         if token:
-            payload = await _decode_token(token)
+            payload = _decode_token(token, self.algorithm, self.key)
             if payload:
               
                 scope["auth_user"] = {
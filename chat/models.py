@@ -6,6 +6,7 @@ class ChatRoom(models.Model):
     participant_a = models.CharField(max_length=255, db_index=True)
     participant_b = models.CharField(max_length=255, db_index=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    last_seq = models.BigIntegerField(default=0)  # highest Message.seq issued in this room
     
     class Meta:
         unique_together = (('participant_a', 'participant_b'),)
@@ -22,12 +23,29 @@ class Message(models.Model):
     content = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
     is_read = models.BooleanField(default=False)
+    seq = models.BigIntegerField(null=True)  # gap-free per-room sequence, see persistence.save_messages
     
     class Meta:
         ordering = ('timestamp',)
         indexes = [
             models.Index(fields=['room', 'timestamp']),
         ]
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'seq'], name='chat_message_room_seq_uniq'),
+        ]
     
     def __str__(self):
-        return f"Message from {self.sender_id} at {self.timestamp}"
\ No newline at end of file
+        return f"Message from {self.sender_id} at {self.timestamp}"
+
+class UnreadCounter(models.Model):
+    """Unread messages per (room, user), kept in step with inserts and read receipts"""
+    room = models.ForeignKey(ChatRoom, related_name="unread_counters", on_delete=models.CASCADE)
+    user_id = models.CharField(max_length=255)  # User ID from auth service
+    unread = models.PositiveIntegerField(default=0)
+    last_read_id = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = (('room', 'user_id'),)
+
+    def __str__(self):
+        return f"{self.user_id} has {self.unread} unread in room {self.room_id}"
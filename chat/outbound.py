@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import time
+import weakref
+from collections import OrderedDict, deque
+from django.conf import settings
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Close code for a socket that fell too far behind. The client should
+# reconnect with ?last_seq=<last seq it saw> to replay what it missed.
+SLOW_CONSUMER_CLOSE_CODE = 4008
+
+# Every live queue, for the max-depth gauge
+_queues = weakref.WeakSet()
+
+
+class OutboundQueue:
+    """
+    Frames waiting to be written to one socket.
+
+    Critical frames (chat messages, replies to the client) are kept in
+    order and never dropped. State frames carry a collapse key and only
+    the latest per key is kept; they are written after any pending
+    critical frames.
+    """
+
+    def __init__(self):
+        self.critical = deque()
+        self.state = OrderedDict()
+        self.ready = asyncio.Event()
+        _queues.add(self)
+
+    def __len__(self):
+        return len(self.critical) + len(self.state)
+
+    def pop(self):
+        if self.critical:
+            return self.critical.popleft()
+        if self.state:
+            return self.state.popitem(last=False)[1]
+        return None
+
+    def clear(self):
+        self.critical.clear()
+        self.state.clear()
+
+
+metrics.WS_OUTBOUND_MAX_DEPTH.set_function(lambda: max((len(q) for q in list(_queues)), default=0))
+
+
+class OutboundQueueMixin:
+    """
+    Bounded, prioritised outbound queue per WebSocket connection.
+
+    send() only queues the frame; a writer task per connection writes
+    them to the socket, so a client on a slow network no longer stalls
+    the consumer's group handlers and channel layer events keep being
+    drained instead of piling up in the layer.
+
+    State events (encode_event with a collapse_key: typing, presence,
+    read receipts) replace a pending event with the same key, and are
+    dropped when CHAT_OUTBOUND_QUEUE_SIZE frames are already waiting.
+    Chat messages and direct replies are always queued; a connection
+    that stays over CHAT_OUTBOUND_QUEUE_SIZE for CHAT_OUTBOUND_SLOW_SECONDS,
+    or reaches CHAT_OUTBOUND_HARD_LIMIT, is closed with
+    SLOW_CONSUMER_CLOSE_CODE.
+
+    Mix in before SubprotocolMixin.
+    """
+
+    _outbound = None
+    _outbound_writer = None
+    _outbound_closed = False
+    _over_since = None
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        if self._outbound_closed:
+            return
+        queue = self._outbound_queue()
+        queue.critical.append((None, text_data, bytes_data, close))
+        self._queued(queue)
+        if len(queue) >= getattr(settings, "CHAT_OUTBOUND_HARD_LIMIT", 1024):
+            await self._close_slow("overflow")
+            return
+        await self._check_lag(queue)
+
+    async def send_encoded(self, event):
+        key = event.get("collapse_key")
+        if key is None:
+            return await super().send_encoded(event)
+        if self._outbound_closed:
+            return
+        binary = getattr(self, "binary", False)
+        frame = (event["type"], None if binary else event["text"], event["bytes"] if binary else None, False)
+        queue = self._outbound_queue()
+        if key in queue.state:
+            superseded = queue.state[key]
+            queue.state[key] = frame
+            metrics.WS_OUTBOUND_DROPPED.labels(event=superseded[0], reason="collapsed").inc()
+            return
+        if len(queue) >= getattr(settings, "CHAT_OUTBOUND_QUEUE_SIZE", 256):
+            metrics.WS_OUTBOUND_DROPPED.labels(event=event["type"], reason="full").inc()
+            await self._check_lag(queue)
+            return
+        queue.state[key] = frame
+        self._queued(queue)
+
+    async def websocket_disconnect(self, message):
+        self._stop_outbound()
+        await super().websocket_disconnect(message)
+
+    def _outbound_queue(self):
+        if self._outbound is None:
+            self._outbound = OutboundQueue()
+        if self._outbound_writer is None:
+            self._outbound_writer = asyncio.ensure_future(self._write_outbound())
+        return self._outbound
+
+    def _queued(self, queue):
+        metrics.WS_OUTBOUND_QUEUED.inc()
+        queue.ready.set()
+
+    async def _check_lag(self, queue):
+        """Close the socket once it has stayed over the queue size for too long"""
+        if len(queue) <= getattr(settings, "CHAT_OUTBOUND_QUEUE_SIZE", 256):
+            self._over_since = None
+            return
+        now = time.monotonic()
+        if self._over_since is None:
+            self._over_since = now
+        elif now - self._over_since >= getattr(settings, "CHAT_OUTBOUND_SLOW_SECONDS", 10.0):
+            await self._close_slow("lagging")
+
+    async def _write_outbound(self):
+        queue = self._outbound
+        while True:
+            frame = queue.pop()
+            if frame is None:
+                queue.ready.clear()
+                await queue.ready.wait()
+                continue
+            metrics.WS_OUTBOUND_QUEUED.dec()
+            _, text_data, bytes_data, close = frame
+            try:
+                await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+            except Exception as e:
+                logger.error(f"Outbound write failed, dropping {len(queue)} frames: {type(e).__name__}: {str(e)}")
+                self._outbound_closed = True
+                self._discard_pending()
+                return
+            if self._over_since is not None and len(queue) <= getattr(settings, "CHAT_OUTBOUND_QUEUE_SIZE", 256):
+                self._over_since = None
+
+    async def _close_slow(self, reason):
+        pending = len(self._outbound)
+        logger.warning(f"Closing slow WebSocket {self.channel_name} ({reason}, {pending} frames pending)")
+        metrics.WS_SLOW_CLOSES.labels(reason=reason).inc()
+        self._outbound_closed = True
+        self._stop_outbound()
+        await self.close(code=SLOW_CONSUMER_CLOSE_CODE)
+
+    def _stop_outbound(self):
+        if self._outbound_writer is not None:
+            self._outbound_writer.cancel()
+            self._outbound_writer = None
+        self._discard_pending()
+
+    def _discard_pending(self):
+        if self._outbound is not None:
+            metrics.WS_OUTBOUND_QUEUED.dec(len(self._outbound))
+            self._outbound.clear()
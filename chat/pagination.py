@@ -0,0 +1,104 @@
+import base64
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Q
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(timestamp, pk):
+    """Encode a (timestamp, id) position as an opaque url-safe cursor"""
+    raw = f"{timestamp.isoformat()}|{pk}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Decode a cursor produced by encode_cursor back into (timestamp, id)"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode()).decode()
+        ts, pk = raw.rsplit("|", 1)
+        return datetime.fromisoformat(ts), int(pk)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise InvalidCursor(f"Invalid cursor: {cursor!r}") from e
+
+
+def encode_score_cursor(score, pk):
+    """Encode a (score, id) position in a ranked listing as an opaque cursor"""
+    raw = f"{score!r}|{pk}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_score_cursor(cursor):
+    """Decode a cursor produced by encode_score_cursor back into (score, id)"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode()).decode()
+        score, pk = raw.rsplit("|", 1)
+        return float(score), int(pk)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise InvalidCursor(f"Invalid cursor: {cursor!r}") from e
+
+
+def parse_limit(value, default=None, maximum=None):
+    """Parse a ?limit= value, falling back to the default and capping at the maximum"""
+    if default is None:
+        default = getattr(settings, "CHAT_PAGE_SIZE", 50)
+    if maximum is None:
+        maximum = getattr(settings, "CHAT_MAX_PAGE_SIZE", 200)
+    if value in (None, ""):
+        return min(default, maximum)
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        raise ValueError("limit must be an integer")
+    if limit < 1:
+        raise ValueError("limit must be a positive integer")
+    return min(limit, maximum)
+
+
+def paginate_keyset(qs, limit, before=None, after=None, field="timestamp"):
+    """
+    Keyset-paginate a queryset on (field, id).
+
+    Args:
+        qs: Queryset to paginate (any ordering is replaced)
+        limit: Maximum number of rows to return
+        before: Cursor; return the rows immediately older than it
+        after: Cursor; return the rows immediately newer than it
+
+    Returns:
+        tuple: (rows in ascending order, prev cursor or None, next cursor or None)
+
+    With neither cursor the newest page is returned. Each page is a single
+    indexed range scan, so the cost does not grow with the size of the table.
+    """
+    if before and after:
+        raise InvalidCursor("Use either before or after, not both")
+
+    if after:
+        ts, pk = decode_cursor(after)
+        qs = qs.filter(Q(**{f"{field}__gt": ts}) | Q(**{field: ts, "id__gt": pk}))
+        rows = list(qs.order_by(field, "id")[:limit + 1])
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        has_newer, has_older = has_more, True
+    else:
+        if before:
+            ts, pk = decode_cursor(before)
+            qs = qs.filter(Q(**{f"{field}__lt": ts}) | Q(**{field: ts, "id__lt": pk}))
+        rows = list(qs.order_by(f"-{field}", "-id")[:limit + 1])
+        has_more = len(rows) > limit
+        rows = rows[:limit][::-1]
+        has_newer, has_older = bool(before), has_more
+
+    if not rows:
+        return rows, None, None
+
+    first, last = rows[0], rows[-1]
+    prev_cursor = encode_cursor(getattr(first, field), first.id) if has_older else None
+    next_cursor = encode_cursor(getattr(last, field), last.id) if has_newer else None
+    return rows, prev_cursor, next_cursor
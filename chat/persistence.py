@@ -0,0 +1,172 @@
+import asyncio
+import atexit
+import logging
+import weakref
+from django.conf import settings
+from collections import defaultdict
+from django.db import transaction
+from django.db.models import F
+from .db import db_sync_to_async
+from .models import ChatRoom, Message
+from .receipts import increment_unread
+
+logger = logging.getLogger(__name__)
+
+
+def assign_seqs(messages):
+    """
+    Give each message the next sequence number of its room.
+
+    Bumping ChatRoom.last_seq row-locks the room until the transaction
+    commits, so concurrent writers to one room serialize here and sequence
+    numbers are gap-free and in commit order. One UPDATE per room per batch.
+    Rooms are locked in id order, so two batches touching the same rooms
+    can't deadlock.
+    """
+    by_room = defaultdict(list)
+    for message in messages:
+        by_room[message.room_id].append(message)
+    for room_id in sorted(by_room):
+        room_messages = by_room[room_id]
+        ChatRoom.objects.filter(id=room_id).update(last_seq=F('last_seq') + len(room_messages))
+        last_seq = ChatRoom.objects.values_list('last_seq', flat=True).get(id=room_id)
+        first_seq = last_seq - len(room_messages) + 1
+        for seq, message in enumerate(room_messages, start=first_seq):
+            message.seq = seq
+
+
+def save_messages(messages):
+    """Insert a batch of unsaved Message instances with one bulk INSERT"""
+    with transaction.atomic():
+        assign_seqs(messages)
+        messages = Message.objects.bulk_create(messages)
+        increment_unread(messages)
+    return messages
+
+
+class MessageWriter:
+    """
+    Per-process write-behind queue for chat messages.
+
+    Messages are buffered and written with bulk_create once
+    CHAT_WRITE_BEHIND_BATCH_SIZE are pending or CHAT_WRITE_BEHIND_FLUSH_MS
+    has passed, whichever comes first. submit() returns a future that
+    resolves to the saved Message once its batch is committed. A failed
+    batch is retried up to `retries` times with exponential backoff before
+    its futures fail.
+    """
+
+    def __init__(self, batch_size=100, flush_interval=0.02, retries=3, retry_delay=0.1):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._pending = []
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+    def submit(self, message):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((message, future))
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+        return future
+
+    async def _run(self):
+        while self._pending:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        """
+        Write everything currently pending, one bulk_create per batch.
+        Also waits for a batch another flush is already writing.
+        """
+        async with self._flush_lock:
+            while self._pending:
+                batch = self._pending[:self.batch_size]
+                del self._pending[:self.batch_size]
+                messages = [message for message, _ in batch]
+                try:
+                    await self._save(messages)
+                except Exception as e:
+                    logger.error(f"Failed to persist {len(batch)} messages: {type(e).__name__}: {str(e)}")
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                            # Mark retrieved; callers that don't await it still see the log above
+                            future.exception()
+                    continue
+                for message, future in batch:
+                    if not future.done():
+                        future.set_result(message)
+
+    async def _save(self, messages):
+        # The transaction rolls back as a whole on failure, so a retry can't double-insert
+        for attempt in range(self.retries + 1):
+            try:
+                return await db_sync_to_async("save_messages")(save_messages)(messages)
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                delay = self.retry_delay * 2 ** attempt
+                logger.warning(
+                    f"Persisting {len(messages)} messages failed, retrying in {delay:.1f}s: "
+                    f"{type(e).__name__}: {str(e)}"
+                )
+                await asyncio.sleep(delay)
+
+    def drain(self):
+        """
+        Save everything pending synchronously, without the event loop.
+        For process exit, when the loop may no longer be running.
+        """
+        while self._pending:
+            batch = self._pending[:self.batch_size]
+            del self._pending[:self.batch_size]
+            try:
+                save_messages([message for message, _ in batch])
+            except Exception as e:
+                logger.error(f"Failed to persist {len(batch)} messages at exit: {type(e).__name__}: {str(e)}")
+
+
+_writers = weakref.WeakKeyDictionary()
+
+
+def write_behind_enabled():
+    return getattr(settings, "CHAT_WRITE_BEHIND", False)
+
+
+def get_writer():
+    """Return the MessageWriter for the running event loop"""
+    loop = asyncio.get_running_loop()
+    writer = _writers.get(loop)
+    if writer is None:
+        writer = _writers[loop] = MessageWriter(
+            batch_size=getattr(settings, "CHAT_WRITE_BEHIND_BATCH_SIZE", 100),
+            flush_interval=getattr(settings, "CHAT_WRITE_BEHIND_FLUSH_MS", 20) / 1000,
+            retries=getattr(settings, "CHAT_WRITE_BEHIND_RETRIES", 3),
+        )
+    return writer
+
+
+async def flush_pending_messages():
+    """Flush the running loop's writer; registered as a lifespan shutdown hook"""
+    writer = _writers.get(asyncio.get_running_loop())
+    if writer is not None:
+        await writer.flush()
+
+
+@atexit.register
+def _drain_writers():
+    # Daphne never sends lifespan events, so this is what saves messages
+    # still queued when it stops (on SIGTERM/SIGINT, not on SIGKILL)
+    for writer in list(_writers.values()):
+        writer.drain()
@@ -0,0 +1,271 @@
+import asyncio
+import logging
+from channels.layers import get_channel_layer
+from django.conf import settings
+from .codecs import encode_event
+from .metrics import timed_group_send
+
+logger = logging.getLogger(__name__)
+
+ONLINE = "online"
+OFFLINE = "offline"
+GLOBAL_GROUP = "presence_global"
+
+# group event type -> "type" of the frame clients receive
+_FRAME_TYPES = {
+    "presence.update": "presence",
+    "presence.broadcast": "presence_global",
+}
+
+
+class InMemoryPresenceStore:
+    """
+    Connection counts and last published status, local to this process.
+    Neither keeps an entry for a user who is offline.
+    """
+
+    def __init__(self):
+        self._counts = {}
+        self._status = {}
+
+    async def incr(self, key):
+        self._counts[key] = self._counts.get(key, 0) + 1
+        return self._counts[key]
+
+    async def decr(self, key):
+        count = self._counts.get(key, 0) - 1
+        if count <= 0:
+            self._counts.pop(key, None)
+            return 0
+        self._counts[key] = count
+        return count
+
+    async def counts(self, keys):
+        return [self._counts.get(key, 0) for key in keys]
+
+    async def swap_status(self, key, status):
+        old, self._status[key] = self._status.get(key), status
+        return old
+
+    async def pop_status(self, key):
+        return self._status.pop(key, None)
+
+
+_DECR_SCRIPT = """
+local n = redis.call('HINCRBY', KEYS[1], ARGV[1], -1)
+if n <= 0 then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+    n = 0
+end
+return n
+"""
+
+_SWAP_SCRIPT = """
+local old = redis.call('HGET', KEYS[1], ARGV[1])
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+return old
+"""
+
+_POP_SCRIPT = """
+local old = redis.call('HGET', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[1], ARGV[1])
+return old
+"""
+
+
+class RedisPresenceStore:
+    """
+    Presence shared by every worker through two Redis hashes.
+
+    Counts of a worker that dies without running disconnect are not
+    reclaimed; flush the hashes on a full redeploy. Any Redis error falls
+    back to the in-memory store so presence degrades to per-process
+    instead of failing connects.
+    """
+
+    counts_key = "chat:presence:count"
+    status_key = "chat:presence:status"
+
+    def __init__(self, url):
+        self.url = url
+        self._clients = {}
+        self._fallback = InMemoryPresenceStore()
+
+    def _client(self):
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(id(loop))
+        if client is None:
+            import redis.asyncio
+            client = self._clients[id(loop)] = redis.asyncio.Redis.from_url(self.url, decode_responses=True)
+        return client
+
+    async def _call(self, name, *args):
+        try:
+            return await getattr(self, f"_redis_{name}")(*args)
+        except Exception as e:
+            logger.warning(f"Redis presence {name} failed, using in-memory fallback: {type(e).__name__}: {str(e)}")
+            return await getattr(self._fallback, name)(*args)
+
+    async def incr(self, key):
+        return await self._call("incr", key)
+
+    async def decr(self, key):
+        return await self._call("decr", key)
+
+    async def counts(self, keys):
+        return await self._call("counts", keys)
+
+    async def swap_status(self, key, status):
+        return await self._call("swap_status", key, status)
+
+    async def pop_status(self, key):
+        return await self._call("pop_status", key)
+
+    async def _redis_incr(self, key):
+        return int(await self._client().hincrby(self.counts_key, key, 1))
+
+    async def _redis_decr(self, key):
+        return int(await self._client().eval(_DECR_SCRIPT, 1, self.counts_key, key))
+
+    async def _redis_counts(self, keys):
+        if not keys:
+            return []
+        return [int(v or 0) for v in await self._client().hmget(self.counts_key, keys)]
+
+    async def _redis_swap_status(self, key, status):
+        return await self._client().eval(_SWAP_SCRIPT, 1, self.status_key, key, status)
+
+    async def _redis_pop_status(self, key):
+        return await self._client().eval(_POP_SCRIPT, 1, self.status_key, key)
+
+
+_store = None
+_offline_tasks = {}
+
+
+def get_store():
+    global _store
+    if _store is None:
+        url = getattr(settings, "PRESENCE_REDIS_URL", None)
+        _store = RedisPresenceStore(url) if url else InMemoryPresenceStore()
+    return _store
+
+
+def reset_store():
+    """Forget all presence state in this process (tests, settings changes)"""
+    global _store
+    for task in _offline_tasks.values():
+        task.cancel()
+    _offline_tasks.clear()
+    _store = None
+
+
+def _room_key(room_group, user_id):
+    return f"{room_group}:{user_id}"
+
+
+def _user_key(user_id):
+    return f"user:{user_id}"
+
+
+def _announce_key(user_id):
+    # Client-announced statuses live apart from the ref-counted ones, so an
+    # announcement can't pin a user's connection-derived presence
+    return f"announce:{user_id}"
+
+
+async def _publish(key, group, event_type, user_id, status):
+    """Record the status and broadcast it only if it actually changed"""
+    store = get_store()
+    # Offline drops the entry instead of storing it, so status only grows with present users
+    old = await (store.pop_status(key) if status == OFFLINE else store.swap_status(key, status))
+    if old == status or (old is None and status == OFFLINE):
+        return False
+    await timed_group_send(get_channel_layer(), group, encode_event(event_type, {
+        "type": _FRAME_TYPES[event_type],
+        "user_id": user_id,
+        "status": status,
+    }, collapse_key=f"presence:{user_id}"))
+    return True
+
+
+async def connect(room_group, user_id):
+    """
+    Count a new connection of user_id in room_group.
+
+    The first connection publishes "online" to the room and to the global
+    group; extra tabs and reconnects within the offline grace period
+    publish nothing.
+    """
+    for key in (_room_key(room_group, user_id), _user_key(user_id)):
+        task = _offline_tasks.pop(key, None)
+        if task is not None:
+            task.cancel()
+    store = get_store()
+    if await store.incr(_room_key(room_group, user_id)) == 1:
+        await _publish(_room_key(room_group, user_id), room_group, "presence.update", user_id, ONLINE)
+    if await store.incr(_user_key(user_id)) == 1:
+        await _publish(_user_key(user_id), GLOBAL_GROUP, "presence.broadcast", user_id, ONLINE)
+
+
+async def disconnect(room_group, user_id):
+    """
+    Drop one connection of user_id in room_group.
+
+    When the last connection closes, "offline" is published only after
+    PRESENCE_OFFLINE_GRACE seconds, and only if the user hasn't come back.
+    """
+    store = get_store()
+    targets = [
+        (_room_key(room_group, user_id), room_group, "presence.update"),
+        (_user_key(user_id), GLOBAL_GROUP, "presence.broadcast"),
+    ]
+    for key, group, event_type in targets:
+        if await store.decr(key) > 0:
+            continue
+        grace = getattr(settings, "PRESENCE_OFFLINE_GRACE", 5.0)
+        if grace <= 0:
+            await _publish_offline(key, group, event_type, user_id)
+        else:
+            _offline_tasks[key] = asyncio.ensure_future(
+                _publish_offline_later(key, group, event_type, user_id, grace)
+            )
+
+
+async def _publish_offline_later(key, group, event_type, user_id, grace):
+    await asyncio.sleep(grace)
+    _offline_tasks.pop(key, None)
+    # Another worker may have picked the user up in the meantime
+    if (await get_store().counts([key]))[0] == 0:
+        await _publish_offline(key, group, event_type, user_id)
+
+
+async def _publish_offline(key, group, event_type, user_id):
+    if key == _user_key(user_id):
+        # An announced status doesn't outlive the user's last connection
+        await clear_announcement(user_id)
+    await _publish(key, group, event_type, user_id, OFFLINE)
+
+
+async def snapshot(room_group, user_ids):
+    """Return {user_id: "online"/"offline"} for the given users in a room"""
+    keys = [_room_key(room_group, user_id) for user_id in user_ids]
+    counts = await get_store().counts(keys)
+    # Users inside the offline grace period are still shown online to everyone else
+    return {
+        user_id: ONLINE if count or key in _offline_tasks else OFFLINE
+        for user_id, key, count in zip(user_ids, keys, counts)
+    }
+
+
+async def announce(user_id, status):
+    """
+    Publish a client-announced status to the global group if it changed.
+    Callers must make sure user_id is the authenticated user.
+    """
+    return await _publish(_announce_key(user_id), GLOBAL_GROUP, "presence.broadcast", user_id, status)
+
+
+async def clear_announcement(user_id):
+    """Forget user_id's announced status without publishing anything"""
+    await get_store().pop_status(_announce_key(user_id))
@@ -0,0 +1,230 @@
+import asyncio
+import cProfile
+import contextlib
+import hmac
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from urllib.parse import parse_qs
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# One profile at a time per thread: cProfile can't nest, and handlers that
+# run concurrently on the event loop would land in each other's profiles anyway
+_active = threading.local()
+
+
+def _enabled_by_rate():
+    rate = getattr(settings, "PROFILE_SAMPLE_RATE", 0.0)
+    return rate > 0 and random.random() < rate
+
+
+def _flag_allowed(value):
+    """True if a request's profile flag carries the admin PROFILE_TOKEN"""
+    token = getattr(settings, "PROFILE_TOKEN", None)
+    return bool(token and value) and hmac.compare_digest(value.encode(), token.encode())
+
+
+def _route_name(path):
+    """/api/chat/rooms/12/messages/ -> api_chat_rooms_id_messages"""
+    parts = ["id" if part.isdigit() else part for part in path.strip("/").split("/") if part]
+    return "_".join(parts) or "root"
+
+
+def _safe(name):
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", name)
+
+
+# Leaf frames of threads that are blocked rather than working (idle sync
+# workers, the event loop waiting in select); dropped from samples
+_IDLE_FRAMES = {
+    ("threading.py", "wait"), ("selectors.py", "select"), ("queue.py", "get"), ("thread.py", "_worker"),
+}
+
+
+class _StackSampler:
+    """
+    Samples the Python stacks of every thread each `interval` seconds from
+    a helper thread and counts identical stacks, for collapsed-stack output
+    (flamegraph.pl, speedscope, inferno). All threads are sampled because
+    Django views and database_sync_to_async work run off the event loop.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self._thread.ident:
+                    continue
+                leaf = (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name)
+                if leaf in _IDLE_FRAMES:
+                    continue
+                if thread_id not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def write(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+def _start(fmt):
+    """Start a collector, or return None if profiling can't start here"""
+    if fmt == "pstats":
+        collector = cProfile.Profile()
+        try:
+            collector.enable()
+        except ValueError as e:  # another profiler (debugger, coverage) owns the hook
+            logger.warning(f"Profiling skipped: {str(e)}")
+            return None
+        return collector
+    collector = _StackSampler(getattr(settings, "PROFILE_INTERVAL_MS", 5) / 1000)
+    collector.start()
+    return collector
+
+
+def _stop(collector):
+    if isinstance(collector, cProfile.Profile):
+        collector.disable()
+    else:
+        collector.stop()
+
+
+@contextlib.asynccontextmanager
+async def profile(name):
+    """
+    Profile the enclosed block and write the result to PROFILE_DIR.
+
+    PROFILE_FORMAT "collapsed" (default) samples every thread's stack each
+    PROFILE_INTERVAL_MS and writes one "frame;frame;frame count" line per
+    distinct stack, which is cheap enough for production. "pstats" writes
+    cProfile output (snakeviz, `python -m pstats`) but, before Python
+    3.12, only sees the event loop thread, not sync views or DB work.
+    Files are named <unix ms>-<pid>-<name>-<duration>ms.<ext>.
+
+    Handlers that run concurrently show up in each other's profiles, and a
+    block that starts while another is being profiled on the same thread
+    is not profiled.
+    """
+    if getattr(_active, "busy", False):
+        yield
+        return
+    fmt = getattr(settings, "PROFILE_FORMAT", "collapsed")
+    collector = _start(fmt)
+    if collector is None:
+        yield
+        return
+    _active.busy = True
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        _stop(collector)
+        _active.busy = False
+        await _save(collector, name, elapsed_ms)
+
+
+def _write_pstats(profile, path):
+    profile.dump_stats(path)
+
+
+async def _save(collector, name, elapsed_ms):
+    directory = getattr(settings, "PROFILE_DIR", "/tmp/chat-profiles")
+    filename = f"{int(time.time() * 1000)}-{os.getpid()}-{_safe(name)}-{elapsed_ms:.0f}ms"
+    try:
+        os.makedirs(directory, exist_ok=True)
+        if isinstance(collector, cProfile.Profile):
+            path = os.path.join(directory, f"{filename}.pstats")
+            await asyncio.to_thread(_write_pstats, collector, path)
+        else:
+            path = os.path.join(directory, f"{filename}.collapsed")
+            await asyncio.to_thread(collector.write, path)
+    except OSError as e:
+        logger.error(f"Could not write profile {filename}: {type(e).__name__}: {str(e)}")
+        return
+    logger.info(f"Wrote profile {path}")
+
+
+class ProfilingMiddleware:
+    """
+    Opt-in profiling around the ASGI application.
+
+    HTTP requests are profiled end to end when sampled at
+    PROFILE_SAMPLE_RATE, or when they carry the admin PROFILE_TOKEN in an
+    "X-Profile" header or a "profile" query parameter. A WebSocket that
+    connects with ?profile=<PROFILE_TOKEN> has every event handler
+    profiled; otherwise consumers using ProfiledConsumerMixin sample
+    individual events at PROFILE_SAMPLE_RATE. With the rate at 0 and no
+    token configured this adds one settings lookup per connection.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            return await self.app(scope, receive, send)
+        flagged = _flag_allowed(self._flag(scope))
+        if scope["type"] == "websocket":
+            scope = dict(scope, profile=flagged)
+            return await self.app(scope, receive, send)
+        if not flagged and not _enabled_by_rate():
+            return await self.app(scope, receive, send)
+        name = f"http-{scope.get('method', '')}-{_route_name(scope.get('path', ''))}"
+        async with profile(name):
+            await self.app(scope, receive, send)
+
+    @staticmethod
+    def _flag(scope):
+        if not getattr(settings, "PROFILE_TOKEN", None):
+            return None
+        for key, value in scope.get("headers", []):
+            if key == b"x-profile":
+                return value.decode("latin-1")
+        values = parse_qs(scope.get("query_string", b"").decode()).get("profile")
+        return values[0] if values else None
+
+
+class ProfiledConsumerMixin:
+    """
+    Profile consumer event handlers: websocket.receive and group events.
+
+    Files are named ws-<consumer>-<event type>. Mix in first, before the
+    other consumer bases.
+    """
+
+    profile_name = None
+
+    async def dispatch(self, message):
+        if not self.scope.get("profile") and not _enabled_by_rate():
+            return await super().dispatch(message)
+        name = f"ws-{self.profile_name or type(self).__name__}-{message.get('type', '')}"
+        async with profile(name):
+            await super().dispatch(message)
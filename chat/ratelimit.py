@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import time
+from collections import namedtuple
+from django.conf import settings
+from . import metrics
+from .cache import MISSING, TTLCache
+
+logger = logging.getLogger(__name__)
+
+# A refused frame: seconds until a token is available, and whether this is
+# the first refusal since the event type was last allowed (only that one
+# gets an error frame, so a flood doesn't turn into a flood of errors)
+Limited = namedtuple("Limited", ["retry_after", "notify"])
+
+
+class TokenBucket:
+    """Holds up to `burst` tokens, refilled at `rate` tokens per second"""
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic() if now is None else now
+
+    def take(self, now=None):
+        """
+        Take one token.
+
+        Returns:
+            float: 0 if a token was taken, else seconds until one is available
+        """
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + max(0.0, now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+
+class InMemoryRateLimitStore:
+    """
+    Per-user buckets local to this process; the stand-in for Redis in tests
+    and single-node setups.
+
+    A bucket is forgotten once it would have refilled completely (it holds
+    no state then), and at most max_buckets are kept: past that the least
+    recently used is dropped, which gives its user a fresh burst.
+    """
+
+    max_buckets = 10000
+
+    def __init__(self, max_buckets=None):
+        self._buckets = TTLCache(maxsize=max_buckets or self.max_buckets)
+
+    async def take(self, key, rate, burst):
+        bucket = self._buckets.get(key)
+        if bucket is MISSING:
+            bucket = TokenBucket(rate, burst)
+        retry_after = bucket.take()
+        self._buckets.set(key, bucket, ttl=burst / rate if rate > 0 else float("inf"))
+        return retry_after
+
+
+# KEYS[1] bucket hash; ARGV rate (tokens/s), burst. Returns {allowed, retry_after}.
+# Uses the Redis clock so workers with skewed clocks share one timeline.
+_TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local retry = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    retry = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return {retry == 0 and 1 or 0, tostring(retry)}
+"""
+
+
+class RedisRateLimitStore:
+    """
+    Per-user buckets shared by every worker, one Redis hash per
+    (user, event) updated atomically by a Lua script. Any Redis error
+    falls back to the in-memory store, so limits degrade to per-process
+    instead of refusing traffic.
+    """
+
+    prefix = "chat:ratelimit"
+
+    def __init__(self, url):
+        self.url = url
+        self._clients = {}
+        self._fallback = InMemoryRateLimitStore()
+
+    def _client(self):
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(id(loop))
+        if client is None:
+            import redis.asyncio
+            client = self._clients[id(loop)] = redis.asyncio.Redis.from_url(self.url, decode_responses=True)
+        return client
+
+    async def take(self, key, rate, burst):
+        try:
+            allowed, retry_after = await self._client().eval(
+                _TAKE_SCRIPT, 1, f"{self.prefix}:{key}", rate, burst
+            )
+        except Exception as e:
+            logger.warning(f"Redis rate limit failed, using in-memory fallback: {type(e).__name__}: {str(e)}")
+            return await self._fallback.take(key, rate, burst)
+        return 0.0 if int(allowed) else float(retry_after)
+
+
+_store = None
+
+
+def get_store():
+    global _store
+    if _store is None:
+        url = getattr(settings, "CHAT_RATE_LIMIT_REDIS_URL", None)
+        _store = RedisRateLimitStore(url) if url else InMemoryRateLimitStore()
+    return _store
+
+
+def reset_store():
+    """Forget all per-user buckets in this process (tests, settings changes)"""
+    global _store
+    _store = None
+
+
+class ConnectionRateLimiter:
+    """
+    Token-bucket limits for one WebSocket connection, per inbound event type.
+
+    CHAT_RATE_LIMITS ({event: (tokens per second, burst)}) is enforced on
+    this connection alone. CHAT_USER_RATE_LIMITS is enforced per user_id
+    over all of the user's connections through the shared store: across
+    workers with CHAT_RATE_LIMIT_REDIS_URL, per process without it. Event
+    types missing from a mapping are not limited by it.
+    """
+
+    def __init__(self, user_id=None):
+        self.user_id = user_id
+        self.limits = getattr(settings, "CHAT_RATE_LIMITS", {})
+        self.user_limits = getattr(settings, "CHAT_USER_RATE_LIMITS", {}) if user_id else {}
+        self._buckets = {}
+        self._limited = set()
+
+    async def check(self, event):
+        """
+        Returns:
+            Limited: if the frame must be refused, else None
+        """
+        retry_after = self._take_local(event)
+        scope = "connection"
+        if not retry_after and event in self.user_limits:
+            rate, burst = self.user_limits[event]
+            retry_after = await get_store().take(f"{self.user_id}:{event}", rate, burst)
+            scope = "user"
+        if not retry_after:
+            self._limited.discard(event)
+            return None
+        metrics.WS_RATE_LIMITED.labels(event=event, scope=scope).inc()
+        notify = event not in self._limited
+        self._limited.add(event)
+        return Limited(retry_after, notify)
+
+    def _take_local(self, event):
+        limit = self.limits.get(event)
+        if limit is None:
+            return 0.0
+        bucket = self._buckets.get(event)
+        if bucket is None:
+            bucket = self._buckets[event] = TokenBucket(*limit)
+        return bucket.take()
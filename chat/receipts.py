@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import weakref
+from collections import Counter
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from .codecs import encode_event
+from .db import db_sync_to_async
+from .membership import get_participants
+from .metrics import timed_group_send
+from .models import Message, UnreadCounter
+
+logger = logging.getLogger(__name__)
+
+
+def ensure_counters(room_id, participants):
+    """Create zeroed unread counters for a new room's participants"""
+    UnreadCounter.objects.bulk_create(
+        [UnreadCounter(room_id=room_id, user_id=user_id) for user_id in set(participants)],
+        ignore_conflicts=True,
+    )
+
+
+def _backfill_counter(room_id, user_id, last_read_id=0):
+    """Create a missing counter (rooms that predate counters) from one COUNT"""
+    unread = Message.objects.filter(room_id=room_id, is_read=False).exclude(sender_id=user_id).count()
+    UnreadCounter.objects.bulk_create(
+        [UnreadCounter(room_id=room_id, user_id=user_id, unread=unread, last_read_id=last_read_id)],
+        ignore_conflicts=True,
+    )
+
+
+def increment_unread(messages):
+    """
+    Bump recipients' unread counters for freshly inserted messages.
+
+    Call inside the transaction that inserted them. One UPDATE is issued
+    per (room, recipient), however many messages the batch holds.
+    """
+    bumps = Counter()
+    for message in messages:
+        for user_id in get_participants(message.room_id) or ():
+            if user_id != message.sender_id:
+                bumps[(message.room_id, user_id)] += 1
+    for (room_id, user_id), count in bumps.items():
+        updated = UnreadCounter.objects.filter(room_id=room_id, user_id=user_id).update(
+            unread=F("unread") + count
+        )
+        if not updated:
+            _backfill_counter(room_id, user_id)
+
+
+def mark_read(room_id, user_id, up_to_id):
+    """
+    Mark every message from the other side up to up_to_id as read.
+
+    One ranged UPDATE on messages and one on the counter, whatever the
+    number of messages covered.
+
+    Returns:
+        int: Number of messages newly marked read
+    """
+    with transaction.atomic():
+        marked = (
+            Message.objects
+            .filter(room_id=room_id, id__lte=up_to_id, is_read=False)
+            .exclude(sender_id=user_id)
+            .update(is_read=True)
+        )
+        updated = UnreadCounter.objects.filter(room_id=room_id, user_id=user_id).update(
+            unread=Greatest(F("unread") - marked, 0),
+            last_read_id=Greatest(F("last_read_id"), up_to_id),
+        )
+        if not updated:
+            _backfill_counter(room_id, user_id, last_read_id=up_to_id)
+    return marked
+
+
+def unread_count(room_id, user_id):
+    return (
+        UnreadCounter.objects
+        .filter(room_id=room_id, user_id=user_id)
+        .values_list("unread", flat=True)
+        .first()
+    ) or 0
+
+
+async def broadcast_receipt(room_group, user_id, up_to_id):
+    await timed_group_send(get_channel_layer(), room_group, encode_event("read.receipt", {
+        "type": "read",
+        "user_id": user_id,
+        "message_id": up_to_id,
+    }, collapse_key=f"read:{user_id}"))
+
+
+class ReadReceiptCoalescer:
+    """
+    Collapse bursts of read events per (room, user).
+
+    The first read event for a key starts a timer; events arriving before
+    it fires only raise the pending high-water mark, so a burst costs one
+    mark_read and one broadcast.
+    """
+
+    def __init__(self, delay=0.5):
+        self.delay = delay
+        self._pending = {}
+        self._tasks = {}
+        self._flush_now = asyncio.Event()
+
+    def submit(self, room_group, room_id, user_id, up_to_id):
+        key = (int(room_id), user_id)
+        self._pending[key] = max(self._pending.get(key, 0), up_to_id)
+        if key not in self._tasks:
+            self._tasks[key] = asyncio.ensure_future(self._flush_later(room_group, key))
+
+    async def _flush_later(self, room_group, key):
+        try:
+            await asyncio.wait_for(self._flush_now.wait(), self.delay)
+        except asyncio.TimeoutError:
+            pass
+        self._tasks.pop(key, None)
+        up_to_id = self._pending.pop(key)
+        room_id, user_id = key
+        try:
+            await db_sync_to_async("mark_read")(mark_read)(room_id, user_id, up_to_id)
+        except Exception as e:
+            logger.error(f"Failed to mark room {room_id} read for {user_id}: {type(e).__name__}: {str(e)}")
+            return
+        await broadcast_receipt(room_group, user_id, up_to_id)
+
+    async def flush(self):
+        """Run every pending flush now"""
+        tasks = list(self._tasks.values())
+        self._flush_now.set()
+        try:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            self._flush_now.clear()
+
+
+_coalescers = weakref.WeakKeyDictionary()
+
+
+def get_coalescer():
+    """Return the ReadReceiptCoalescer for the running event loop"""
+    loop = asyncio.get_running_loop()
+    coalescer = _coalescers.get(loop)
+    if coalescer is None:
+        coalescer = _coalescers[loop] = ReadReceiptCoalescer(
+            delay=getattr(settings, "CHAT_READ_COALESCE_MS", 500) / 1000,
+        )
+    return coalescer
+
+
+async def flush_pending_receipts():
+    """Flush the running loop's coalescer; registered as a lifespan shutdown hook"""
+    coalescer = _coalescers.get(asyncio.get_running_loop())
+    if coalescer is not None:
+        await coalescer.flush()
@@ -0,0 +1,50 @@
+"""
+Async data access for rooms and messages.
+
+The API follows Django's async ORM (aget_*, acreate_*, async iteration),
+but each call is a single hop to the DB thread pool (chat.db) rather than
+one hop per query on asgiref's shared thread, which is where Django 5.2's
+own async ORM methods still run. Writes that need a transaction, like
+sequence assignment in persistence.save_messages, stay in one hop.
+"""
+from django.conf import settings
+from .db import db_sync_to_async
+from .models import Message
+from .persistence import save_messages
+
+
+@db_sync_to_async("create_message")
+def acreate_message(room_id, sender_id, content):
+    """Save one message with its room sequence number and unread counts"""
+    # Callers checked membership, so the room exists; skip the extra lookup
+    return save_messages([Message(room_id=int(room_id), sender_id=sender_id, content=content)])[0]
+
+
+@db_sync_to_async("messages_after")
+def _messages_after_chunk(room_id, after_seq, limit):
+    return list(Message.objects.filter(room_id=int(room_id), seq__gt=after_seq).order_by("seq")[:limit])
+
+
+async def aiter_messages_after(room_id, after_seq, limit=None, chunk_size=None):
+    """
+    Iterate a room's messages with seq > after_seq in seq order, at most limit.
+
+    Fetches chunk_size rows (CHAT_DB_CHUNK_SIZE) per query on the
+    (room, seq) index, so a long replay doesn't hold a pool thread or
+    load every row at once:
+
+        async for message in aiter_messages_after(room_id, last_seq, limit=500):
+            ...
+    """
+    chunk_size = chunk_size or getattr(settings, "CHAT_DB_CHUNK_SIZE", 500)
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = chunk_size if remaining is None else min(chunk_size, remaining)
+        rows = await _messages_after_chunk(room_id, after_seq, size)
+        for row in rows:
+            yield row
+        if len(rows) < size:
+            return
+        after_seq = rows[-1].seq
+        if remaining is not None:
+            remaining -= len(rows)
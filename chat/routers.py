@@ -0,0 +1,197 @@
+import contextlib
+import contextvars
+import logging
+import random
+import threading
+import time
+from django.conf import settings
+from django.db import connections
+from . import metrics
+from .cache import MISSING, RedisTier, TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Alias reads are routed to inside replica_reads(); None means the primary
+_read_alias = contextvars.ContextVar("chat_read_alias", default=None)
+
+# user_id -> True while the user's own recent writes may not have reached the replicas
+_sticky = TTLCache(maxsize=getattr(settings, "DB_STICKY_CACHE_SIZE", 50000))
+_sticky_redis = None
+
+# alias -> (checked at, lag in seconds or None if the replica is unreachable)
+_lags = {}
+# Aliases being measured right now; other callers use the last value meanwhile
+_measuring = set()
+_lags_lock = threading.Lock()
+
+# Seconds a hot standby is behind; 0 when it has replayed everything it received,
+# so an idle primary doesn't make its replicas look stale
+_PG_LAG_SQL = """
+SELECT CASE
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+END
+"""
+
+
+class ReplicaRouter:
+    """
+    Sends reads inside replica_reads() to the replica it picked, and
+    everything else, writes included, to the primary ("default").
+
+    Reads are opt-in rather than routed by default because most reads in
+    this app are part of a write (sequence numbers, get_or_create, unread
+    counters) and must see the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        return _read_alias.get()
+
+    def db_for_write(self, model, **hints):
+        # Explicit, so an instance loaded from a replica is saved to the primary
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        aliases = {"default", *getattr(settings, "DATABASE_REPLICAS", ())}
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+
+@contextlib.contextmanager
+def replica_reads(user_id=None):
+    """
+    Route ORM reads in the block to a replica, when one may serve them.
+
+    The primary is used instead when no replicas are configured, when
+    user_id wrote within DB_REPLICA_STICKY_SECONDS (read-your-writes), or
+    when every replica lags more than DB_REPLICA_MAX_LAG or is down.
+
+    Yields:
+        str: The alias reads go to
+    """
+    alias = choose_alias(user_id)
+    token = _read_alias.set(alias if alias != "default" else None)
+    try:
+        yield alias
+    finally:
+        _read_alias.reset(token)
+
+
+def choose_alias(user_id=None):
+    replicas = getattr(settings, "DATABASE_REPLICAS", ())
+    if not replicas:
+        return "default"
+    if user_id is not None and _is_sticky(str(user_id)):
+        metrics.DB_READ_ROUTES.labels(route="sticky").inc()
+        return "default"
+    max_lag = getattr(settings, "DB_REPLICA_MAX_LAG", 2.0)
+    fresh = [alias for alias in replicas if _within(replica_lag(alias), max_lag)]
+    if not fresh:
+        metrics.DB_READ_ROUTES.labels(route="lagging").inc()
+        return "default"
+    metrics.DB_READ_ROUTES.labels(route="replica").inc()
+    return random.choice(fresh)
+
+
+def _within(lag, max_lag):
+    return lag is not None and lag <= max_lag
+
+
+def replica_lag(alias):
+    """
+    Last measured lag of a replica, re-measured every DB_REPLICA_LAG_CHECK_INTERVAL.
+
+    One caller at a time measures, outside the lock, so a replica that is
+    down (up to DB_REPLICA_CONNECT_TIMEOUT per check) only holds up that
+    caller; the rest get the previous value, or None (use the primary)
+    before the first measurement is in.
+    """
+    interval = getattr(settings, "DB_REPLICA_LAG_CHECK_INTERVAL", 1.0)
+    with _lags_lock:
+        checked = _lags.get(alias)
+        if checked is not None and time.monotonic() - checked[0] < interval:
+            return checked[1]
+        if alias in _measuring:
+            return checked[1] if checked is not None else None
+        _measuring.add(alias)
+    try:
+        lag = measure_lag(alias)
+    finally:
+        with _lags_lock:
+            _measuring.discard(alias)
+    with _lags_lock:
+        _lags[alias] = (time.monotonic(), lag)
+    metrics.DB_REPLICA_LAG_SECONDS.labels(alias=alias).set(float("nan") if lag is None else lag)
+    return lag
+
+
+def measure_lag(alias):
+    """
+    Returns:
+        float: Seconds the replica is behind (0 for engines that can't
+            tell, e.g. SQLite), or None if it can't be queried
+    """
+    connection = connections[alias]
+    try:
+        if connection.vendor != "postgresql":
+            connection.ensure_connection()
+            return 0.0
+        with connection.cursor() as cursor:
+            cursor.execute(_PG_LAG_SQL)
+            row = cursor.fetchone()
+        return float(row[0] or 0)
+    except Exception as e:
+        logger.warning(f"Replica {alias} lag check failed: {type(e).__name__}: {str(e)}")
+        # Don't leave a broken connection on this thread for the next read
+        connection.close()
+        return None
+
+
+def _sticky_ttl():
+    return getattr(settings, "DB_REPLICA_STICKY_SECONDS", 5.0)
+
+
+def _get_sticky_redis():
+    """Return the shared Redis tier if DB_STICKY_REDIS_URL is set, so stickiness spans workers"""
+    global _sticky_redis
+    url = getattr(settings, "DB_STICKY_REDIS_URL", None)
+    if not url:
+        return None
+    if _sticky_redis is None or _sticky_redis.url != url:
+        _sticky_redis = RedisTier(url, prefix="chat:sticky")
+    return _sticky_redis
+
+
+def _is_sticky(user_id):
+    if user_id in _sticky:
+        return True
+    redis_tier = _get_sticky_redis()
+    return redis_tier is not None and redis_tier.get(user_id) is not MISSING
+
+
+def note_write(user_id):
+    """Read user_id's history from the primary for the next DB_REPLICA_STICKY_SECONDS"""
+    if not getattr(settings, "DATABASE_REPLICAS", ()):
+        return
+    _sticky.set(str(user_id), True, _sticky_ttl())
+    redis_tier = _get_sticky_redis()
+    if redis_tier is not None:
+        redis_tier.set(str(user_id), True, _sticky_ttl())
+
+
+async def anote_write(user_id):
+    """Async note_write, for consumers"""
+    if not getattr(settings, "DATABASE_REPLICAS", ()):
+        return
+    _sticky.set(str(user_id), True, _sticky_ttl())
+    redis_tier = _get_sticky_redis()
+    if redis_tier is not None:
+        await redis_tier.aset(str(user_id), True, _sticky_ttl())
+
+
+def reset():
+    """Forget stickiness and measured lag in this process (tests, settings changes)"""
+    _sticky.clear()
+    with _lags_lock:
+        _lags.clear()
@@ -0,0 +1,161 @@
+import html
+import re
+from django.db import connection
+from django.db.models import BooleanField, F, FloatField, Q, TextField, Value
+from django.db.models.expressions import RawSQL
+from .models import Message
+from .pagination import decode_score_cursor, encode_score_cursor
+
+# Must match the text search configuration of the generated column in
+# migration 0004, or PostgreSQL can't use the GIN index
+SEARCH_CONFIG = "english"
+
+# The database marks matches with these private-use characters; the excerpt
+# is HTML-escaped afterwards and only then are they turned into <mark> tags,
+# so message content can never inject markup
+HIGHLIGHT_START = "\ue000"
+HIGHLIGHT_STOP = "\ue001"
+
+MAX_QUERY_LENGTH = 256
+
+_TABLE = Message._meta.db_table
+_FTS_TABLE = f"{_TABLE}_fts"
+
+
+def render_highlight(excerpt):
+    """HTML-escape a raw excerpt and wrap its marked terms in <mark>"""
+    if excerpt is None:
+        return None
+    escaped = html.escape(excerpt)
+    return escaped.replace(HIGHLIGHT_START, "<mark>").replace(HIGHLIGHT_STOP, "</mark>")
+
+
+def _fts5_query(query):
+    """Quote every word so user input can't use (or break on) FTS5 query syntax"""
+    return " ".join(f'"{word}"' for word in re.findall(r"\w+", query))
+
+
+class PostgresSearch:
+    """tsvector column with a GIN index, queried with websearch_to_tsquery"""
+
+    tsquery = f"websearch_to_tsquery('{SEARCH_CONFIG}', %s)"
+
+    def matches(self, qs, query):
+        return qs.filter(
+            RawSQL(f"{_TABLE}.search_vector @@ {self.tsquery}", [query], output_field=BooleanField())
+        ).annotate(
+            rank=RawSQL(f"ts_rank_cd({_TABLE}.search_vector, {self.tsquery})", [query], output_field=FloatField())
+        )
+
+    def highlight(self, qs, query):
+        options = f"StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_STOP}, MaxFragments=2"
+        return qs.annotate(highlight=RawSQL(
+            f"ts_headline('{SEARCH_CONFIG}', {_TABLE}.content, {self.tsquery}, %s)",
+            [query, options],
+            output_field=TextField(),
+        ))
+
+
+class SQLiteSearch:
+    """
+    External-content FTS5 table, for local and test setups.
+
+    Kept current by triggers on chat_message that SQLite drops whenever a
+    migration rebuilds the table; see migrations/0004_message_search.py.
+    """
+
+    def matches(self, qs, query):
+        query = _fts5_query(query)
+        # bm25() is lower for better matches; negate it so rank sorts like PostgreSQL's
+        return qs.filter(
+            RawSQL(
+                f"{_TABLE}.id IN (SELECT rowid FROM {_FTS_TABLE} WHERE {_FTS_TABLE} MATCH %s)",
+                [query],
+                output_field=BooleanField(),
+            )
+        ).annotate(rank=RawSQL(
+            f"(SELECT -bm25({_FTS_TABLE}) FROM {_FTS_TABLE} "
+            f"WHERE {_FTS_TABLE} MATCH %s AND rowid = {_TABLE}.id)",
+            [query],
+            output_field=FloatField(),
+        ))
+
+    def highlight(self, qs, query):
+        return qs.annotate(highlight=RawSQL(
+            f"(SELECT snippet({_FTS_TABLE}, 0, %s, %s, '…', 32) FROM {_FTS_TABLE} "
+            f"WHERE {_FTS_TABLE} MATCH %s AND rowid = {_TABLE}.id)",
+            [HIGHLIGHT_START, HIGHLIGHT_STOP, _fts5_query(query)],
+            output_field=TextField(),
+        ))
+
+
+class SubstringSearch:
+    """Unindexed last resort for other databases; every hit ranks the same"""
+
+    def matches(self, qs, query):
+        return qs.filter(content__icontains=query).annotate(rank=Value(0.0, output_field=FloatField()))
+
+    def highlight(self, qs, query):
+        return qs.annotate(highlight=F("content"))
+
+
+_BACKENDS = {
+    "postgresql": PostgresSearch,
+    "sqlite": SQLiteSearch,
+}
+
+
+def get_backend():
+    return _BACKENDS.get(connection.vendor, SubstringSearch)()
+
+
+def search_messages(user_id, query, limit, after=None, room_id=None):
+    """
+    Full-text search over the messages of the rooms user_id takes part in.
+
+    Args:
+        user_id: Caller; only rooms where they are participant_a or participant_b are searched
+        query: Free-text query, e.g. 'budget "next week"'
+        limit: Maximum number of hits to return
+        after: Cursor from a previous call's next cursor
+        room_id: Optionally restrict the search to one room
+
+    Returns:
+        tuple: (Message list, best match first, each with .rank and .highlight; next cursor or None)
+
+    The matching set and ranking come from the index; highlights are built
+    only for the page that is returned.
+    """
+    query = query.strip()
+    if not query:
+        raise ValueError("q is required")
+    if len(query) > MAX_QUERY_LENGTH:
+        raise ValueError(f"q must be at most {MAX_QUERY_LENGTH} characters")
+
+    backend = get_backend()
+    qs = Message.objects.filter(Q(room__participant_a=user_id) | Q(room__participant_b=user_id))
+    if room_id is not None:
+        qs = qs.filter(room_id=room_id)
+    qs = backend.matches(qs, query)
+    if after:
+        rank, pk = decode_score_cursor(after)
+        qs = qs.filter(Q(rank__lt=rank) | Q(rank=rank, id__lt=pk))
+
+    page = list(qs.order_by("-rank", "-id").values_list("id", "rank")[:limit + 1])
+    has_more = len(page) > limit
+    page = page[:limit]
+    if not page:
+        return [], None
+
+    ranks = dict(page)
+    hits = {m.id: m for m in backend.highlight(Message.objects.filter(id__in=ranks), query)}
+    results = []
+    for pk, rank in page:
+        message = hits.get(pk)
+        if message is None:  # deleted since the page was read
+            continue
+        message.rank = rank
+        message.highlight = render_highlight(message.highlight)
+        results.append(message)
+    last_pk, last_rank = page[-1]
+    return results, encode_score_cursor(last_rank, last_pk) if has_more else None
@@ -10,5 +10,34 @@ class ChatRoomSerializer(serializers.ModelSerializer):
 class MessageSerializer(serializers.ModelSerializer):
     class Meta:
         model = Message
-        fields = ["id", "room", "sender_id", "content", "timestamp", "is_read"]
-        read_only_fields = ["id", "timestamp"]
+        fields = ["id", "room", "sender_id", "content", "timestamp", "is_read", "seq"]
+        read_only_fields = ["id", "timestamp", "seq"]
+
+class SearchHitSerializer(serializers.ModelSerializer):
+    """A search hit; expects the rank and highlight set by search.search_messages"""
+    rank = serializers.FloatField(read_only=True)
+    highlight = serializers.CharField(read_only=True, help_text="HTML-escaped matching excerpt with terms wrapped in <mark>")
+
+    class Meta:
+        model = Message
+        fields = ["id", "room", "sender_id", "content", "timestamp", "seq", "rank", "highlight"]
+
+class InboxRoomSerializer(serializers.ModelSerializer):
+    """A room as listed in a user's inbox; expects the annotations from the inbox query"""
+    last_message = serializers.SerializerMethodField()
+    unread = serializers.IntegerField(read_only=True)
+    last_activity = serializers.DateTimeField(read_only=True)
+
+    class Meta:
+        model = ChatRoom
+        fields = ["id", "participant_a", "participant_b", "created_at", "last_activity", "last_message", "unread"]
+
+    def get_last_message(self, room):
+        if room.last_message_id is None:
+            return None
+        return {
+            "id": room.last_message_id,
+            "sender_id": room.last_message_sender_id,
+            "content": room.last_message_content,
+            "timestamp": serializers.DateTimeField().to_representation(room.last_message_timestamp),
+        }
@@ -1,8 +1,1646 @@
 
-from django.test import TestCase
+import asyncio
+import contextlib
+import httpx
+from asgiref.sync import async_to_sync
+from django.test import TestCase, TransactionTestCase, override_settings
+from . import auth_client
 from .models import ChatRoom
 
 class ChatModelsTest(TestCase):
     def test_create_room(self):
         r = ChatRoom.objects.create(participant_a="1", participant_b="2")
         self.assertEqual(str(r), "1<->2")
+
+
+class RoomMessagesPaginationTest(TestCase):
+    def setUp(self):
+        from .models import Message
+        self.room = ChatRoom.objects.create(participant_a="1", participant_b="2")
+        self.messages = [
+            Message.objects.create(room=self.room, sender_id="1", content=f"m{i}")
+            for i in range(7)
+        ]
+        self.url = f"/api/chat/rooms/{self.room.id}/messages/"
+
+    def test_default_page_is_newest(self):
+        resp = self.client.get(self.url, {"limit": 3})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([m["content"] for m in resp.data["results"]], ["m4", "m5", "m6"])
+        self.assertIsNotNone(resp.data["prev"])
+        self.assertIsNone(resp.data["next"])
+
+    def test_walk_backwards_and_forwards(self):
+        first = self.client.get(self.url, {"limit": 3}).data
+        older = self.client.get(self.url, {"limit": 3, "before": first["prev"]}).data
+        self.assertEqual([m["content"] for m in older["results"]], ["m1", "m2", "m3"])
+        oldest = self.client.get(self.url, {"limit": 3, "before": older["prev"]}).data
+        self.assertEqual([m["content"] for m in oldest["results"]], ["m0"])
+        self.assertIsNone(oldest["prev"])
+        newer = self.client.get(self.url, {"limit": 3, "after": oldest["next"]}).data
+        self.assertEqual([m["content"] for m in newer["results"]], ["m1", "m2", "m3"])
+
+    def test_limit_is_capped_and_validated(self):
+        with self.settings(CHAT_MAX_PAGE_SIZE=5):
+            resp = self.client.get(self.url, {"limit": 1000})
+        self.assertEqual(len(resp.data["results"]), 5)
+        self.assertEqual(self.client.get(self.url, {"limit": "abc"}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {"before": "not-a-cursor"}).status_code, 400)
+
+
+class SharedAuthClientTest(TestCase):
+    def setUp(self):
+        auth_client.clear_profile_cache()
+
+    def tearDown(self):
+        auth_client.close_sync_client()
+
+    def test_sync_client_is_reused(self):
+        client = auth_client.get_sync_client()
+        self.assertIs(client, auth_client.get_sync_client())
+        auth_client.close_sync_client()
+        self.assertTrue(client.is_closed)
+        self.assertIsNot(client, auth_client.get_sync_client())
+
+    def test_fetch_profile_sync_uses_shared_client(self):
+        calls = []
+
+        def handler(request):
+            calls.append(request)
+            return httpx.Response(200, json={"id": 1, "username": "a"})
+
+        auth_client._sync_client = httpx.Client(transport=httpx.MockTransport(handler))
+        self.assertEqual(auth_client.fetch_profile_sync("tok")["id"], 1)
+        self.assertEqual(auth_client.fetch_profile_sync("tok2")["id"], 1)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(calls[0].headers["authorization"], "Bearer tok")
+
+    def test_lifespan_shutdown_closes_clients(self):
+        from .lifespan import lifespan_app, on_shutdown, _shutdown_hooks
+
+        client = auth_client.get_sync_client()
+        on_shutdown(auth_client.aclose_clients)
+        messages = iter([{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}])
+        sent = []
+
+        async def receive():
+            return next(messages)
+
+        async def send(message):
+            sent.append(message["type"])
+
+        try:
+            async_to_sync(lifespan_app)({"type": "lifespan"}, receive, send)
+        finally:
+            _shutdown_hooks.remove(auth_client.aclose_clients)
+        self.assertEqual(sent, ["lifespan.startup.complete", "lifespan.shutdown.complete"])
+        self.assertTrue(client.is_closed)
+
+    def test_exit_closes_clients_without_lifespan(self):
+        import asyncio
+
+        async def get_async_client():
+            return auth_client.get_async_client()
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        async_client = loop.run_until_complete(get_async_client())
+        sync_client = auth_client.get_sync_client()
+        auth_client._close_clients()
+        self.assertTrue(sync_client.is_closed)
+        self.assertTrue(async_client.is_closed)
+
+
+class ProfileCacheTest(TestCase):
+    def setUp(self):
+        auth_client.clear_profile_cache()
+        self.calls = []
+
+    def tearDown(self):
+        auth_client.clear_profile_cache()
+        auth_client.close_sync_client()
+
+    def _mock(self, status=200):
+        def handler(request):
+            self.calls.append(request)
+            return httpx.Response(status, json={"id": 7})
+        return httpx.MockTransport(handler)
+
+    def test_sync_lookups_are_cached(self):
+        auth_client._sync_client = httpx.Client(transport=self._mock())
+        for _ in range(3):
+            self.assertEqual(auth_client.fetch_profile_sync("tok")["id"], 7)
+        self.assertEqual(len(self.calls), 1)
+
+    def test_failures_are_cached_briefly(self):
+        auth_client._sync_client = httpx.Client(transport=self._mock(status=401))
+        self.assertIsNone(auth_client.fetch_profile_sync("bad"))
+        self.assertIsNone(auth_client.fetch_profile_sync("bad"))
+        self.assertEqual(len(self.calls), 1)
+        with self.settings(AUTH_PROFILE_NEGATIVE_TTL=0):
+            auth_client.clear_profile_cache()
+            auth_client.fetch_profile_sync("bad")
+            auth_client.fetch_profile_sync("bad")
+        self.assertEqual(len(self.calls), 3)
+
+    def test_ttl_is_bounded_by_token_exp(self):
+        import time
+        import jwt
+        expired = jwt.encode({"exp": int(time.time()) - 10}, "k", algorithm="HS256")
+        fresh = jwt.encode({"exp": int(time.time()) + 3600}, "k", algorithm="HS256")
+        self.assertLessEqual(auth_client._profile_ttl(expired, {"id": 1}), 0)
+        with self.settings(AUTH_PROFILE_CACHE_TTL=60):
+            self.assertEqual(auth_client._profile_ttl(fresh, {"id": 1}), 60)
+
+    def test_concurrent_async_misses_share_one_request(self):
+        import asyncio
+
+        async def slow_request(token):
+            self.calls.append(token)
+            await asyncio.sleep(0.01)
+            return {"id": 9}
+
+        async def run():
+            return await asyncio.gather(*[auth_client.fetch_profile_async("tok") for _ in range(5)])
+
+        original = auth_client._request_profile_async
+        auth_client._request_profile_async = slow_request
+        try:
+            results = async_to_sync(run)()
+        finally:
+            auth_client._request_profile_async = original
+        self.assertEqual([r["id"] for r in results], [9] * 5)
+        self.assertEqual(len(self.calls), 1)
+
+    def test_cancelled_first_caller_doesnt_cancel_the_others(self):
+        import asyncio
+        from .cache import AsyncSingleFlight
+        flight = AsyncSingleFlight()
+
+        async def slow_lookup():
+            self.calls.append("lookup")
+            await asyncio.sleep(0.05)
+            return {"id": 9}
+
+        async def run():
+            first = asyncio.ensure_future(asyncio.wait_for(flight.do("tok", slow_lookup), 0.01))
+            await asyncio.sleep(0)
+            second = asyncio.ensure_future(flight.do("tok", slow_lookup))
+            with self.assertRaises(asyncio.TimeoutError):
+                await first
+            return await second
+
+        self.assertEqual(async_to_sync(run)(), {"id": 9})
+        self.assertEqual(self.calls, ["lookup"])
+
+
+def mock_auth_service(test, handler):
+    """Send both shared auth clients to handler; async clients are built per event loop, so patch their factory"""
+    from unittest import mock
+    auth_client._sync_client = httpx.Client(transport=httpx.MockTransport(handler))
+    patcher = mock.patch.object(
+        auth_client, "_client_kwargs", lambda asynchronous=False: {"transport": httpx.MockTransport(handler)}
+    )
+    patcher.start()
+    test.addCleanup(patcher.stop)
+
+
+class VerifyUsersExistTest(TransactionTestCase):
+    def setUp(self):
+        auth_client.clear_profile_cache()
+        auth_client.clear_known_users()
+        self.paths = []
+
+    def tearDown(self):
+        auth_client.clear_profile_cache()
+        auth_client.clear_known_users()
+        auth_client.close_sync_client()
+
+    def _install(self, missing=()):
+        def handler(request):
+            self.paths.append(request.url.path)
+            if request.url.path.endswith("/profile/"):
+                return httpx.Response(200, json={"id": 1})
+            if request.url.path.endswith("/bulk/"):
+                ids = request.url.params["ids"].split(",")
+                return httpx.Response(200, json=[{"id": i} for i in ids if i not in missing])
+            user_id = request.url.path.rstrip("/").rsplit("/", 1)[-1]
+            return httpx.Response(404 if user_id in missing else 200, json={"id": user_id})
+        mock_auth_service(self, handler)
+
+    def test_known_users_skip_the_auth_service(self):
+        self._install()
+        self.assertTrue(auth_client.verify_users_exist(["1", "2", "3"], "tok"))
+        self.assertEqual(len(self.paths), 3)
+        self.assertTrue(auth_client.verify_users_exist(["2", "1"], "tok"))
+        self.assertEqual(len(self.paths), 3)
+
+    def test_missing_user_fails_and_is_not_cached(self):
+        self._install(missing={"2"})
+        self.assertFalse(auth_client.verify_users_exist(["1", "2"], "tok"))
+        self.assertFalse(auth_client.verify_users_exist(["2"], "tok"))
+        self.assertEqual(self.paths.count("/api/users/2/"), 2)
+
+    def test_bulk_endpoint_is_one_call(self):
+        self._install(missing={"3"})
+        with self.settings(AUTH_BULK_USERS_ENDPOINT="api/users/bulk/"):
+            self.assertTrue(auth_client.verify_users_exist(["1", "2"], "tok"))
+            self.assertFalse(auth_client.verify_users_exist(["1", "3"], "tok"))
+        self.assertEqual(self.paths, ["/api/users/bulk/", "/api/users/bulk/"])
+
+    def test_room_creation_between_known_users_needs_no_verify_call(self):
+        self._install()
+        body = {"participant_a": "1", "participant_b": "2"}
+        headers = {"HTTP_AUTHORIZATION": f"Bearer {make_token(1)}"}
+        resp = self.client.post("/api/chat/rooms/", body, **headers)
+        self.assertEqual(resp.status_code, 201)
+        self.assertCountEqual(self.paths, ["/api/users/profile/", "/api/users/2/"])
+        resp = self.client.post("/api/chat/rooms/", body, **headers)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(self.paths), 2)
+
+
+class JwtAuthMiddlewareTest(TestCase):
+    def setUp(self):
+        from . import middleware
+        middleware._payload_cache.clear()
+        self.seen = []
+
+        async def inner(scope, receive, send):
+            self.seen.append(scope["auth_user"])
+
+        self.app = middleware.JwtAuthMiddleware(inner)
+
+    def _call(self, token):
+        scope = {"type": "websocket", "query_string": f"token={token}".encode(), "headers": []}
+        async_to_sync(self.app)(scope, None, None)
+        return self.seen[-1]
+
+    def test_valid_token_is_decoded_and_cached(self):
+        import time
+        import jwt
+        from django.conf import settings
+        from . import middleware
+        token = jwt.encode({"user_id": 5, "exp": int(time.time()) + 60}, settings.JWT_SECRET, algorithm="HS256")
+        self.assertEqual(self._call(token)["user_id"], "5")
+        self.assertEqual(len(middleware._payload_cache), 1)
+        self.assertEqual(self._call(token)["user_id"], "5")
+
+    def test_invalid_and_expired_tokens_are_rejected(self):
+        import time
+        import jwt
+        from django.conf import settings
+        expired = jwt.encode({"user_id": 5, "exp": int(time.time()) - 1}, settings.JWT_SECRET, algorithm="HS256")
+        forged = jwt.encode({"user_id": 5}, "wrong-secret", algorithm="HS256")
+        self.assertIsNone(self._call(expired))
+        self.assertIsNone(self._call(forged))
+
+
+class RoomMembershipCacheTest(TestCase):
+    def setUp(self):
+        from . import membership
+        membership.clear_room_cache()
+        self.membership = membership
+
+    def test_participants_are_cached_after_one_query(self):
+        room = ChatRoom.objects.create(participant_a="1", participant_b="2")
+        with self.assertNumQueries(1):
+            self.assertEqual(self.membership.get_participants(room.id), ("1", "2"))
+            self.assertEqual(self.membership.get_participants(str(room.id)), ("1", "2"))
+
+    def test_missing_rooms_are_negatively_cached(self):
+        with self.assertNumQueries(1):
+            self.assertIsNone(self.membership.get_participants(999))
+            self.assertIsNone(self.membership.get_participants(999))
+        with self.settings(ROOM_NEGATIVE_CACHE_TTL=0):
+            self.membership.clear_room_cache()
+            with self.assertNumQueries(2):
+                self.membership.get_participants(999)
+                self.membership.get_participants(999)
+
+    def test_remembered_room_needs_no_query(self):
+        self.membership.remember_room(42, "1", "2")
+        with self.assertNumQueries(0):
+            self.assertEqual(async_to_sync(self.membership.aget_participants)("42"), ("1", "2"))
+
+
+IN_MEMORY_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
+
+def make_token(user_id):
+    import jwt
+    from django.conf import settings
+    return jwt.encode({"user_id": user_id}, settings.JWT_SECRET, algorithm="HS256")
+
+
+def ws_application():
+    from channels.routing import URLRouter
+    from .middleware import JwtAuthMiddlewareStack
+    from .routing import websocket_urlpatterns
+    return JwtAuthMiddlewareStack(URLRouter(websocket_urlpatterns))
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, CHAT_WRITE_BEHIND=True,
+                   CHAT_WRITE_BEHIND_BATCH_SIZE=10, CHAT_WRITE_BEHIND_FLUSH_MS=50)
+class WriteBehindPersistenceTest(TransactionTestCase):
+    def setUp(self):
+        from . import membership, presence
+        membership.clear_room_cache()
+        presence.reset_store()
+        self.room = ChatRoom.objects.create(participant_a="1", participant_b="2")
+
+    def test_writer_batches_inserts(self):
+        from . import persistence
+        from .models import Message
+        batches = []
+        original = persistence.save_messages
+
+        def recording_save(messages):
+            batches.append(len(messages))
+            return original(messages)
+
+        async def run():
+            writer = persistence.MessageWriter(batch_size=10, flush_interval=0.05)
+            futures = [
+                writer.submit(Message(room_id=self.room.id, sender_id="1", content=f"m{i}"))
+                for i in range(25)
+            ]
+            return await asyncio.gather(*futures)
+
+        persistence.save_messages = recording_save
+        try:
+            saved = async_to_sync(run)()
+        finally:
+            persistence.save_messages = original
+        self.assertEqual(batches, [10, 10, 5])
+        self.assertTrue(all(m.id for m in saved))
+        self.assertEqual(Message.objects.filter(room=self.room).count(), 25)
+
+    def test_failed_batch_is_retried_and_drain_saves_pending(self):
+        from unittest import mock
+        from . import persistence
+        from .models import Message
+        original = persistence.save_messages
+        failures = [RuntimeError("db restarting")]
+
+        def flaky_save(messages):
+            if failures:
+                raise failures.pop()
+            return original(messages)
+
+        async def run():
+            writer = persistence.MessageWriter(batch_size=10, flush_interval=0.01, retry_delay=0.01)
+            saved = await writer.submit(Message(room_id=self.room.id, sender_id="1", content="retried"))
+            # Never flushed by the loop: left for the exit-time drain
+            writer._pending.append((Message(room_id=self.room.id, sender_id="1", content="drained"), None))
+            return saved, writer
+
+        with mock.patch.object(persistence, "save_messages", flaky_save):
+            saved, writer = async_to_sync(run)()
+        self.assertEqual(saved.content, "retried")
+        writer.drain()
+        self.assertEqual(
+            list(Message.objects.filter(room=self.room).order_by("seq").values_list("content", flat=True)),
+            ["retried", "drained"],
+        )
+
+    def test_broadcast_then_ack_after_flush(self):
+        from channels.testing import WebsocketCommunicator
+        from .models import Message
+
+        async def receive_until_ack(communicator):
+            frames = []
+            while not frames or frames[-1].get("type") != "ack":
+                frames.append(await communicator.receive_json_from(timeout=2))
+            return frames
+
+        async def run():
+            sender = WebsocketCommunicator(ws_application(), f"/ws/chat/{self.room.id}/?token={make_token(1)}")
+            other = WebsocketCommunicator(ws_application(), f"/ws/chat/{self.room.id}/?token={make_token(2)}")
+            self.assertTrue((await sender.connect())[0])
+            self.assertTrue((await other.connect())[0])
+            await sender.send_json_to({"type": "message", "content": "hi"})
+            frames = await receive_until_ack(sender)
+            received = await receive_until_ack(other)
+            await sender.disconnect()
+            await other.disconnect()
+            return frames, received
+
+        frames, received = async_to_sync(run)()
+        broadcast = next(f for f in frames if f.get("content") == "hi")
+        ack = frames[-1]
+        self.assertIsNone(broadcast["seq"])  # assigned when the batch commits
+        self.assertEqual(next(f for f in received if f.get("content") == "hi")["uid"], broadcast["uid"])
+        self.assertEqual((ack["uid"], ack["seq"]), (broadcast["uid"], 1))
+        self.assertEqual(received[-1], ack)  # the whole room learns id and seq
+        self.assertEqual(Message.objects.get(id=ack["id"]).content, "hi")
+        self.assertEqual(Message.objects.get(id=ack["id"]).seq, 1)
+        self.assertEqual(ChatRoom.objects.get(id=self.room.id).last_seq, 1)
+
+    @override_settings(CHAT_WRITE_BEHIND_FLUSH_MS=60000)
+    def test_resume_includes_messages_still_pending(self):
+        from channels.testing import WebsocketCommunicator
+        from .persistence import get_writer
+
+        async def run():
+            sender = WebsocketCommunicator(ws_application(), f"/ws/chat/{self.room.id}/?token={make_token(2)}")
+            self.assertTrue((await sender.connect())[0])
+            await sender.send_json_to({"type": "message", "content": "queued"})
+            frame = await sender.receive_json_from()
+            while frame.get("content") != "queued":
+                frame = await sender.receive_json_from()
+            pending = len(get_writer()._pending)
+            path = f"/ws/chat/{self.room.id}/?token={make_token(1)}&last_seq=0"
+            resumed = WebsocketCommunicator(ws_application(), path)
+            self.assertTrue((await resumed.connect())[0])
+            frame = await resumed.receive_json_from()
+            while frame.get("type") != "resume":
+                frame = await resumed.receive_json_from()
+            await resumed.disconnect()
+            await sender.disconnect()
+            return pending, frame
+
+        pending, frame = async_to_sync(run)()
+        self.assertEqual(pending, 1)
+        self.assertEqual([m["content"] for m in frame["messages"]], ["queued"])
+
+
+class TypingThrottleTest(TestCase):
+    def _run(self, scenario, **kwargs):
+        from .typing_indicator import TypingThrottle
+        sent = []
+
+        async def emit(is_typing):
+            sent.append(is_typing)
+
+        async def run():
+            throttle = TypingThrottle(emit, **kwargs)
+            await scenario(throttle)
+            await throttle.close()
+
+        async_to_sync(run)()
+        return sent
+
+    def test_duplicates_are_dropped(self):
+        async def scenario(throttle):
+            for _ in range(5):
+                await throttle.update(True)
+
+        self.assertEqual(self._run(scenario, interval=0, idle_timeout=0), [True, False])
+
+    def test_updates_are_throttled_to_latest_value(self):
+        async def scenario(throttle):
+            await throttle.update(True)
+            await throttle.update(False)
+            await throttle.update(True)
+            await throttle.update(False)
+            await asyncio.sleep(0.08)
+
+        self.assertEqual(self._run(scenario, interval=0.05, idle_timeout=0), [True, False])
+
+    def test_idle_typing_is_stopped(self):
+        from .typing_indicator import typing_counters
+        before = typing_counters["auto_stopped"]
+
+        async def scenario(throttle):
+            await throttle.update(True)
+            await asyncio.sleep(0.05)
+            self.assertFalse(throttle.state)
+
+        self.assertEqual(self._run(scenario, interval=0, idle_timeout=0.02), [True, False])
+        self.assertEqual(typing_counters["auto_stopped"], before + 1)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, PRESENCE_OFFLINE_GRACE=0.05)
+class PresenceTest(TransactionTestCase):
+    def setUp(self):
+        from . import membership, presence
+        membership.clear_room_cache()
+        presence.reset_store()
+        self.room = ChatRoom.objects.create(participant_a="1", participant_b="2")
+        self.path = f"/ws/chat/{self.room.id}/?token="
+
+    async def _drain(self, communicator):
+        frames = []
+        while not await communicator.receive_nothing(timeout=0.1):
+            frames.append(await communicator.receive_json_from())
+        return frames
+
+    def test_second_tab_and_quick_reconnect_publish_nothing(self):
+        from channels.testing import WebsocketCommunicator
+
+        async def run():
+            watcher = WebsocketCommunicator(ws_application(), self.path + make_token(2))
+            await watcher.connect()
+            await self._drain(watcher)
+            tab1 = WebsocketCommunicator(ws_application(), self.path + make_token(1))
+            tab2 = WebsocketCommunicator(ws_application(), self.path + make_token(1))
+            await tab1.connect()
+            await tab2.connect()
+            seen = await self._drain(watcher)
+            await tab1.disconnect()
+            seen += await self._drain(watcher)
+            await tab2.disconnect()
+            tab3 = WebsocketCommunicator(ws_application(), self.path + make_token(1))
+            await tab3.connect()
+            seen += await self._drain(watcher)
+            await tab3.disconnect()
+            await asyncio.sleep(0.1)
+            seen += await self._drain(watcher)
+            await watcher.disconnect()
+            return seen
+
+        seen = async_to_sync(run)()
+        statuses = [f["status"] for f in seen if f.get("type") == "presence" and f["user_id"] == "1"]
+        self.assertEqual(statuses, ["online", "offline"])
+
+    def test_joiner_gets_snapshot(self):
+        from channels.testing import WebsocketCommunicator
+
+        async def run():
+            first = WebsocketCommunicator(ws_application(), self.path + make_token(2))
+            await first.connect()
+            second = WebsocketCommunicator(ws_application(), self.path + make_token(1))
+            await second.connect()
+            frames = await self._drain(second)
+            await first.disconnect()
+            await second.disconnect()
+            return frames
+
+        frames = async_to_sync(run)()
+        snapshot = next(f for f in frames if f["type"] == "presence_snapshot")
+        self.assertEqual(snapshot["users"], {"1": "online", "2": "online"})
+
+
+    @override_settings(PRESENCE_OFFLINE_GRACE=0)
+    def test_offline_users_leave_no_status_behind(self):
+        from . import presence
+
+        async def run():
+            await presence.connect("chat_1", "1")
+            await presence.disconnect("chat_1", "1")
+            return presence.get_store()._status
+
+        self.assertEqual(async_to_sync(run)(), {})
+
+    def test_presence_announcements_are_own_user_only(self):
+        from channels.testing import WebsocketCommunicator
+        from . import presence
+
+        async def run():
+            client = WebsocketCommunicator(ws_application(), f"/ws/presence/?token={make_token(1)}")
+            await client.connect()
+            await client.send_json_to({"action": "status", "user_id": "2", "status": "online"})
+            refused = await client.receive_json_from()
+            await client.send_json_to({"action": "status", "status": "away"})
+            announced = await client.receive_json_from()
+            await client.disconnect()
+            return refused, announced, dict(presence.get_store()._status)
+
+        refused, announced, status = async_to_sync(run)()
+        self.assertEqual(refused["type"], "error")
+        self.assertEqual((announced["user_id"], announced["status"]), ("1", "away"))
+        self.assertEqual(status, {})  # the announcement went with the connection
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class MsgpackSubprotocolTest(TransactionTestCase):
+    def setUp(self):
+        from . import membership, presence
+        membership.clear_room_cache()
+        presence.reset_store()
+        self.room = ChatRoom.objects.create(participant_a="1", participant_b="2")
+
+    def test_msgpack_round_trip(self):
+        import msgpack
+        from channels.testing import WebsocketCommunicator
+
+        async def run():
+            path = f"/ws/chat/{self.room.id}/?token={make_token(1)}"
+            binary = WebsocketCommunicator(ws_application(), path, subprotocols=["msgpack"])
+            text = WebsocketCommunicator(ws_application(), f"/ws/chat/{self.room.id}/?token={make_token(2)}")
+            connected, subprotocol = await binary.connect()
+            await text.connect()
+            await binary.send_to(bytes_data=msgpack.packb({"type": "message", "content": "hola"}))
+            binary_frames, text_frames = [], []
+            while not await binary.receive_nothing(timeout=0.2):
+                binary_frames.append(msgpack.unpackb(await binary.receive_from(), raw=False))
+            while not await text.receive_nothing(timeout=0.1):
+                text_frames.append(await text.receive_json_from())
+            await binary.disconnect()
+            await text.disconnect()
+            return subprotocol, binary_frames, text_frames
+
+        subprotocol, binary_frames, text_frames = async_to_sync(run)()
+        self.assertEqual(subprotocol, "msgpack")
+        self.assertIn("hola", [f.get("content") for f in binary_frames])
+        self.assertIn("hola", [f.get("content") for f in text_frames])
+
+
+class ReadReceiptsTest(TestCase):
+    def setUp(self):
+        from . import membership
+        from .models import Message
+        from .persistence import save_messages
+        from .receipts import ensure_counters
+        membership.clear_room_cache()
+        auth_client.clear_profile_cache()
+        self.room = ChatRoom.objects.create(participant_a="1", participant_b="2")
+        ensure_counters(self.room.id, ("1", "2"))
+        self.messages = save_messages([
+            Message(room=self.room, sender_id=sender, content=str(i))
+            for i, sender in enumerate(["1", "1", "2", "1"])
+        ])
+
+    def tearDown(self):
+        auth_client.clear_profile_cache()
+        auth_client.close_sync_client()
+
+    def test_counters_follow_inserts(self):
+        from .receipts import unread_count
+        self.assertEqual(unread_count(self.room.id, "2"), 3)
+        self.assertEqual(unread_count(self.room.id, "1"), 1)
+
+    def test_mark_read_is_ranged_and_idempotent(self):
+        from .models import Message, UnreadCounter
+        from .receipts import mark_read
+        self.assertEqual(mark_read(self.room.id, "2", self.messages[2].id), 2)
+        self.assertEqual(mark_read(self.room.id, "2", self.messages[2].id), 0)
+        counter = UnreadCounter.objects.get(room=self.room, user_id="2")
+        self.assertEqual((counter.unread, counter.last_read_id), (1, self.messages[2].id))
+        self.assertFalse(Message.objects.get(id=self.messages[2].id).is_read)
+
+    def test_missing_counter_is_backfilled(self):
+        from .models import UnreadCounter
+        from .receipts import mark_read, unread_count
+        UnreadCounter.objects.all().delete()
+        mark_read(self.room.id, "2", self.messages[0].id)
+        self.assertEqual(unread_count(self.room.id, "2"), 2)
+
+    @override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+    def test_rest_endpoint(self):
+        auth_client._sync_client = httpx.Client(transport=httpx.MockTransport(
+            lambda request: httpx.Response(200, json={"id": 2})
+        ))
+        url = f"/api/chat/rooms/{self.room.id}/read/"
+        resp = self.client.post(url, {"message_id": self.messages[-1].id}, HTTP_AUTHORIZATION="Bearer tok")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual((resp.data["marked"], resp.data["unread"]), (3, 0))
+        self.assertEqual(self.client.post(url, {"message_id": "x"}, HTTP_AUTHORIZATION="Bearer tok").status_code, 400)
+        self.assertEqual(self.client.post(url, {"message_id": 1}).status_code, 401)
+
+
+class ReadReceiptCoalescerTest(TestCase):
+    def test_burst_is_written_once_with_highest_id(self):
+        from . import receipts
+        calls, broadcasts = [], []
+        original_mark, original_broadcast = receipts.mark_read, receipts.broadcast_receipt
+
+        async def fake_broadcast(room_group, user_id, up_to_id):
+            broadcasts.append(up_to_id)
+
+        async def run():
+            coalescer = receipts.ReadReceiptCoalescer(delay=0.02)
+            for up_to_id in (3, 9, 5):
+                coalescer.submit("chat_1", 1, "2", up_to_id)
+            await asyncio.sleep(0.05)
+
+        receipts.mark_read = lambda *args: calls.append(args) or 1
+        receipts.broadcast_receipt = fake_broadcast
+        try:
+            async_to_sync(run)()
+        finally:
+            receipts.mark_read, receipts.broadcast_receipt = original_mark, original_broadcast
+        self.assertEqual(calls, [(1, "2", 9)])
+        self.assertEqual(broadcasts, [9])
+
+
+class InboxTest(TestCase):
+    def setUp(self):
+        from . import membership
+        from .models import Message
+        from .persistence import save_messages
+        membership.clear_room_cache()
+        auth_client.clear_profile_cache()
+        auth_client._sync_client = httpx.Client(transport=httpx.MockTransport(
+            lambda request: httpx.Response(200, json={"id": 1})
+        ))
+        self.rooms = [ChatRoom.objects.create(participant_a="1", participant_b=str(i)) for i in range(2, 6)]
+        ChatRoom.objects.create(participant_a="7", participant_b="8")
+        # room 0 stays empty, then rooms 3, 1, 2 get messages in that order
+        for index in (3, 1, 2):
+            save_messages([Message(room=self.rooms[index], sender_id=self.rooms[index].participant_b, content=f"r{index}")])
+
+    def tearDown(self):
+        auth_client.clear_profile_cache()
+        auth_client.close_sync_client()
+
+    def test_rooms_ordered_by_activity_with_unread(self):
+        auth = {"HTTP_AUTHORIZATION": "Bearer tok"}
+        warm = self.client.get("/api/chat/rooms/", {"limit": 1}, **auth)  # fills the profile cache
+        self.assertEqual(warm.status_code, 200)
+        with self.assertNumQueries(1):
+            resp = self.client.get("/api/chat/rooms/", {"limit": 3}, **auth)
+        self.assertEqual(resp.status_code, 200)
+        results = resp.data["results"]
+        self.assertEqual([r["id"] for r in results], [self.rooms[i].id for i in (2, 1, 3)])
+        self.assertEqual(results[0]["last_message"]["content"], "r2")
+        self.assertEqual(results[0]["unread"], 1)
+        older = self.client.get("/api/chat/rooms/", {"limit": 3, "before": resp.data["prev"]}, **auth).data
+        self.assertEqual([r["id"] for r in older["results"]], [self.rooms[0].id])
+        self.assertIsNone(older["results"][0]["last_message"])
+
+
+class MessageSequenceTest(TestCase):
+    def test_seqs_are_per_room_and_gap_free(self):
+        from .models import Message
+        from .persistence import save_messages
+        a = ChatRoom.objects.create(participant_a="1", participant_b="2")
+        b = ChatRoom.objects.create(participant_a="1", participant_b="3")
+        save_messages([Message(room=a, sender_id="1", content="x")])
+        saved = save_messages([
+            Message(room=a, sender_id="1", content="y"),
+            Message(room=b, sender_id="1", content="z"),
+            Message(room=a, sender_id="2", content="w"),
+        ])
+        self.assertEqual([m.seq for m in saved], [2, 1, 3])
+        a.refresh_from_db()
+        self.assertEqual(a.last_seq, 3)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, CHAT_RESUME_MAX_MESSAGES=3)
+class ResumeTest(TransactionTestCase):
+    def setUp(self):
+        from . import membership, presence
+        from .models import Message
+        from .persistence import save_messages
+        membership.clear_room_cache()
+        presence.reset_store()
+        self.room = ChatRoom.objects.create(participant_a="1", participant_b="2")
+        save_messages([Message(room=self.room, sender_id="2", content=f"m{i}") for i in range(1, 6)])
+
+    def _resume(self, last_seq):
+        from channels.testing import WebsocketCommunicator
+
+        async def run():
+            path = f"/ws/chat/{self.room.id}/?token={make_token(1)}&last_seq={last_seq}"
+            communicator = WebsocketCommunicator(ws_application(), path)
+            await communicator.connect()
+            frame = await communicator.receive_json_from()
+            while frame.get("type") != "resume":
+                frame = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return frame
+
+        return async_to_sync(run)()
+
+    def test_only_missing_messages_are_replayed(self):
+        frame = self._resume(3)
+        self.assertEqual([m["seq"] for m in frame["messages"]], [4, 5])
+        self.assertFalse(frame["truncated"])
+
+    def test_large_gaps_are_truncated(self):
+        frame = self._resume(0)
+        self.assertEqual([m["content"] for m in frame["messages"]], ["m1", "m2", "m3"])
+        self.assertTrue(frame["truncated"])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class EncodeOnceFanOutTest(TransactionTestCase):
+    def setUp(self):
+        from . import membership, presence
+        membership.clear_room_cache()
+        presence.reset_store()
+        self.room = ChatRoom.objects.create(participant_a="1", participant_b="2")
+
+    def test_broadcast_is_encoded_once_for_all_recipients(self):
+        import msgpack
+        from channels.testing import WebsocketCommunicator
+        from . import codecs
+        encodes = []
+        original = codecs.dumps_json
+
+        def counting_dumps(content):
+            encodes.append(content)
+            return original(content)
+
+        async def run():
+            sockets = [
+                WebsocketCommunicator(ws_application(), f"/ws/chat/{self.room.id}/?token={make_token(user)}",
+                                      subprotocols=protocols)
+                for user, protocols in (("1", []), ("2", []), ("2", ["msgpack"]))
+            ]
+            for socket in sockets:
+                await socket.connect()
+            await asyncio.sleep(0.05)
+            for socket in sockets:
+                while not await socket.receive_nothing(timeout=0.05):
+                    await socket.receive_from()
+            codecs.dumps_json = counting_dumps
+            try:
+                await sockets[0].send_json_to({"type": "message", "content": "once"})
+                frames = [await socket.receive_from() for socket in sockets]
+            finally:
+                codecs.dumps_json = original
+            for socket in sockets:
+                await socket.disconnect()
+            return frames
+
+        text1, text2, binary = async_to_sync(run)()
+        self.assertEqual(len(encodes), 1)
+        self.assertEqual(text1, text2)
+        self.assertEqual(msgpack.unpackb(binary, raw=False)["content"], "once")
+
+
+class HybridChannelLayerTest(TestCase):
+    def _pair(self):
+        from channels.layers import InMemoryChannelLayer
+        from .layers import HybridChannelLayer
+        redis_stand_in = InMemoryChannelLayer()
+        return HybridChannelLayer(remote=redis_stand_in), HybridChannelLayer(remote=redis_stand_in)
+
+    def test_local_members_are_served_from_memory(self):
+        from .layers import HybridChannelLayer
+
+        async def run():
+            layer = HybridChannelLayer()
+            channels = [await layer.new_channel() for _ in range(3)]
+            for channel in channels:
+                await layer.group_add("chat_1", channel)
+            await layer.group_send("chat_1", {"type": "chat.message", "text": "hi"})
+            return [await layer.receive(channel) for channel in channels], layer.stats
+
+        received, stats = async_to_sync(run)()
+        self.assertEqual([m["text"] for m in received], ["hi"] * 3)
+        self.assertEqual(stats["local_deliveries"], 3)
+        self.assertEqual(stats["remote_publishes"], 0)
+
+    def test_remote_members_get_one_publish_per_event(self):
+        async def run():
+            process_a, process_b = self._pair()
+            a1, a2 = await process_a.new_channel(), await process_a.new_channel()
+            b1, b2 = await process_b.new_channel(), await process_b.new_channel()
+            for layer, channel in ((process_a, a1), (process_a, a2), (process_b, b1), (process_b, b2)):
+                await layer.group_add("chat_1", channel)
+            await process_a.group_send("chat_1", {"type": "chat.message", "text": "hi"})
+            received = [
+                await asyncio.wait_for(layer.receive(channel), 1)
+                for layer, channel in ((process_a, a1), (process_a, a2), (process_b, b1), (process_b, b2))
+            ]
+            await asyncio.sleep(0.01)
+            for layer, channel in ((process_a, a1), (process_a, a2)):
+                self.assertTrue(layer._queues[channel].empty())
+            await process_a.close()
+            await process_b.close()
+            return received, process_a.stats, process_b.stats
+
+        received, stats_a, stats_b = async_to_sync(run)()
+        self.assertEqual([m["text"] for m in received], ["hi"] * 4)
+        self.assertNotIn("__hybrid_group__", received[-1])
+        self.assertEqual(stats_a["remote_publishes"], 1)
+        self.assertEqual(stats_a["echoes_dropped"], 1)
+        self.assertEqual(stats_b["remote_deliveries"], 1)
+        self.assertEqual(stats_b["local_deliveries"], 2)
+
+    def test_process_channel_gets_its_own_capacity(self):
+        from .layers import PROCESS_CHANNEL_PREFIX, HybridChannelLayer
+
+        async def run():
+            layer = HybridChannelLayer(
+                remote={"BACKEND": "channels.layers.InMemoryChannelLayer", "CONFIG": {"capacity": 5}},
+                process_channel_capacity=500,
+            )
+            remote = layer.remote
+            # Compiled the way channels_redis does on construction
+            remote.channel_capacity = remote.compile_capacities(remote.channel_capacity)
+            process_channel = await remote.new_channel(PROCESS_CHANNEL_PREFIX)
+            return remote.get_capacity(process_channel), remote.get_capacity(await remote.new_channel())
+
+        self.assertEqual(async_to_sync(run)(), (500, 5))
+
+    def test_cancelled_receive_forgets_the_channel(self):
+        from .layers import HybridChannelLayer
+
+        async def run():
+            layer = HybridChannelLayer()
+            channel = await layer.new_channel()
+            await layer.group_add("chat_1", channel)
+            task = asyncio.ensure_future(layer.receive(channel))
+            await asyncio.sleep(0)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            return layer
+
+        layer = async_to_sync(run)()
+        self.assertEqual(layer._queues, {})
+        self.assertNotIn("chat_1", layer._groups)
+
+
+class MessageSearchTest(TestCase):
+    def setUp(self):
+        from . import membership
+        from .models import Message
+        from .persistence import save_messages
+        membership.clear_room_cache()
+        auth_client.clear_profile_cache()
+        auth_client._sync_client = httpx.Client(transport=httpx.MockTransport(
+            lambda request: httpx.Response(200, json={"id": 1})
+        ))
+        self.mine = ChatRoom.objects.create(participant_a="1", participant_b="2")
+        self.other = ChatRoom.objects.create(participant_a="2", participant_b="3")
+        # Written the way ChatConsumer._create_message writes
+        save_messages([
+            Message(room=self.mine, sender_id="2", content="the budget review is on friday"),
+            Message(room=self.mine, sender_id="1", content="budget budget budget, reviewing budgets all week"),
+            Message(room=self.mine, sender_id="2", content="lunch?"),
+            Message(room=self.other, sender_id="3", content="secret budget for room three"),
+        ])
+        self.auth = {"HTTP_AUTHORIZATION": "Bearer tok"}
+
+    def tearDown(self):
+        auth_client.clear_profile_cache()
+        auth_client.close_sync_client()
+
+    def _search(self, **params):
+        return self.client.get("/api/chat/search/", params, **self.auth)
+
+    def test_ranked_highlighted_hits_from_own_rooms_only(self):
+        resp = self._search(q="budgets")
+        self.assertEqual(resp.status_code, 200)
+        results = resp.data["results"]
+        self.assertEqual(len(results), 2)
+        self.assertTrue(all(r["room"] == self.mine.id for r in results))
+        self.assertTrue(results[0]["content"].startswith("budget budget"))
+        self.assertGreaterEqual(results[0]["rank"], results[1]["rank"])
+        self.assertIn("<mark>budget</mark>", results[1]["highlight"])
+        self.assertIsNone(resp.data["next"])
+
+    def test_cursor_walks_every_hit_once(self):
+        first = self._search(q="budget", limit=1).data
+        second = self._search(q="budget", limit=1, after=first["next"]).data
+        self.assertEqual(len(first["results"]) + len(second["results"]), 2)
+        self.assertNotEqual(first["results"][0]["id"], second["results"][0]["id"])
+        self.assertIsNone(second["next"])
+
+    def test_new_messages_are_indexed_and_query_syntax_is_inert(self):
+        from .models import Message
+        from .persistence import save_messages
+        save_messages([Message(room=self.mine, sender_id="1", content="quarterly OR planning")])
+        self.assertEqual(len(self._search(q='planning" OR (').data["results"]), 1)
+        Message.objects.filter(content="lunch?").update(content="dinner instead")
+        self.assertEqual(len(self._search(q="lunch").data["results"]), 0)
+        self.assertEqual(len(self._search(q="dinner", room_id=self.mine.id).data["results"]), 1)
+
+    def test_highlight_is_html_escaped(self):
+        from .models import Message
+        from .persistence import save_messages
+        save_messages([Message(room=self.mine, sender_id="2", content='<img src=x onerror="alert(1)"> invoice')])
+        highlight = self._search(q="invoice").data["results"][0]["highlight"]
+        self.assertNotIn("<img", highlight)
+        self.assertIn("&lt;img", highlight)
+        self.assertIn("<mark>invoice</mark>", highlight)
+
+    def test_validation(self):
+        self.assertEqual(self._search(q="").status_code, 400)
+        self.assertEqual(self._search(q="budget", after="junk").status_code, 400)
+        self.assertEqual(self.client.get("/api/chat/search/", {"q": "budget"}).status_code, 401)
+
+
+class HotPathBudgetTest(TransactionTestCase):
+    """
+    Fixed SQL and auth-service budgets per request for the REST hot paths.
+
+    Raising a budget should be a deliberate change; benchmarks/rest_bench.py
+    reports the same numbers under load.
+    """
+    CREATE_ROOM_QUERIES = 3  # lookup, INSERT room, INSERT unread counters
+    EXISTING_ROOM_QUERIES = 1
+    CREATE_ROOM_AUTH_CALLS_COLD = 2  # caller's profile, the other participant
+    ROOM_MESSAGES_QUERIES = 2  # room lookup, one keyset page
+
+    def setUp(self):
+        from . import membership
+        membership.clear_room_cache()
+        auth_client.clear_profile_cache()
+        auth_client.clear_known_users()
+        self.auth_calls = []
+
+        def handler(request):
+            self.auth_calls.append(request.url.path)
+            return httpx.Response(200, json={"id": 1})
+
+        mock_auth_service(self, handler)
+        self.auth = {"HTTP_AUTHORIZATION": f"Bearer {make_token(1)}"}
+
+    def tearDown(self):
+        auth_client.clear_profile_cache()
+        auth_client.clear_known_users()
+        auth_client.close_sync_client()
+
+    @contextlib.contextmanager
+    def _statements(self):
+        """Capture queries on this thread and on the DB pool (one thread on SQLite)"""
+        from django.db import connection, connections
+        from django.test.utils import CaptureQueriesContext
+        from .db import get_executor
+        executor = get_executor()
+        pooled = CaptureQueriesContext(executor.submit(lambda: connections["default"]).result())
+        executor.submit(pooled.__enter__).result()
+        try:
+            with CaptureQueriesContext(connection) as local:
+                yield [local, pooled]
+        finally:
+            executor.submit(pooled.__exit__, None, None, None).result()
+
+    def _count(self, contexts):
+        control = ("BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE")
+        return sum(
+            len([q for q in ctx.captured_queries if q["sql"].split(" ", 1)[0].upper() not in control])
+            for ctx in contexts
+        )
+
+    def _create(self, partner):
+        return self.client.post("/api/chat/rooms/", {"participant_a": "1", "participant_b": partner}, **self.auth)
+
+    def test_create_or_get_room_budget(self):
+        with self._statements() as ctx:
+            resp = self._create("2")
+        self.assertEqual(resp.status_code, 201)
+        self.assertLessEqual(self._count(ctx), self.CREATE_ROOM_QUERIES)
+        self.assertLessEqual(len(self.auth_calls), self.CREATE_ROOM_AUTH_CALLS_COLD)
+
+        self.auth_calls.clear()
+        with self._statements() as ctx:
+            resp = self._create("2")
+        self.assertEqual(resp.status_code, 200)
+        self.assertLessEqual(self._count(ctx), self.EXISTING_ROOM_QUERIES)
+        self.assertEqual(self.auth_calls, [])
+
+        with self._statements() as ctx:
+            self.assertEqual(self._create("3").status_code, 201)
+        self.assertLessEqual(self._count(ctx), self.CREATE_ROOM_QUERIES)
+        self.assertEqual(len(self.auth_calls), 1)  # only the new participant
+
+    def test_room_messages_budget_is_flat(self):
+        from .models import Message
+        room = ChatRoom.objects.create(participant_a="1", participant_b="2")
+        url = f"/api/chat/rooms/{room.id}/messages/"
+        for size in (0, 10, 250):
+            Message.objects.bulk_create(
+                [Message(room=room, sender_id="1", content="x") for _ in range(size - room.messages.count())]
+            )
+            for params in ({"limit": 5}, {"limit": 100}):
+                with self._statements() as ctx:
+                    resp = self.client.get(url, params)
+                self.assertEqual(resp.status_code, 200)
+                self.assertLessEqual(self._count(ctx), self.ROOM_MESSAGES_QUERIES, (size, params))
+                if resp.data["prev"]:
+                    with self._statements() as ctx:
+                        self.client.get(url, {**params, "before": resp.data["prev"]})
+                    self.assertLessEqual(self._count(ctx), self.ROOM_MESSAGES_QUERIES, (size, params))
+        self.assertEqual(self.auth_calls, [])
+
+
+class MetricsRegistryTest(TestCase):
+    def test_exposition_format(self):
+        from .metrics import Counter, Gauge, Histogram, Registry
+        registry = Registry()
+        counter = Counter("t_events_total", "Events", ["kind"], registry=registry)
+        gauge = Gauge("t_depth", "Depth", registry=registry)
+        histogram = Histogram("t_seconds", "Latency", buckets=(0.1, 1.0), registry=registry)
+        counter.labels(kind='a"b').inc(2)
+        gauge.set_function(lambda: 7)
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value)
+        lines = registry.render().splitlines()
+        self.assertIn("# TYPE t_events_total counter", lines)
+        self.assertIn('t_events_total{kind="a\\"b"} 2', lines)
+        self.assertIn("t_depth 7", lines)
+        self.assertIn('t_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('t_seconds_bucket{le="1.0"} 2', lines)
+        self.assertIn('t_seconds_bucket{le="+Inf"} 3', lines)
+        self.assertIn("t_seconds_count 3", lines)
+
+    def test_auth_calls_are_timed_by_outcome(self):
+        from .metrics import AUTH_REQUEST_SECONDS
+
+        def handler(request):
+            if request.url.path.startswith("/api/users/9"):
+                raise httpx.ConnectError("down", request=request)
+            return httpx.Response(404 if request.url.path.startswith("/api/users/5") else 200, json={"id": 1})
+
+        AUTH_REQUEST_SECONDS.clear()
+        auth_client.clear_profile_cache()
+        auth_client.clear_known_users()
+        auth_client._sync_client = httpx.Client(
+            transport=auth_client._InstrumentedTransport(httpx.MockTransport(handler))
+        )
+        try:
+            auth_client.fetch_profile_sync("tok")
+            auth_client.verify_users_exist(["5"], "tok")
+            auth_client.verify_users_exist(["9"], "tok")
+        finally:
+            auth_client.clear_profile_cache()
+            auth_client.clear_known_users()
+            auth_client.close_sync_client()
+        self.assertEqual(AUTH_REQUEST_SECONDS.labels(operation="profile", status=200).count, 1)
+        self.assertEqual(AUTH_REQUEST_SECONDS.labels(operation="verify_user", status=404).count, 1)
+        self.assertEqual(AUTH_REQUEST_SECONDS.labels(operation="verify_user", status="error").count, 1)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class MetricsEndpointTest(TransactionTestCase):
+    def setUp(self):
+        from . import membership, metrics, presence
+        membership.clear_room_cache()
+        presence.reset_store()
+        metrics.REGISTRY.clear()
+        self.room = ChatRoom.objects.create(participant_a="1", participant_b="2")
+
+    def test_hot_paths_are_exposed(self):
+        from asgiref.sync import sync_to_async
+        from channels.testing import WebsocketCommunicator
+
+        async def run():
+            socket = WebsocketCommunicator(ws_application(), f"/ws/chat/{self.room.id}/?token={make_token('1')}")
+            await socket.connect()
+            await socket.receive_json_from()  # presence snapshot
+            connected = (await sync_to_async(self.client.get)("/metrics")).content.decode()
+            await socket.send_json_to({"type": "message", "content": "hi"})
+            await socket.receive_json_from()
+            await socket.disconnect()
+            return connected
+
+        self.assertIn('chat_ws_connections{consumer="chat"} 1', async_to_sync(run)().splitlines())
+        lines = self.client.get("/metrics").content.decode().splitlines()
+        self.assertIn('chat_ws_connections{consumer="chat"} 0', lines)
+        self.assertIn('chat_ws_handler_seconds_count{consumer="chat",handler="connect",event=""} 1', lines)
+        self.assertIn('chat_ws_handler_seconds_count{consumer="chat",handler="receive",event="message"} 1', lines)
+        self.assertIn('chat_group_send_seconds_count{event="chat.message"} 1', lines)
+        self.assertIn('chat_db_seconds_count{operation="create_message"} 1', lines)
+        self.assertIn('chat_threadpool_wait_seconds_count{operation="create_message"} 1', lines)
+        self.assertIn("# TYPE chat_channel_layer_queued_messages gauge", lines)
+
+    def test_token_guard(self):
+        with self.settings(METRICS_TOKEN="s3cret"):
+            self.assertEqual(self.client.get("/metrics").status_code, 401)
+            resp = self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer s3cret")
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp["Content-Type"].startswith("text/plain; version=0.0.4"))
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, PROFILE_TOKEN="prof", PROFILE_SAMPLE_RATE=0.0,
+                   PROFILE_INTERVAL_MS=1)
+class ProfilingTest(TransactionTestCase):
+    def setUp(self):
+        import tempfile
+        from . import membership, presence
+        membership.clear_room_cache()
+        presence.reset_store()
+        self.room = ChatRoom.objects.create(participant_a="1", participant_b="2")
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def _files(self):
+        import os
+        return sorted(os.listdir(self.tmp.name))
+
+    def _get(self, path, headers=()):
+        from channels.testing import HttpCommunicator
+        from django.core.asgi import get_asgi_application
+        from .profiling import ProfilingMiddleware
+        app = ProfilingMiddleware(get_asgi_application())
+        return async_to_sync(HttpCommunicator(app, "GET", path, headers=list(headers)).get_response)()
+
+    def test_http_requests_profiled_only_when_flagged_or_sampled(self):
+        import pstats
+        url = f"/api/chat/rooms/{self.room.id}/messages/"
+        with self.settings(PROFILE_DIR=self.tmp.name):
+            self.assertEqual(self._get(url)["status"], 200)
+            self._get(url, [(b"x-profile", b"wrong")])
+            self.assertEqual(self._files(), [])
+            self.assertEqual(self._get(url, [(b"x-profile", b"prof")])["status"], 200)
+            with self.settings(PROFILE_SAMPLE_RATE=1.0, PROFILE_FORMAT="pstats"):
+                self._get(url)
+        files = self._files()
+        self.assertEqual(len(files), 2)
+        self.assertTrue(all("-http-GET-api_chat_rooms_id_messages-" in name for name in files))
+        self.assertEqual({name.rsplit(".", 1)[1] for name in files}, {"collapsed", "pstats"})
+        pstats.Stats(f"{self.tmp.name}/{[n for n in files if n.endswith('.pstats')][0]}")
+
+    def test_flagged_websocket_profiles_each_handler(self):
+        from channels.testing import WebsocketCommunicator
+        from .profiling import ProfilingMiddleware
+
+        async def run(query):
+            socket = WebsocketCommunicator(
+                ProfilingMiddleware(ws_application()), f"/ws/chat/{self.room.id}/?token={make_token('1')}{query}"
+            )
+            await socket.connect()
+            await socket.receive_json_from()
+            await socket.send_json_to({"type": "message", "content": "hi"})
+            await socket.receive_json_from()
+            await socket.disconnect()
+
+        with self.settings(PROFILE_DIR=self.tmp.name):
+            async_to_sync(run)("")
+            self.assertEqual(self._files(), [])
+            async_to_sync(run)("&profile=prof")
+        names = " ".join(self._files())
+        for event in ("websocket.connect", "websocket.receive", "chat.message"):
+            self.assertIn(f"-ws-chat-{event}-", names)
+
+
+class OutboundQueueTest(TestCase):
+    def setUp(self):
+        from . import metrics
+        metrics.REGISTRY.clear()
+
+    def _socket(self):
+        """A socket whose writes block until released, behind the outbound queue"""
+        import json
+        from .codecs import SubprotocolMixin
+        from .outbound import OutboundQueueMixin
+
+        class StalledSocket:
+            channel_name = "test!stalled"
+
+            def __init__(self):
+                self.sent, self.closed = [], None
+                self.released = asyncio.Event()
+
+            async def send(self, text_data=None, bytes_data=None, close=False):
+                await self.released.wait()
+                self.sent.append(json.loads(text_data))
+
+            async def send_json(self, content, close=False):
+                await self.send(text_data=json.dumps(content), close=close)
+
+            async def close(self, code=None):
+                self.closed = code
+
+        class Socket(OutboundQueueMixin, SubprotocolMixin, StalledSocket):
+            pass
+
+        return Socket()
+
+    @staticmethod
+    def _typing(user_id, is_typing):
+        from .codecs import encode_event
+        frame = {"type": "typing", "user_id": user_id, "is_typing": is_typing}
+        return encode_event("typing.event", frame, collapse_key=f"typing:{user_id}")
+
+    @override_settings(CHAT_OUTBOUND_QUEUE_SIZE=3, CHAT_OUTBOUND_HARD_LIMIT=100, CHAT_OUTBOUND_SLOW_SECONDS=60)
+    def test_messages_kept_and_state_collapsed_or_dropped(self):
+        from . import metrics
+        from .codecs import encode_event
+
+        async def run():
+            socket = self._socket()
+            await socket.send_json({"type": "message", "n": 0})
+            await asyncio.sleep(0)  # the writer takes it and stalls
+            await socket.send_encoded(self._typing("1", True))
+            await socket.send_encoded(self._typing("1", False))
+            await socket.send_encoded(encode_event(
+                "presence.update", {"type": "presence", "user_id": "2", "status": "online"}, collapse_key="presence:2"
+            ))
+            await socket.send_json({"type": "message", "n": 1})
+            await socket.send_json({"type": "message", "n": 2})
+            await socket.send_encoded(self._typing("3", True))  # full: dropped
+            await socket.send_encoded(self._typing("1", True))  # still collapses into the pending one
+            self.assertEqual(metrics.WS_OUTBOUND_QUEUED.labels().get(), 4)
+            socket.released.set()
+            while len(socket._outbound):
+                await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            socket._stop_outbound()
+            return socket
+
+        socket = async_to_sync(run)()
+        self.assertEqual(
+            [(f["type"], f.get("n", f.get("user_id"))) for f in socket.sent],
+            [("message", 0), ("message", 1), ("message", 2), ("typing", "1"), ("presence", "2")],
+        )
+        self.assertTrue(socket.sent[3]["is_typing"])
+        self.assertIsNone(socket.closed)
+        self.assertEqual(metrics.WS_OUTBOUND_DROPPED.labels(event="typing.event", reason="collapsed").get(), 2)
+        self.assertEqual(metrics.WS_OUTBOUND_DROPPED.labels(event="typing.event", reason="full").get(), 1)
+        self.assertEqual(metrics.WS_OUTBOUND_QUEUED.labels().get(), 0)
+
+    def test_json_replies_go_through_the_queue(self):
+        import json
+        from channels.generic.websocket import AsyncJsonWebsocketConsumer
+        from . import metrics
+        from .codecs import SubprotocolMixin
+        from .outbound import OutboundQueueMixin
+
+        class Consumer(OutboundQueueMixin, SubprotocolMixin, AsyncJsonWebsocketConsumer):
+            channel_name = "test!json"
+
+        async def run():
+            written, released = [], asyncio.Event()
+
+            async def base_send(message):
+                await released.wait()
+                written.append(json.loads(message["text"]))
+
+            consumer = Consumer()
+            consumer.base_send = base_send
+            # A send that bypasses the queue would block here until released
+            await asyncio.wait_for(consumer.send_json({"type": "ack", "n": 0}), 1)
+            await asyncio.wait_for(consumer.send_json({"type": "ack", "n": 1}), 1)
+            pending = len(consumer._outbound)  # the writer holds the first, stalled
+            released.set()
+            while len(consumer._outbound):
+                await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            consumer._stop_outbound()
+            return pending, written
+
+        pending, written = async_to_sync(run)()
+        self.assertEqual(pending, 1)
+        self.assertEqual([f["n"] for f in written], [0, 1])
+        self.assertEqual(metrics.WS_OUTBOUND_QUEUED.labels().get(), 0)
+
+    def test_sockets_that_stay_behind_are_closed_resumably(self):
+        from . import metrics
+        from .outbound import SLOW_CONSUMER_CLOSE_CODE
+
+        async def run(count):
+            socket = self._socket()
+            for n in range(count):
+                await socket.send_json({"type": "message", "n": n})
+                await asyncio.sleep(0)
+            socket._stop_outbound()
+            return socket
+
+        with self.settings(CHAT_OUTBOUND_QUEUE_SIZE=100, CHAT_OUTBOUND_HARD_LIMIT=3):
+            socket = async_to_sync(run)(3)
+            self.assertIsNone(socket.closed)
+            socket = async_to_sync(run)(4)
+            self.assertEqual(socket.closed, SLOW_CONSUMER_CLOSE_CODE)
+        with self.settings(CHAT_OUTBOUND_QUEUE_SIZE=1, CHAT_OUTBOUND_SLOW_SECONDS=0):
+            socket = async_to_sync(run)(4)
+            self.assertEqual(socket.closed, SLOW_CONSUMER_CLOSE_CODE)
+        self.assertEqual(metrics.WS_SLOW_CLOSES.labels(reason="overflow").get(), 1)
+        self.assertEqual(metrics.WS_SLOW_CLOSES.labels(reason="lagging").get(), 1)
+        self.assertEqual(metrics.WS_OUTBOUND_QUEUED.labels().get(), 0)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class RateLimitTest(TransactionTestCase):
+    def setUp(self):
+        from . import membership, presence, ratelimit
+        membership.clear_room_cache()
+        presence.reset_store()
+        ratelimit.reset_store()
+        self.room = ChatRoom.objects.create(participant_a="1", participant_b="2")
+
+    def test_token_bucket(self):
+        from .ratelimit import TokenBucket
+        bucket = TokenBucket(rate=2, burst=2, now=0.0)
+        self.assertEqual([bucket.take(now=0.0) for _ in range(3)], [0.0, 0.0, 0.5])
+        self.assertEqual(bucket.take(now=0.25), 0.25)
+        self.assertEqual(bucket.take(now=0.5), 0.0)
+
+    def test_in_memory_store_is_bounded(self):
+        from .ratelimit import InMemoryRateLimitStore
+        store = InMemoryRateLimitStore(max_buckets=3)
+
+        async def run():
+            for user in range(10):
+                await store.take(f"{user}:message", rate=0.001, burst=1)  # none refill in time
+            return await store.take("9:message", rate=0.001, burst=1)
+
+        self.assertGreater(async_to_sync(run)(), 0)  # the recent bucket was kept
+        self.assertEqual(len(store._buckets), 3)
+
+    async def _drain(self, socket):
+        frames = []
+        while not await socket.receive_nothing(timeout=0.1):
+            frames.append(await socket.receive_json_from())
+        return frames
+
+    @override_settings(CHAT_RATE_LIMITS={"message": (0.001, 2)}, CHAT_USER_RATE_LIMITS={})
+    def test_connection_limit_refuses_with_one_error_frame(self):
+        from channels.testing import WebsocketCommunicator
+        from .models import Message
+
+        async def run():
+            socket = WebsocketCommunicator(ws_application(), f"/ws/chat/{self.room.id}/?token={make_token('1')}")
+            await socket.connect()
+            for n in range(4):
+                await socket.send_json_to({"type": "message", "content": f"m{n}"})
+            frames = await self._drain(socket)
+            await socket.disconnect()
+            return frames
+
+        frames = async_to_sync(run)()
+        self.assertEqual([f["content"] for f in frames if "content" in f], ["m0", "m1"])
+        errors = [f for f in frames if f.get("type") == "error"]
+        self.assertEqual(len(errors), 1)
+        self.assertEqual((errors[0]["detail"], errors[0]["event"]), ("rate_limited", "message"))
+        self.assertGreater(errors[0]["retry_after"], 0)
+        self.assertEqual(Message.objects.count(), 2)
+
+    @override_settings(CHAT_RATE_LIMITS={}, CHAT_USER_RATE_LIMITS={"unknown": (0.001, 1)})
+    def test_user_limit_spans_connections(self):
+        from channels.testing import WebsocketCommunicator
+
+        async def run():
+            path = f"/ws/chat/{self.room.id}/?token={make_token('1')}"
+            first, second = WebsocketCommunicator(ws_application(), path), WebsocketCommunicator(ws_application(), path)
+            await first.connect()
+            await second.connect()
+            await first.send_json_to({"type": "bogus"})
+            replies = await self._drain(first)
+            await second.send_json_to({"type": "bogus"})
+            replies += await self._drain(second)
+            await first.disconnect()
+            await second.disconnect()
+            return [f["detail"] for f in replies if f.get("type") == "error"]
+
+        self.assertEqual(async_to_sync(run)(), ["unknown type", "rate_limited"])
+
+
+class RepositoryTest(TransactionTestCase):
+    def setUp(self):
+        from .models import Message
+        from .persistence import save_messages
+        self.room = ChatRoom.objects.create(participant_a="1", participant_b="2")
+        save_messages([Message(room=self.room, sender_id="1", content=f"m{i}") for i in range(1, 8)])
+
+    def test_iterates_in_chunks(self):
+        from . import repository
+
+        async def collect(**kwargs):
+            return [m.seq async for m in repository.aiter_messages_after(self.room.id, 2, **kwargs)]
+
+        self.assertEqual(async_to_sync(collect)(chunk_size=2), [3, 4, 5, 6, 7])
+        self.assertEqual(async_to_sync(collect)(limit=3, chunk_size=2), [3, 4, 5])
+        self.assertEqual(async_to_sync(collect)(limit=0), [])
+
+    def test_runs_on_the_db_pool(self):
+        import threading
+        from . import repository
+        from .db import db_sync_to_async
+
+        async def run():
+            message = await repository.acreate_message(self.room.id, "2", "hello")
+            thread = await db_sync_to_async("thread_name")(lambda: threading.current_thread().name)()
+            return message, thread
+
+        message, thread = async_to_sync(run)()
+        self.assertEqual((message.seq, message.content), (8, "hello"))
+        self.assertTrue(thread.startswith("chat-db"))
+
+
+class AsyncCreateRoomTest(TransactionTestCase):
+    def setUp(self):
+        import threading
+        import time
+        from . import membership
+        membership.clear_room_cache()
+        auth_client.clear_profile_cache()
+        auth_client.clear_known_users()
+        self.addCleanup(auth_client.clear_profile_cache)
+        self.addCleanup(auth_client.clear_known_users)
+        self.addCleanup(auth_client.close_sync_client)
+        self.in_flight = self.peak = 0
+        self.delay = 0.05
+        lock = threading.Lock()
+
+        def handler(request):
+            with lock:
+                self.in_flight += 1
+                self.peak = max(self.peak, self.in_flight)
+            try:
+                time.sleep(self.delay)
+            finally:
+                with lock:
+                    self.in_flight -= 1
+            return httpx.Response(200, json={"id": 1})
+
+        mock_auth_service(self, handler)
+
+    def _create(self, partner, token=None):
+        headers = {"HTTP_AUTHORIZATION": f"Bearer {token or make_token(1)}"}
+        return self.client.post("/api/chat/rooms/", {"participant_a": "1", "participant_b": partner}, **headers)
+
+    def test_auth_calls_run_concurrently(self):
+        resp = self._create("2")
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.json()["participant_b"], "2")
+        self.assertEqual(self.peak, 2)  # profile and the other participant, side by side
+        self.assertEqual(self._create("2").status_code, 200)
+
+    def test_json_body_and_unreadable_token(self):
+        import json
+        resp = self.client.post(
+            "/api/chat/rooms/", json.dumps({"participant_a": "1", "participant_b": "2"}),
+            content_type="application/json", HTTP_AUTHORIZATION="Bearer opaque",
+        )
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(self.peak, 3)  # no claim to go on: both participants are looked up
+        self.assertEqual(self._create("").status_code, 400)
+
+    @override_settings(CHAT_CREATE_ROOM_DEADLINE=0.05)
+    def test_one_deadline_for_the_whole_request(self):
+        import time
+        self.delay = 0.5
+        started = time.perf_counter()
+        resp = self._create("2")
+        self.assertEqual(resp.status_code, 504)
+        self.assertLess(time.perf_counter() - started, 0.4)
+        self.assertFalse(ChatRoom.objects.exists())
+
+
+class ReplicaRoutingTest(TransactionTestCase):
+    """A second SQLite file stands in for a replica that hasn't caught up"""
+
+    alias = "replica_test"
+
+    @classmethod
+    def setUpClass(cls):
+        # Added after the test runner has set up its databases, so the
+        # replica isn't replaced by a test database and keeps its own rows
+        super().setUpClass()
+        cls.databases = {"default", cls.alias}
+        import os
+        import tempfile
+        from django.core.management import call_command
+        from django.db import connections
+        fd, path = tempfile.mkstemp(suffix=".sqlite3")
+        os.close(fd)
+        connections.settings[cls.alias] = connections.configure_settings({
+            "default": connections.settings["default"],
+            cls.alias: {"ENGINE": "django.db.backends.sqlite3", "NAME": path},
+        })[cls.alias]
+        cls.addClassCleanup(os.remove, path)
+        cls.addClassCleanup(connections.settings.pop, cls.alias)
+        cls.addClassCleanup(connections.__delitem__, cls.alias)
+        cls.addClassCleanup(lambda: connections[cls.alias].close())
+        call_command("migrate", database=cls.alias, verbosity=0)
+
+    def setUp(self):
+        from . import routers
+        from .models import Message
+        routers.reset()
+        self.addCleanup(routers.reset)
+
+        self.room = ChatRoom.objects.create(participant_a="1", participant_b="2")
+        ChatRoom.objects.using(self.alias).create(id=self.room.id, participant_a="1", participant_b="2")
+        Message.objects.create(room=self.room, sender_id="1", content="primary", seq=1)
+        Message.objects.using(self.alias).create(room_id=self.room.id, sender_id="1", content="replica", seq=1)
+        self.url = f"/api/chat/rooms/{self.room.id}/messages/"
+
+    def _history(self, user_id):
+        resp = self.client.get(self.url, HTTP_AUTHORIZATION=f"Bearer {make_token(user_id)}")
+        return [m["content"] for m in resp.data["results"]]
+
+    def test_history_reads_from_replica_and_writes_stay_on_primary(self):
+        from .models import Message
+        from .routers import ReplicaRouter
+        self.assertEqual(self._history(1), ["primary"])  # no replicas configured
+        with self.settings(DATABASE_REPLICAS=[self.alias]):
+            self.assertEqual(self._history(1), ["replica"])
+            self.assertEqual(ReplicaRouter().db_for_write(Message), "default")
+
+    def test_recent_writer_reads_own_writes(self):
+        from .routers import note_write
+        with self.settings(DATABASE_REPLICAS=[self.alias], DB_REPLICA_STICKY_SECONDS=60):
+            note_write("1")
+            self.assertEqual(self._history(1), ["primary"])
+            self.assertEqual(self._history(2), ["replica"])
+
+    def test_lagging_replica_falls_back_to_primary(self):
+        from unittest import mock
+        from . import routers
+        with self.settings(DATABASE_REPLICAS=[self.alias], DB_REPLICA_MAX_LAG=2.0):
+            with mock.patch.object(routers, "measure_lag", return_value=30.0):
+                self.assertEqual(self._history(2), ["primary"])
+            routers.reset()
+            with mock.patch.object(routers, "measure_lag", return_value=None):  # unreachable
+                self.assertEqual(self._history(2), ["primary"])
+            routers.reset()
+            self.assertEqual(self._history(2), ["replica"])
+
+    def test_slow_lag_check_blocks_only_its_caller(self):
+        import threading
+        from unittest import mock
+        from . import routers
+        measuring, release = threading.Event(), threading.Event()
+
+        def slow_measure(alias):
+            measuring.set()
+            release.wait(5)
+            return 0.0
+
+        with mock.patch.object(routers, "measure_lag", slow_measure):
+            checker = threading.Thread(target=routers.replica_lag, args=(self.alias,))
+            checker.start()
+            self.assertTrue(measuring.wait(5))
+            self.assertIsNone(routers.replica_lag(self.alias))  # no waiting on the lock
+            release.set()
+            checker.join()
+            self.assertEqual(routers.replica_lag(self.alias), 0.0)
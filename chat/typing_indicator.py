@@ -0,0 +1,93 @@
+import asyncio
+import time
+from collections import Counter
+
+# Process-wide typing counters:
+#   received             typing frames from clients
+#   sent                 typing updates broadcast to the room
+#   suppressed_duplicate frames that repeated the current state
+#   suppressed_throttled frames superseded inside a throttle window
+#   auto_stopped         is_typing=false sent after inactivity
+typing_counters = Counter()
+
+
+class TypingThrottle:
+    """
+    Per-connection typing state.
+
+    Drops repeats of the current is_typing value, broadcasts at most one
+    update per interval (the latest value wins), and sends is_typing=false
+    after idle_timeout seconds without a typing=true frame.
+    """
+
+    def __init__(self, emit, interval=1.0, idle_timeout=5.0):
+        self._emit = emit
+        self.interval = interval
+        self.idle_timeout = idle_timeout
+        self.state = False
+        self._last_emit = float("-inf")
+        self._pending = None
+        self._flush_task = None
+        self._idle_task = None
+
+    async def update(self, is_typing):
+        typing_counters["received"] += 1
+        self._reset_idle_timer(is_typing)
+        await self._offer(is_typing)
+
+    async def _offer(self, is_typing):
+        if self._pending is not None:
+            # A flush is already scheduled; the latest value replaces the queued one
+            typing_counters["suppressed_throttled"] += 1
+            self._pending = is_typing
+            return
+        if is_typing == self.state:
+            typing_counters["suppressed_duplicate"] += 1
+            return
+        wait = self._last_emit + self.interval - time.monotonic()
+        if wait <= 0:
+            await self._send(is_typing)
+            return
+        self._pending = is_typing
+        self._flush_task = asyncio.ensure_future(self._flush_after(wait))
+
+    async def _flush_after(self, delay):
+        await asyncio.sleep(delay)
+        value, self._pending = self._pending, None
+        self._flush_task = None
+        if value is None:
+            return
+        if value == self.state:
+            typing_counters["suppressed_duplicate"] += 1
+            return
+        await self._send(value)
+
+    async def _send(self, is_typing):
+        self.state = is_typing
+        self._last_emit = time.monotonic()
+        typing_counters["sent"] += 1
+        await self._emit(is_typing)
+
+    def _reset_idle_timer(self, is_typing):
+        if self._idle_task is not None:
+            self._idle_task.cancel()
+            self._idle_task = None
+        if is_typing and self.idle_timeout > 0:
+            self._idle_task = asyncio.ensure_future(self._stop_when_idle())
+
+    async def _stop_when_idle(self):
+        await asyncio.sleep(self.idle_timeout)
+        self._idle_task = None
+        if self.state or self._pending:
+            typing_counters["auto_stopped"] += 1
+            await self._offer(False)
+
+    async def close(self):
+        """Cancel timers and clear a still-visible typing indicator"""
+        for task in (self._flush_task, self._idle_task):
+            if task is not None:
+                task.cancel()
+        self._flush_task = self._idle_task = None
+        self._pending = None
+        if self.state:
+            await self._send(False)
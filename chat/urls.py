@@ -1,7 +1,9 @@
 from django.urls import path
-from .views import CreateOrGetRoom, RoomMessages
+from .views import CreateOrGetRoom, MarkRoomRead, MessageSearch, RoomMessages
 
 urlpatterns = [
     path("rooms/", CreateOrGetRoom.as_view(), name="create_room"),
     path("rooms/<int:room_id>/messages/", RoomMessages.as_view(), name="room_messages"),
+    path("rooms/<int:room_id>/read/", MarkRoomRead.as_view(), name="room_read"),
+    path("search/", MessageSearch.as_view(), name="message_search"),
 ]
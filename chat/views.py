@@ -1,12 +1,27 @@
+import hmac
+import threading
+import time
+import jwt
+from concurrent.futures import ThreadPoolExecutor
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status, serializers
-from .models import ChatRoom
-from .auth_client import fetch_profile_sync
+from asgiref.sync import async_to_sync
+from django.db.models import F, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.conf import settings
+from django.http import HttpResponse
+from .models import ChatRoom, Message, UnreadCounter
+from . import metrics
+from .auth_client import fetch_profile_sync, verify_users_exist
 import logging
-import httpx
 from django.shortcuts import get_object_or_404
-from chat.serializers import MessageSerializer
+from chat.serializers import InboxRoomSerializer, MessageSerializer, SearchHitSerializer
+from .membership import get_participants, remember_room
+from .pagination import InvalidCursor, paginate_keyset, parse_limit
+from .receipts import broadcast_receipt, ensure_counters, mark_read, unread_count
+from .routers import note_write, replica_reads
+from .search import search_messages
 
 logger = logging.getLogger(__name__)
 
@@ -14,130 +29,337 @@ class CreateRoomSerializer(serializers.Serializer):
     participant_a = serializers.CharField(max_length=255, required=True, help_text="User ID of first participant")
     participant_b = serializers.CharField(max_length=255, required=True, help_text="User ID of second participant")
 
+class MarkReadSerializer(serializers.Serializer):
+    message_id = serializers.IntegerField(min_value=1, help_text="Mark every message up to this id as read")
+
+
+def _bearer_token(request):
+    auth_header = request.headers.get('Authorization', '')
+    return auth_header.replace('Bearer ', '').strip() if auth_header.startswith('Bearer ') else None
+
+
+def authenticate_request(request):
+    """
+    Resolve the caller's user ID from the Bearer token.
+
+    Returns:
+        tuple: (user_id, None) on success, (None, error Response) otherwise
+    """
+    token = _bearer_token(request)
+    if not token:
+        return None, Response(
+            {"detail": "Authentication required. Please provide a Bearer token."},
+            status=status.HTTP_401_UNAUTHORIZED
+        )
+    profile = fetch_profile_sync(token)
+    if not profile:
+        return None, Response(
+            {"detail": "Invalid token or user not found in auth service"},
+            status=status.HTTP_401_UNAUTHORIZED
+        )
+    return str(profile.get('id') or profile.get('user_id')), None
+
+
+def inbox_queryset(user_id):
+    """
+    The user's rooms with their latest message and unread count.
+
+    Everything is computed in one statement: the room filter uses the
+    participant_a/participant_b indexes, the latest message comes from
+    correlated subqueries on the (room, timestamp) index, and unread from
+    the per-(room, user) counter.
+    """
+    latest = Message.objects.filter(room=OuterRef('pk')).order_by('-timestamp', '-id')
+    unread = UnreadCounter.objects.filter(room=OuterRef('pk'), user_id=user_id).values('unread')[:1]
+    return (
+        ChatRoom.objects
+        .filter(Q(participant_a=user_id) | Q(participant_b=user_id))
+        .annotate(
+            last_message_id=Subquery(latest.values('id')[:1]),
+            last_message_sender_id=Subquery(latest.values('sender_id')[:1]),
+            last_message_content=Subquery(latest.values('content')[:1]),
+            last_message_timestamp=Subquery(latest.values('timestamp')[:1]),
+            unread=Coalesce(Subquery(unread), 0),
+        )
+        .annotate(last_activity=Coalesce(F('last_message_timestamp'), F('created_at')))
+    )
+
+
 class CreateOrGetRoom(APIView):
     serializer_class = CreateRoomSerializer
-    
+
+    def get(self, request):
+        """
+        Inbox: the caller's rooms, most recently active first.
+
+        Query params:
+            limit: Page size (capped at CHAT_MAX_PAGE_SIZE)
+            before: Cursor from a previous response's "prev"; less recently active rooms
+            after: Cursor from a previous response's "next"; more recently active rooms
+        """
+        user_id, error = authenticate_request(request)
+        if error:
+            return error
+        with replica_reads(user_id):
+            try:
+                limit = parse_limit(request.query_params.get("limit"))
+                rows, prev_cursor, next_cursor = paginate_keyset(
+                    inbox_queryset(user_id),
+                    limit,
+                    before=request.query_params.get("before"),
+                    after=request.query_params.get("after"),
+                    field="last_activity",
+                )
+            except (InvalidCursor, ValueError) as e:
+                return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            return Response({
+                "results": InboxRoomSerializer(rows[::-1], many=True).data,
+                "prev": prev_cursor,
+                "next": next_cursor,
+            })
+
     def post(self, request):
-        # Validate input using serializer
+        """
+        Create the room between two users, or return the existing one.
+
+        The caller's profile and the participants' existence are checked
+        against the auth service concurrently, on a thread pool, and the
+        whole request has one deadline, CHAT_CREATE_ROOM_DEADLINE, instead
+        of each auth call running to its own timeout in turn.
+        """
         serializer = CreateRoomSerializer(data=request.data)
         if not serializer.is_valid():
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-        
-        participant_a = serializer.validated_data['participant_a']
-        participant_b = serializer.validated_data['participant_b']
-        
-        # just added this line 
-        print(f" Participants validated: {participant_a}, {participant_b}")
-        # Get token from Authorization header
-        auth_header = request.headers.get('Authorization', '')
-        token = auth_header.replace('Bearer ', '').strip() if auth_header.startswith('Bearer ') else None
-        
+        token = _bearer_token(request)
         if not token:
-            # just added this too
-            print(" No token")
             return Response(
-                {"detail": "Authentication required. Please provide a Bearer token."}, 
+                {"detail": "Authentication required. Please provide a Bearer token."},
                 status=status.HTTP_401_UNAUTHORIZED
             )
-        
-        # Validate the requesting user exists
-        logger.info(f"Validating token for user...")
-        current_user = fetch_profile_sync(token)
-        
+        deadline = time.monotonic() + getattr(settings, "CHAT_CREATE_ROOM_DEADLINE", 10.0)
+        try:
+            return self._create_or_get(
+                token, serializer.validated_data['participant_a'], serializer.validated_data['participant_b'], deadline
+            )
+        except TimeoutError:
+            logger.warning("Room creation missed its deadline")
+            return Response(
+                {"detail": "Timed out creating the room; try again"},
+                status=status.HTTP_504_GATEWAY_TIMEOUT
+            )
+
+    def _create_or_get(self, token, participant_a, participant_b, deadline):
+        participants = [participant_a, participant_b]
+        # The caller is confirmed by their profile fetch, so only the other
+        # participant needs a lookup; the token's claim says which one that is
+        # (a hint only: the profile below is what's trusted)
+        claimed = _claimed_user_id(token)
+        skipped = claimed if claimed in participants else None
+        executor = _get_auth_executor()
+        current_user, users_valid = _results_by(deadline, [
+            executor.submit(fetch_profile_sync, token),
+            executor.submit(verify_users_exist, [p for p in participants if p != skipped], token),
+        ])
         if not current_user:
-            # added this too
-            print("fetch_profile_sync returned None!")
             return Response(
-                {"detail": "Invalid token or user not found in auth service"}, 
+                {"detail": "Invalid token or user not found in auth service"},
                 status=status.HTTP_401_UNAUTHORIZED
             )
-        # added this too
-        print(f"Profile fetched: {current_user}")
-        
         current_user_id = str(current_user.get('id') or current_user.get('user_id'))
-        print(f"User ID: {current_user_id}")
-        
-        # Verify current user is one of the participants
-        if current_user_id not in [participant_a, participant_b]:
-            # added this too
-            print(f" User {current_user_id} not in participants")
+        if current_user_id not in participants:
             return Response(
-                {"detail": "You can only create rooms where you are a participant"}, 
+                {"detail": "You can only create rooms where you are a participant"},
                 status=status.HTTP_403_FORBIDDEN
             )
-        # added this too 
-        print(f"User is participant")
-        # added this too
-        print(f"Verifying users exist...")
-        
-        
-        # Verify both users exist in auth service
-        # logger.info(f"Verifying users {participant_a} and {participant_b} exist...")
-        users_valid = self.verify_users_exist([participant_a, participant_b], token)
-        
+        if skipped is not None and skipped != current_user_id:
+            # The claim was wrong, so the participant it named is still unchecked
+            users_valid = users_valid and _results_by(deadline, [
+                executor.submit(verify_users_exist, [skipped], token),
+            ])[0]
         if not users_valid:
-            print("verify_users_exist returned False")
             return Response(
-                {"detail": "One or more participants not found in auth service"}, 
+                {"detail": "One or more participants not found in auth service"},
                 status=status.HTTP_404_NOT_FOUND
             )
-        print(f"Users verified")
+
         # Normalize participant order (prevent duplicate rooms)
         if participant_a > participant_b:
             participant_a, participant_b = participant_b, participant_a
-        
-        # Create or get room
+        if time.monotonic() >= deadline:
+            raise TimeoutError
         try:
-            room, created = ChatRoom.objects.get_or_create(
-                participant_a=participant_a,
-                participant_b=participant_b
-            )
-            
-            logger.info(f"Room {'created' if created else 'retrieved'}: {room.id}")
-            
-            return Response({
-                "room_id": room.id,
-                "created": created,
-                "participant_a": participant_a,
-                "participant_b": participant_b,
-                "created_at": room.created_at
-            }, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
-            
+            room, created = _get_or_create_room(participant_a, participant_b)
         except Exception as e:
             logger.error(f"Error creating/getting room: {str(e)}")
             return Response(
-                {"detail": f"Database error: {str(e)}"}, 
+                {"detail": f"Database error: {str(e)}"},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
-    def verify_users_exist(self, user_ids, token):
-        """Verify all users exist in auth service"""
-        from django.conf import settings
+        logger.info(f"Room {'created' if created else 'retrieved'}: {room.id}")
+        remember_room(room.id, room.participant_a, room.participant_b)
+        if created:
+            note_write(current_user_id)
+        return Response({
+            "room_id": room.id,
+            "created": created,
+            "participant_a": participant_a,
+            "participant_b": participant_b,
+            "created_at": room.created_at
+        }, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
+
+
+def _claimed_user_id(token):
+    """The user_id the token claims, unverified, or None if it isn't a readable JWT"""
+    try:
+        claims = jwt.decode(token, options={"verify_signature": False})
+    except jwt.InvalidTokenError:
+        return None
+    user_id = claims.get("user_id") if isinstance(claims, dict) else None
+    return str(user_id) if user_id is not None else None
+
+
+_auth_executor = None
+_auth_executor_lock = threading.Lock()
+
+
+def _get_auth_executor():
+    """Threads running CreateOrGetRoom.post's auth calls side by side"""
+    global _auth_executor
+    if _auth_executor is None:
+        with _auth_executor_lock:
+            if _auth_executor is None:
+                _auth_executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, "CHAT_CREATE_ROOM_AUTH_THREADS", 32),
+                    thread_name_prefix="create-room-auth",
+                )
+    return _auth_executor
+
+
+def _results_by(deadline, futures):
+    """
+    Wait for every future until the time.monotonic() deadline.
+
+    Raises:
+        TimeoutError: If any is still running then; those not started yet are cancelled
+    """
+    try:
+        return [future.result(timeout=max(0.0, deadline - time.monotonic())) for future in futures]
+    except TimeoutError:
+        for future in futures:
+            future.cancel()
+        raise
+
+
+def _get_or_create_room(participant_a, participant_b):
+    """
+    get_or_create is race-safe here: the unique (participant_a,
+    participant_b) constraint makes a concurrent duplicate INSERT fail,
+    and Django then reads the winner's row.
+    """
+    room, created = ChatRoom.objects.get_or_create(participant_a=participant_a, participant_b=participant_b)
+    if created:
+        ensure_counters(room.id, (room.participant_a, room.participant_b))
+    return room, created
 
-        auth_url = getattr(settings, 'AUTH_API_URL', 'http://authservice:8080')
 
-        for user_id in user_ids:
-            try:
-                # Try to fetch user profile from auth service
-                url = f"{auth_url.rstrip('/')}/api/users/{user_id}/"
-                headers = {"Authorization": f"Bearer {token}"}
-                
-                response = httpx.get(url, headers=headers, timeout=5.0)
-                
-                if response.status_code == 404:
-                    logger.error(f"User {user_id} not found in auth service")
-                    return False
-                elif response.status_code != 200:
-                    logger.warning(f"Auth service returned status {response.status_code} for user {user_id}")
-                    # Continue anyway - might be auth service issue
-                    
-            except Exception as e:
-                logger.error(f"Error verifying user {user_id}: {str(e)}")
-                # Don't block room creation due to transient network issues
-                
-        return True
 class RoomMessages (APIView):
+    """
+    Room history, newest page first.
+
+    Query params:
+        limit: Page size (capped at CHAT_MAX_PAGE_SIZE)
+        before: Cursor from a previous response's "prev"; older messages
+        after: Cursor from a previous response's "next"; newer messages
+    """
     def get(self, request, room_id):
-        room = get_object_or_404(ChatRoom, id=room_id)
-        qs = room.messages.all()
-        serializer = MessageSerializer(qs, many=True)
-        return Response(serializer.data)
+        # Unauthenticated, so stickiness keys on the token's (unverified) claim;
+        # a wrong claim only changes which database serves the page
+        token = _bearer_token(request)
+        with replica_reads(_claimed_user_id(token) if token else None):
+            room = get_object_or_404(ChatRoom, id=room_id)
+            try:
+                limit = parse_limit(request.query_params.get("limit"))
+                rows, prev_cursor, next_cursor = paginate_keyset(
+                    room.messages.all(),
+                    limit,
+                    before=request.query_params.get("before"),
+                    after=request.query_params.get("after"),
+                )
+            except (InvalidCursor, ValueError) as e:
+                return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            serializer = MessageSerializer(rows, many=True)
+            return Response({
+                "results": serializer.data,
+                "prev": prev_cursor,
+                "next": next_cursor,
+            })
+
+
+class MarkRoomRead(APIView):
+    """Mark everything up to message_id in a room as read for the caller"""
+    serializer_class = MarkReadSerializer
+
+    def post(self, request, room_id):
+        user_id, error = authenticate_request(request)
+        if error:
+            return error
+        serializer = MarkReadSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        participants = get_participants(room_id)
+        if participants is None:
+            return Response({"detail": "Room not found"}, status=status.HTTP_404_NOT_FOUND)
+        if user_id not in participants:
+            return Response({"detail": "You are not a participant of this room"}, status=status.HTTP_403_FORBIDDEN)
+
+        up_to_id = serializer.validated_data['message_id']
+        marked = mark_read(room_id, user_id, up_to_id)
+        if marked:
+            note_write(user_id)
+            async_to_sync(broadcast_receipt)(f"chat_{room_id}", user_id, up_to_id)
+        return Response({
+            "room_id": room_id,
+            "marked": marked,
+            "unread": unread_count(room_id, user_id),
+        })
+
+
+class MessageSearch(APIView):
+    """
+    Full-text search across the caller's rooms, best match first.
+
+    Query params:
+        q: Search terms; quoted phrases and -exclusions are honoured on PostgreSQL
+        room_id: Only search this room
+        limit: Page size (capped at CHAT_MAX_PAGE_SIZE)
+        after: Cursor from a previous response's "next"; the following hits
+    """
+    def get(self, request):
+        user_id, error = authenticate_request(request)
+        if error:
+            return error
+        with replica_reads(user_id):
+            try:
+                limit = parse_limit(request.query_params.get("limit"))
+                room_id = request.query_params.get("room_id")
+                hits, next_cursor = search_messages(
+                    user_id,
+                    request.query_params.get("q", ""),
+                    limit,
+                    after=request.query_params.get("after"),
+                    room_id=int(room_id) if room_id else None,
+                )
+            except (InvalidCursor, ValueError) as e:
+                return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            return Response({
+                "results": SearchHitSerializer(hits, many=True).data,
+                "next": next_cursor,
+            })
+
+
+def metrics_view(request):
+    """Prometheus scrape endpoint; requires "Authorization: Bearer <METRICS_TOKEN>" when that is set"""
+    token = getattr(settings, "METRICS_TOKEN", None)
+    if token and not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        return HttpResponse(status=401)
+    return HttpResponse(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
@@ -10,10 +10,22 @@ django.setup()
 # Import after setup to avoid ImproperlyConfigured errors
 from chat.middleware import JwtAuthMiddlewareStack
 from chat import routing
+from chat.auth_client import aclose_clients
+from chat.db import shutdown_executor
+from chat.lifespan import lifespan_app, on_shutdown
+from chat.persistence import flush_pending_messages
+from chat.profiling import ProfilingMiddleware
+from chat.receipts import flush_pending_receipts
 
-application = ProtocolTypeRouter({
+on_shutdown(flush_pending_messages)
+on_shutdown(flush_pending_receipts)
+on_shutdown(aclose_clients)
+on_shutdown(shutdown_executor)
+
+application = ProfilingMiddleware(ProtocolTypeRouter({
     "http": get_asgi_application(),
     "websocket": JwtAuthMiddlewareStack(
         URLRouter(routing.websocket_urlpatterns)
     ),
-})
+    "lifespan": lifespan_app,
+}))
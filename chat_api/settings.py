@@ -63,22 +63,104 @@ DATABASES = {
         'PASSWORD': os.getenv('DB_PASSWORD', 'postgres'),
         'HOST': os.getenv('DB_HOST', 'localhost'),
         'PORT': os.getenv('DB_PORT', '5432'),
+        # Closed after each request / DB hop by default. Don't raise this under
+        # Daphne: every HTTP request runs its sync view on a new thread, so
+        # each would leave a connection open for the full max age. Use DB_POOL
+        # to reuse connections.
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', 0)),
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
+# DB_POOL: psycopg 3 connection pool instead of one connection per thread
+# (Django requires CONN_MAX_AGE 0 with it). Connections are checked on checkout.
+DB_POOL = os.getenv('DB_POOL', 'false').lower() in ('1', 'true', 'yes')
+if DB_POOL:
+    from psycopg_pool import ConnectionPool
+
+    DATABASES['default']['CONN_MAX_AGE'] = 0
+    DATABASES['default']['OPTIONS'] = {
+        'pool': {
+            'min_size': int(os.getenv('DB_POOL_MIN_SIZE', 2)),
+            'max_size': int(os.getenv('DB_POOL_MAX_SIZE', 20)),
+            'timeout': float(os.getenv('DB_POOL_TIMEOUT', 10.0)),
+            'max_idle': float(os.getenv('DB_POOL_MAX_IDLE', 300.0)),
+            'check': ConnectionPool.check_connection,
+        },
+    }
+
+# Read replicas (optional): DB_REPLICA_HOSTS=host1,host2 adds the aliases replica_1,
+# replica_2 with the primary's settings unless DB_REPLICA_PORT/NAME/USER/PASSWORD say
+# otherwise. History, inbox and search reads go to a replica, except for a user who
+# wrote in the last DB_REPLICA_STICKY_SECONDS or when every replica lags more than
+# DB_REPLICA_MAX_LAG seconds (measured every DB_REPLICA_LAG_CHECK_INTERVAL). Replicas
+# share the primary's CONN_MAX_AGE, so keep it 0 unless DB_POOL is on.
+DB_REPLICA_CONNECT_TIMEOUT = int(os.getenv('DB_REPLICA_CONNECT_TIMEOUT', 2))  # seconds; bounds checks of a dead replica
+DATABASE_REPLICAS = []
+for _index, _host in enumerate(filter(None, os.getenv('DB_REPLICA_HOSTS', '').split(',')), start=1):
+    DATABASES[f'replica_{_index}'] = {
+        **DATABASES['default'],
+        'OPTIONS': {**DATABASES['default'].get('OPTIONS', {}), 'connect_timeout': DB_REPLICA_CONNECT_TIMEOUT},
+        'HOST': _host.strip(),
+        'PORT': os.getenv('DB_REPLICA_PORT', DATABASES['default']['PORT']),
+        'NAME': os.getenv('DB_REPLICA_NAME', DATABASES['default']['NAME']),
+        'USER': os.getenv('DB_REPLICA_USER', DATABASES['default']['USER']),
+        'PASSWORD': os.getenv('DB_REPLICA_PASSWORD', DATABASES['default']['PASSWORD']),
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append(f'replica_{_index}')
+DATABASE_ROUTERS = ['chat.routers.ReplicaRouter']
+DB_REPLICA_MAX_LAG = float(os.getenv('DB_REPLICA_MAX_LAG', 2.0))
+DB_REPLICA_LAG_CHECK_INTERVAL = float(os.getenv('DB_REPLICA_LAG_CHECK_INTERVAL', 1.0))
+DB_REPLICA_STICKY_SECONDS = float(os.getenv('DB_REPLICA_STICKY_SECONDS', 5.0))
+DB_STICKY_REDIS_URL = os.getenv('DB_STICKY_REDIS_URL', None)  # stickiness shared across workers
+
+# Threads running database work for async code (consumers, write-behind,
+# read receipts); keep at or below DB_POOL_MAX_SIZE. SQLite always gets one.
+CHAT_DB_THREADS = int(os.getenv('CHAT_DB_THREADS', 10))
+CHAT_DB_CHUNK_SIZE = int(os.getenv('CHAT_DB_CHUNK_SIZE', 500))  # rows per query when iterating messages
+
 # Redis for Channels
 REDIS_HOST = os.getenv('REDIS_HOST', 'localhost')
 REDIS_PORT = int(os.getenv('REDIS_PORT', 6379))
 
-CHANNEL_LAYERS = {
-    "default": {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
-        'CONFIG': {
-            'hosts': [(REDIS_HOST, REDIS_PORT)]
-        },
+REDIS_CHANNEL_LAYER = {
+    'BACKEND': 'channels_redis.core.RedisChannelLayer',
+    'CONFIG': {
+        'hosts': [(REDIS_HOST, REDIS_PORT)]
     },
 }
 
+# CHANNEL_LAYER_MODE: "redis" (every event through Redis), "hybrid" (local
+# members served in memory, one Redis publish per event) or "local" (single node, no Redis)
+CHANNEL_LAYER_MODE = os.getenv('CHANNEL_LAYER_MODE', 'redis')
+
+# CHANNEL_LAYER_PROCESS_CAPACITY: events from other processes that may wait in Redis
+# for one hybrid process; past it, cross-process events for that process are dropped
+CHANNEL_LAYER_PROCESS_CAPACITY = int(os.getenv('CHANNEL_LAYER_PROCESS_CAPACITY', 10000))
+
+if CHANNEL_LAYER_MODE == 'hybrid':
+    CHANNEL_LAYERS = {
+        "default": {
+            'BACKEND': 'chat.layers.HybridChannelLayer',
+            'CONFIG': {
+                'remote': REDIS_CHANNEL_LAYER,
+                'process_channel_capacity': CHANNEL_LAYER_PROCESS_CAPACITY,
+            },
+        },
+    }
+elif CHANNEL_LAYER_MODE == 'local':
+    CHANNEL_LAYERS = {
+        "default": {
+            'BACKEND': 'chat.layers.HybridChannelLayer',
+            'CONFIG': {'remote': None},
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        "default": REDIS_CHANNEL_LAYER,
+    }
+
 # REST Framework
 REST_FRAMEWORK = {
     # 'DEFAULT_AUTHENTICATION_CLASSES': [
@@ -99,11 +181,104 @@ SPECTACULAR_SETTINGS = {
 JWT_SECRET = os.getenv('JWT_SECRET', "fallback-secret")
 JWT_ALGORITHM = os.getenv('JWT_ALGORITHM', "HS256")
 JWT_PUBLIC_KEY = os.getenv('JWT_PUBLIC_KEY', None)  # For RS256
+JWT_PAYLOAD_CACHE_SIZE = int(os.getenv('JWT_PAYLOAD_CACHE_SIZE', 10000))
+JWT_PAYLOAD_CACHE_TTL = float(os.getenv('JWT_PAYLOAD_CACHE_TTL', 300.0))  # never past the token's exp
 
 # Auth Service Configuration 
 AUTH_API_URL = os.getenv("AUTH_API_URL", "http://authservice:8080")
 AUTH_PROFILE_ENDPOINT = os.getenv("AUTH_PROFILE_ENDPOINT", "api/users/profile/")  # FIXED: Added comma
 
+# Shared HTTP client pool for auth service calls
+AUTH_HTTP_TIMEOUT = float(os.getenv("AUTH_HTTP_TIMEOUT", 10.0))
+AUTH_HTTP_CONNECT_TIMEOUT = float(os.getenv("AUTH_HTTP_CONNECT_TIMEOUT", 3.0))
+AUTH_VERIFY_TIMEOUT = float(os.getenv("AUTH_VERIFY_TIMEOUT", 5.0))
+CHAT_CREATE_ROOM_DEADLINE = float(os.getenv("CHAT_CREATE_ROOM_DEADLINE", 10.0))  # whole POST /rooms/, auth calls included
+CHAT_CREATE_ROOM_AUTH_THREADS = int(os.getenv("CHAT_CREATE_ROOM_AUTH_THREADS", 32))  # POST /rooms/ auth calls in flight per process
+AUTH_HTTP_MAX_CONNECTIONS = int(os.getenv("AUTH_HTTP_MAX_CONNECTIONS", 100))
+AUTH_HTTP_MAX_KEEPALIVE = int(os.getenv("AUTH_HTTP_MAX_KEEPALIVE", 20))
+AUTH_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("AUTH_HTTP_KEEPALIVE_EXPIRY", 30.0))
+AUTH_HTTP2 = os.getenv("AUTH_HTTP2", "false").lower() in ("1", "true", "yes")  # needs the 'h2' package
+
+# Profile cache (keyed by token hash); set the TTL to 0 to disable
+AUTH_PROFILE_CACHE_SIZE = int(os.getenv("AUTH_PROFILE_CACHE_SIZE", 10000))
+AUTH_PROFILE_CACHE_TTL = float(os.getenv("AUTH_PROFILE_CACHE_TTL", 60.0))
+AUTH_PROFILE_NEGATIVE_TTL = float(os.getenv("AUTH_PROFILE_NEGATIVE_TTL", 5.0))
+AUTH_PROFILE_CACHE_REDIS_URL = os.getenv("AUTH_PROFILE_CACHE_REDIS_URL", None)  # shared tier across workers
+
+# Participant verification
+AUTH_BULK_USERS_ENDPOINT = os.getenv("AUTH_BULK_USERS_ENDPOINT", None)  # e.g. "api/users/bulk/", takes ?ids=1,2
+AUTH_VERIFY_CONCURRENCY = int(os.getenv("AUTH_VERIFY_CONCURRENCY", 8))
+AUTH_USER_EXISTS_CACHE_SIZE = int(os.getenv("AUTH_USER_EXISTS_CACHE_SIZE", 50000))
+AUTH_USER_EXISTS_CACHE_TTL = float(os.getenv("AUTH_USER_EXISTS_CACHE_TTL", 300.0))
+
+# Room membership cache used by WebSocket connects
+ROOM_CACHE_SIZE = int(os.getenv("ROOM_CACHE_SIZE", 50000))
+ROOM_CACHE_TTL = float(os.getenv("ROOM_CACHE_TTL", 3600.0))
+ROOM_NEGATIVE_CACHE_TTL = float(os.getenv("ROOM_NEGATIVE_CACHE_TTL", 5.0))
+
+# Write-behind message persistence: broadcast immediately, bulk insert in batches.
+# A failed batch is retried CHAT_WRITE_BEHIND_RETRIES times with backoff. Pending
+# messages are flushed when a consumer disconnects and when the process exits;
+# Daphne sends no lifespan events, so the lifespan flush never runs under it and
+# a SIGKILL (or an exhausted retry) loses messages that were already broadcast.
+CHAT_WRITE_BEHIND = os.getenv("CHAT_WRITE_BEHIND", "false").lower() in ("1", "true", "yes")
+CHAT_WRITE_BEHIND_BATCH_SIZE = int(os.getenv("CHAT_WRITE_BEHIND_BATCH_SIZE", 100))
+CHAT_WRITE_BEHIND_FLUSH_MS = int(os.getenv("CHAT_WRITE_BEHIND_FLUSH_MS", 20))
+CHAT_WRITE_BEHIND_RETRIES = int(os.getenv("CHAT_WRITE_BEHIND_RETRIES", 3))
+
+# Typing indicators: at most one broadcast per interval, auto-stop after idle timeout
+CHAT_TYPING_INTERVAL = float(os.getenv("CHAT_TYPING_INTERVAL", 1.0))
+CHAT_TYPING_IDLE_TIMEOUT = float(os.getenv("CHAT_TYPING_IDLE_TIMEOUT", 5.0))
+
+# Presence: reference-counted per user, offline published after a grace period
+PRESENCE_REDIS_URL = os.getenv("PRESENCE_REDIS_URL", None)  # shared across workers; in-memory when unset
+PRESENCE_OFFLINE_GRACE = float(os.getenv("PRESENCE_OFFLINE_GRACE", 5.0))
+
+# Read receipts: bursts per (room, user) are written once per window
+CHAT_READ_COALESCE_MS = int(os.getenv("CHAT_READ_COALESCE_MS", 500))
+
+# Reconnect resume (ws/chat/<room_id>/?last_seq=N): at most this many messages are replayed
+CHAT_RESUME_MAX_MESSAGES = int(os.getenv("CHAT_RESUME_MAX_MESSAGES", 500))
+
+# Inbound rate limits, token buckets per event type: {event: (tokens per second, burst)}.
+# CHAT_RATE_LIMITS apply to each connection; CHAT_USER_RATE_LIMITS to each user_id over
+# all their connections, shared across workers when CHAT_RATE_LIMIT_REDIS_URL is set
+CHAT_RATE_LIMITS = {
+    "message": (5.0, 20),
+    "typing": (5.0, 10),
+    "read": (10.0, 30),
+    "fetch_profile": (0.5, 3),
+    "status": (1.0, 5),
+    "unknown": (2.0, 10),
+}
+CHAT_USER_RATE_LIMITS = {
+    "message": (10.0, 40),
+    "fetch_profile": (1.0, 5),
+}
+CHAT_RATE_LIMIT_REDIS_URL = os.getenv("CHAT_RATE_LIMIT_REDIS_URL", None)
+
+# Per-connection outbound queues: typing/presence/read state is collapsed or dropped
+# past CHAT_OUTBOUND_QUEUE_SIZE pending frames; a socket that stays over it for
+# CHAT_OUTBOUND_SLOW_SECONDS, or reaches CHAT_OUTBOUND_HARD_LIMIT, is closed with 4008
+CHAT_OUTBOUND_QUEUE_SIZE = int(os.getenv("CHAT_OUTBOUND_QUEUE_SIZE", 256))
+CHAT_OUTBOUND_HARD_LIMIT = int(os.getenv("CHAT_OUTBOUND_HARD_LIMIT", 1024))
+CHAT_OUTBOUND_SLOW_SECONDS = float(os.getenv("CHAT_OUTBOUND_SLOW_SECONDS", 10.0))
+
+# Prometheus metrics at /metrics, per process; bearer token required when set
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", None)
+
+# Opt-in profiling (chat.profiling): a fraction of HTTP requests / WS events,
+# or those flagged with X-Profile / ?profile=<PROFILE_TOKEN> (give the token to admins only)
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0.0))
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", None)
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/chat-profiles")
+PROFILE_FORMAT = os.getenv("PROFILE_FORMAT", "collapsed")  # or "pstats"
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", 5))
+
+# Message history pagination
+CHAT_PAGE_SIZE = int(os.getenv("CHAT_PAGE_SIZE", 50))
+CHAT_MAX_PAGE_SIZE = int(os.getenv("CHAT_MAX_PAGE_SIZE", 200))
+
 # Logging
 LOGGING = {
     'version': 1,
@@ -2,9 +2,11 @@
 from django.contrib import admin
 from django.urls import path,include
 from openapi.schema import urlpatterns as doc_urls
+from chat.views import metrics_view
 urlpatterns = [
     path('admin/', admin.site.urls),
     path("api/chat/", include("chat.urls")),
+    path("metrics", metrics_view, name="metrics"),
 ]+doc_urls
 
 